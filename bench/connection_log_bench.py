@@ -0,0 +1,70 @@
+"""
+Compares the cost of recording a closed connection on the relay thread:
+one log line per connection vs. the batched connection log.
+
+Usage: python -m bench.connection_log_bench
+"""
+import logging
+import os
+import tempfile
+from time import perf_counter
+from typing import Tuple
+
+from config.Config import ConnectionLogConfig
+from util.ConnectionLog import ConnectionLog, ConnectionRecord
+
+COUNT = 200000
+
+
+def create_record(index: int) -> ConnectionRecord:
+    return ConnectionRecord('tcp:4:8080', '10.0.0.1', 40000 + index % 20000, '192.168.0.1', 80,
+                            1000.0 + index, 1001.5 + index, 100 * index, 200 * index)
+
+
+def bench_log_lines(path: str) -> float:
+    logger = logging.getLogger('connection-bench')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter('%(levelname)-.1s %(asctime)-.19s [%(name)s] %(message)s'))
+    logger.addHandler(handler)
+
+    records = [create_record(i) for i in range(COUNT)]
+    start = perf_counter()
+    for record in records:
+        logger.info('Connection closed: ' + record.client_ip + ':' + str(record.client_port) + ' -> ' +
+                    record.upstream_ip + ', ' + str(record.bytes_out) + '/' + str(record.bytes_in) + ' bytes, ' +
+                    str(round(record.get_duration(), 3)) + 's')
+    duration = perf_counter() - start
+    handler.close()
+    logger.removeHandler(handler)
+    return duration
+
+
+def bench_connection_log(path: str, file_format: str) -> Tuple[float, float, int]:
+    log = ConnectionLog(ConnectionLogConfig({'path': path, 'format': file_format, 'buffer': COUNT}))
+    log.start()
+    records = [create_record(i) for i in range(COUNT)]
+    start = perf_counter()
+    for record in records:
+        log.add(record)
+    duration = perf_counter() - start
+    log.stop()
+    return duration, perf_counter() - start, log.dropped
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        print('%d closed connections' % COUNT)
+        duration = bench_log_lines(os.path.join(directory, 'lines.log'))
+        print('  log line per connection   %6.2f us/record on the relay thread' % (duration / COUNT * 1e6))
+        for file_format in (ConnectionLog.FORMAT_JSONL, ConnectionLog.FORMAT_BINARY):
+            path = os.path.join(directory, 'connections.' + file_format)
+            duration, total, dropped = bench_connection_log(path, file_format)
+            print('  connection log (%-6s)   %6.2f us/record on the relay thread, %6.2f us/record total, '
+                  '%5.1f bytes/record, %d dropped' %
+                  (file_format, duration / COUNT * 1e6, total / COUNT * 1e6, os.path.getsize(path) / COUNT, dropped))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Stand-in for iptables, ip6tables, iptables-restore and ip6tables-restore used by the scale harness.
+Keeps the rules in a json state file and records every call with its duration.
+
+Usage: fake_iptables.py <binary name> [iptables args]
+
+Environment:
+  FAKE_IPTABLES_STATE  Path of the json state file
+  FAKE_IPTABLES_LOG    Path of the call log (one json object per call)
+  FAKE_IPTABLES_DELAY  Optional delay per call in seconds (e.g. a slow router or a busy xtables lock)
+"""
+import fcntl
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+Rules = Dict[str, Dict[str, List[List[str]]]]
+
+BUILTIN_CHAINS = {
+    'filter': ['INPUT', 'FORWARD', 'OUTPUT'],
+    'nat': ['PREROUTING', 'INPUT', 'OUTPUT', 'POSTROUTING'],
+}
+
+
+class UsageError(Exception):
+    pass
+
+
+def format_rule(num: int, spec: List[str]) -> str:
+    values = {'-p': 'all', '-d': '0.0.0.0/0', '-j': ''}
+    extra = []
+    i = 0
+    while i < len(spec):
+        if spec[i] in ('-p', '-d', '-j', '--dport', '--comment', '--to-destination'):
+            values[spec[i]] = spec[i + 1]
+            i += 2
+        else:
+            i += 1
+    if '--comment' in values:
+        extra.append('/* ' + values['--comment'] + ' */')
+    if '--dport' in values:
+        extra.append(values['-p'] + ' dpt:' + values['--dport'])
+    if '--to-destination' in values:
+        extra.append('to:' + values['--to-destination'])
+    return '%-4d %-10s %-4s --  %-20s %-20s %s' % (num, values['-j'], values['-p'], '0.0.0.0/0', values['-d'],
+                                                 ' '.join(extra))
+
+
+def apply(rules: Rules, table: str, args: List[str]) -> List[str]:
+    """
+    Applies a single iptables command
+    :return: Output lines
+    """
+    if table not in BUILTIN_CHAINS:
+        raise UsageError("can't initialize iptables table `" + table + "': Table does not exist")
+    chains = rules.setdefault(table, {})
+    command = args[0]
+    if command == '-S':
+        # Rules of one or all chains in the syntax of the commands
+        names = args[1:2] or BUILTIN_CHAINS[table] + [name for name in chains if name not in BUILTIN_CHAINS[table]]
+        lines = ['-P ' + name + ' ACCEPT' for name in names if name in BUILTIN_CHAINS[table]]
+        for name in names:
+            lines += ['-A ' + name + ' ' + ' '.join(spec) for spec in chains.get(name, [])]
+        return lines
+    chain = chains.setdefault(args[1], [])
+    if command == '-L':
+        lines = ['Chain ' + args[1] + ' (policy ACCEPT)',
+                 'num  target     prot opt source               destination']
+        return lines + [format_rule(num + 1, spec) for num, spec in enumerate(chain)]
+    if command == '-A':
+        chain.append(args[2:])
+        return []
+
+    num = int(args[2])
+    if num < 1 or num > len(chain):
+        raise UsageError('Index of deletion too big')
+    if command == '-D':
+        del chain[num - 1]
+    elif command == '-R':
+        chain[num - 1] = args[3:]
+    else:
+        raise UsageError('Unknown command ' + command)
+    return []
+
+
+def execute(name: str, args: List[str], rules: Rules) -> List[str]:
+    if name.endswith('-restore'):
+        # All commands of the transaction are applied or none
+        staged = json.loads(json.dumps(rules))
+        table = 'filter'
+        for line in sys.stdin.read().splitlines():
+            line = line.strip()
+            if line.startswith('*'):
+                table = line[1:]
+            elif line.startswith('-'):
+                apply(staged, table, line.split())
+        rules.clear()
+        rules.update(staged)
+        return []
+
+    table = 'filter'
+    if args[0] == '-t':
+        table = args[1]
+        args = args[2:]
+    return apply(rules, table, args)
+
+
+def main():
+    start = time.perf_counter()
+    name = sys.argv[1]
+    args = sys.argv[2:]
+    state_path = os.environ['FAKE_IPTABLES_STATE']
+    stack = 'ip6tables' if name.startswith('ip6tables') else 'iptables'
+
+    delay = float(os.environ.get('FAKE_IPTABLES_DELAY', 0))
+    with open(state_path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if delay > 0:
+            time.sleep(delay)
+        state = {}
+        if os.path.isfile(state_path):
+            with open(state_path) as file:
+                state = json.load(file)
+
+        exit_code = 0
+        try:
+            output = execute(name, args, state.setdefault(stack, {}))
+            with open(state_path, 'w') as file:
+                json.dump(state, file)
+            if len(output) > 0:
+                print('\n'.join(output))
+        except (UsageError, IndexError, ValueError) as e:
+            print(name + ': ' + str(e), file=sys.stderr)
+            exit_code = 1
+
+        with open(os.environ['FAKE_IPTABLES_LOG'], 'a') as log:
+            log.write(json.dumps({'bin': name, 'args': args, 'duration': time.perf_counter() - start,
+                                  'exit_code': exit_code}) + '\n')
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
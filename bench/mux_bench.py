@@ -0,0 +1,87 @@
+"""
+Compares the time to the first response of a plain relay forward with a mux forward
+which has to peek the requested host name and match it against many routes.
+
+Usage: python -m bench.mux_bench
+"""
+import socket
+import threading
+from time import perf_counter
+from typing import List
+
+from config.Config import RouteConfig
+from util.Mux import HostPeek, MuxRouter
+from util.Relay import Relay
+
+CONNECTIONS = 2000
+ROUTES = 50
+REQUEST = b'GET / HTTP/1.1\r\nHost: host25.example.com\r\nUser-Agent: bench\r\n\r\n'
+
+
+def start_responder() -> int:
+    """
+    Starts a server which answers the first request of every connection with a single byte
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(128)
+
+    def serve(conn: socket.socket):
+        with conn:
+            if conn.recv(65536):
+                conn.sendall(b'r')
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def first_response(port: int) -> List[float]:
+    times = []
+    for _ in range(CONNECTIONS):
+        start = perf_counter()
+        with socket.create_connection(('127.0.0.1', port)) as sock:
+            sock.sendall(REQUEST)
+            sock.recv(1)
+        times.append(perf_counter() - start)
+    times.sort()
+    return times
+
+
+def report(name: str, times: List[float]):
+    print(name)
+    print('  first response p50 / p99:  %.1f / %.1f us' % (times[len(times) // 2] * 1e6,
+                                                           times[int(len(times) * 0.99)] * 1e6))
+
+
+def main():
+    port = start_responder()
+
+    relay = Relay(4, 0, 4, port)
+    relay.set_destination('127.0.0.1')
+    relay.start()
+    report('relay', first_response(relay.get_port()))
+    relay.stop()
+
+    routes = [RouteConfig({'match': 'host' + str(i) + '.example.com', 'host': 'localhost'}) for i in range(ROUTES)]
+    routes.append(RouteConfig({'match': '*.example.com', 'host': 'localhost'}))
+    router = MuxRouter(routes, port)
+    for route in routes:
+        router.set_address(route.match, '127.0.0.1')
+    relay = Relay(4, 0, 4, port, router=router)
+    relay.start()
+    report('mux (' + str(len(routes)) + ' routes)', first_response(relay.get_port()))
+    relay.stop()
+
+    start = perf_counter()
+    for _ in range(100000):
+        router.select(HostPeek.parse(REQUEST)[1])
+    print('peek + route:                 %.2f us' % ((perf_counter() - start) * 10))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Compares the pooled native relay against a naive relay which allocates
+a new bytes object for every recv.
+
+Usage: python -m bench.relay_bench
+"""
+import resource
+import socket
+import threading
+import tracemalloc
+from time import perf_counter
+from typing import List
+
+from util.Relay import Relay
+
+BUFFER_SIZE = 16384
+TRANSFER_SIZE = 64 * 1024 * 1024
+PING_COUNT = 5000
+PING_SIZE = 64
+
+
+class NaiveRelay:
+    """
+    Thread per direction relay using recv()/sendall()
+    """
+
+    def __init__(self, dst_port: int):
+        self._dst_port = dst_port
+        self.allocations = 0
+        self.allocated_bytes = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(16)
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def get_port(self) -> int:
+        return self._sock.getsockname()[1]
+
+    def stop(self):
+        self._sock.close()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self._sock.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(('127.0.0.1', self._dst_port))
+            for src, dst in ((client, upstream), (upstream, client)):
+                src.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                threading.Thread(target=self._pipe, args=(src, dst), daemon=True).start()
+
+    def _pipe(self, src: socket.socket, dst: socket.socket):
+        while True:
+            try:
+                data = src.recv(BUFFER_SIZE)
+            except OSError:
+                return
+            self.allocations += 1
+            self.allocated_bytes += BUFFER_SIZE
+            if not data:
+                dst.close()
+                return
+            dst.sendall(data)
+
+
+def start_sink() -> int:
+    """
+    Starts a server which echos small messages and discards large ones
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(16)
+
+    def serve(conn: socket.socket):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = bytearray(65536)
+        while True:
+            received = conn.recv_into(buffer)
+            if received == 0:
+                return
+            if received <= PING_SIZE:
+                conn.sendall(buffer[:received])
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def transfer(port: int) -> float:
+    chunk = b'x' * 65536
+    start = perf_counter()
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        for _ in range(TRANSFER_SIZE // len(chunk)):
+            sock.sendall(chunk)
+    return perf_counter() - start
+
+
+def ping(port: int) -> List[float]:
+    message = b'p' * PING_SIZE
+    times = []
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for _ in range(PING_COUNT):
+            start = perf_counter()
+            sock.sendall(message)
+            received = 0
+            while received < PING_SIZE:
+                received += len(sock.recv(PING_SIZE))
+            times.append(perf_counter() - start)
+    times.sort()
+    return times
+
+
+def run(name: str, port: int, allocated):
+    tracemalloc.start()
+    cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+    duration = transfer(port)
+    cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    mb = TRANSFER_SIZE / 1024 / 1024
+    cpu = (cpu_end.ru_utime - cpu_start.ru_utime) + (cpu_end.ru_stime - cpu_start.ru_stime)
+    allocations, allocated_bytes = allocated()
+    times = ping(port)
+    print(name)
+    print('  throughput:        %.1f MB/s' % (mb / duration))
+    print('  cpu per MB:        %.3f ms' % (cpu * 1000 / mb))
+    print('  buffer allocs/MB:  %.1f (%.0f KB/MB)' % (allocations / mb, allocated_bytes / 1024 / mb))
+    print('  peak traced mem:   %.0f KB' % (peak / 1024))
+    print('  ping p50 / p99:    %.1f / %.1f us' % (times[len(times) // 2] * 1e6, times[int(len(times) * 0.99)] * 1e6))
+
+
+def main():
+    sink_port = start_sink()
+
+    naive = NaiveRelay(sink_port)
+    run('naive relay', naive.get_port(), lambda: (naive.allocations, naive.allocated_bytes))
+    naive.stop()
+
+    relay = Relay(4, 0, 4, sink_port, BUFFER_SIZE)
+    relay.set_destination('127.0.0.1')
+    relay.start()
+    pool = relay._pool
+    run('pooled relay', relay.get_port(), lambda: (pool.get_allocated(), pool.get_allocated() * BUFFER_SIZE))
+    relay.stop()
+
+
+if __name__ == '__main__':
+    main()
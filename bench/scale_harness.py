@@ -0,0 +1,297 @@
+"""
+End-to-end scale test: Runs the real tunnel.py with a growing number of forwards against
+local stand-ins for the DNS server, iptables/ip6tables and the upstream servers.
+
+Reports per run:
+- startup: time from launch until every forward accepts connections
+- spawns: iptables calls (from the fake binaries) and child processes (socat)
+- DNS switch: time until new connections of all sampled forwards reach the new address
+- resources: RSS, threads, file descriptors and CPU time of the tunnel process
+- shutdown: time until the process exited after SIGTERM and the leftover firewall rules
+
+Usage: python -m bench.scale_harness [--mode relay|socat] [--iptables-delay s] [forwards ...]
+"""
+import argparse
+import json
+import os
+import resource
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter, sleep
+from typing import Dict, List, Optional
+
+from util.Process import Process
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_IPTABLES = os.path.join(REPO_DIR, 'bench', 'fake_iptables.py')
+IPTABLES_BINARIES = ('iptables', 'ip6tables', 'iptables-restore', 'ip6tables-restore')
+
+DEST_HOST = 'upstream.test'
+BASE_PORT = 20000
+UPSTREAM_COUNT = 4
+SAMPLE_COUNT = 20
+TIMEOUT = 300
+
+
+class StubDns:
+    """
+    UDP nameserver which answers A queries from a table that can be changed at runtime
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self._answers: Dict[str, List[str]] = {}
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self.address = '127.0.0.1:' + str(self._sock.getsockname()[1])
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def set(self, name: str, ips: List[str]):
+        self._answers[name] = ips
+
+    def _serve(self):
+        while True:
+            query, addr = self._sock.recvfrom(512)
+            self.queries += 1
+            self._sock.sendto(self._reply(query), addr)
+
+    def _reply(self, query: bytes) -> bytes:
+        query_id = struct.unpack('!H', query[:2])[0]
+        offset = 12
+        labels = []
+        while query[offset] != 0:
+            length = query[offset]
+            labels.append(query[offset + 1:offset + 1 + length].decode())
+            offset += length + 1
+        qtype = struct.unpack('!H', query[offset + 1:offset + 3])[0]
+        question = query[12:offset + 5]
+
+        ips = self._answers.get('.'.join(labels))
+        if ips is None:
+            return struct.pack('!HHHHHH', query_id, 0x8183, 1, 0, 0, 0) + question
+        answers = b''
+        count = 0
+        for ip in ips:
+            if qtype != 1:
+                continue
+            # Name pointer to the question, type A, class IN, ttl 0
+            answers += struct.pack('!HHHIH', 0xc00c, 1, 1, 0, 4) + socket.inet_aton(ip)
+            count += 1
+        return struct.pack('!HHHHHH', query_id, 0x8180, 1, count, 0, 0) + question + answers
+
+
+class WhoamiServer:
+    """
+    Upstream which sends the local address a connection has been accepted on, then echos
+    """
+
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('0.0.0.0', 0))
+        self._sock.listen(socket.SOMAXCONN)
+        self.port = self._sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self._sock.accept()
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def _serve(conn: socket.socket):
+        with conn:
+            try:
+                conn.sendall(conn.getsockname()[0].encode() + b'\n')
+                while True:
+                    data = conn.recv(4096)
+                    if not data:
+                        return
+                    conn.sendall(data)
+            except OSError:
+                return
+
+
+def whoami(port: int) -> Optional[str]:
+    """
+    Returns the upstream address a new connection through the forward reaches, None if it fails
+    """
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=2) as sock:
+            data = b''
+            while not data.endswith(b'\n'):
+                chunk = sock.recv(64)
+                if not chunk:
+                    return None
+                data += chunk
+            return data.decode().strip()
+    except OSError:
+        return None
+
+
+def wait_until(condition, timeout: float = TIMEOUT) -> float:
+    """
+    Polls the condition and returns the time until it was met
+    """
+    start = perf_counter()
+    while not condition():
+        if perf_counter() - start > timeout:
+            raise TimeoutError('Condition not met within ' + str(timeout) + 's')
+        sleep(0.01)
+    return perf_counter() - start
+
+
+def create_fake_binaries(bin_dir: str):
+    for name in IPTABLES_BINARIES:
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as file:
+            file.write('#!/bin/sh\nexec "' + sys.executable + '" "' + FAKE_IPTABLES + '" ' + name + ' "$@"\n')
+        os.chmod(path, 0o755)
+
+
+def read_calls(path: str) -> List[dict]:
+    if not os.path.isfile(path):
+        return []
+    with open(path) as file:
+        return [json.loads(line) for line in file]
+
+
+def read_log(path: str) -> str:
+    with open(path) as file:
+        return file.read()
+
+
+def read_rules(path: str) -> int:
+    """
+    Returns the number of rules in the fake firewall
+    """
+    if not os.path.isfile(path):
+        return 0
+    with open(path) as file:
+        state = json.load(file)
+    return sum(len(chain) for tables in state.values() for chains in tables.values() for chain in chains.values())
+
+
+def process_resources(pid: int) -> Dict[str, float]:
+    status = {}
+    with open('/proc/' + str(pid) + '/status') as file:
+        for line in file:
+            key, _, value = line.partition(':')
+            status[key] = value.strip()
+    with open('/proc/' + str(pid) + '/stat') as file:
+        fields = file.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    return {
+        'rss_mb': int(status['VmRSS'].split()[0]) / 1024,
+        'threads': int(status['Threads']),
+        'fds': len(os.listdir('/proc/' + str(pid) + '/fd')),
+        'cpu_s': (int(fields[11]) + int(fields[12])) / ticks,
+    }
+
+
+def run(forwards: int, mode: str, iptables_delay: float, dns: StubDns, upstreams: List[WhoamiServer]) -> dict:
+    dns.set(DEST_HOST, ['127.0.0.1'])
+    ports = [BASE_PORT + i for i in range(forwards)]
+    step = max(1, forwards // SAMPLE_COUNT)
+    samples = ports[::step] + [ports[-1]]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bin_dir = os.path.join(tmp_dir, 'bin')
+        os.mkdir(bin_dir)
+        create_fake_binaries(bin_dir)
+        state_path = os.path.join(tmp_dir, 'iptables.json')
+        calls_path = os.path.join(tmp_dir, 'calls.jsonl')
+
+        config_path = os.path.join(tmp_dir, 'config.json')
+        with open(config_path, 'w') as file:
+            json.dump({
+                'dest': DEST_HOST,
+                'dns': {'nameserver': dns.address, 'interval': 0.2},
+                'shutdown_timeout': 5,
+                'forward': [{
+                    'prot': 'tcp',
+                    'mode': mode,
+                    'src': {'stack': 4, 'port': port},
+                    'dest': {'stack': 4, 'port': upstreams[i % len(upstreams)].port},
+                } for i, port in enumerate(ports)],
+            }, file)
+
+        env = dict(os.environ)
+        env['PATH'] = bin_dir + os.pathsep + env['PATH']
+        env['FAKE_IPTABLES_STATE'] = state_path
+        env['FAKE_IPTABLES_LOG'] = calls_path
+        env['FAKE_IPTABLES_DELAY'] = str(iptables_delay)
+
+        result = {'forwards': forwards}
+        with open(os.path.join(tmp_dir, 'tunnel.log'), 'w') as log:
+            start = perf_counter()
+            proc = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'tunnel.py'), '-c', config_path],
+                                    cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+            try:
+                # Forwards are started in order, the last one accepting means all of them do
+                wait_until(lambda: whoami(ports[-1]) is not None)
+                result['startup_s'] = perf_counter() - start
+                result['ready'] = all(whoami(port) == '127.0.0.1' for port in samples)
+                calls = read_calls(calls_path)
+                probes = [call for call in calls if call['args'][-1:] == ['-S']]
+                if len(probes) == 0 or any(call['exit_code'] != 0 for call in probes):
+                    # Without firewall handling there are no iptables calls to measure
+                    raise RuntimeError('The firewall probe of tunnel.py failed:\n' +
+                                       read_log(log.name))
+                result['startup_calls'] = len(calls)
+                result['children'] = len(Process.get_child_pids(proc.pid))
+                result.update(process_resources(proc.pid))
+
+                dns.set(DEST_HOST, ['127.0.0.2'])
+                result['dns_switch_s'] = wait_until(lambda: all(whoami(port) == '127.0.0.2' for port in samples))
+
+                shutdown_start = perf_counter()
+                proc.send_signal(signal.SIGTERM)
+                proc.wait(TIMEOUT)
+                result['shutdown_s'] = perf_counter() - shutdown_start
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+
+        calls = read_calls(calls_path)
+        result['calls'] = len(calls)
+        result['failed_calls'] = len([call for call in calls if call['exit_code'] != 0])
+        result['iptables_s'] = sum(call['duration'] for call in calls)
+        result['leftover_rules'] = read_rules(state_path)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', default='relay', help='Forward mode (relay or socat)')
+    parser.add_argument('--iptables-delay', type=float, default=0, help='Delay of every fake iptables call in s')
+    parser.add_argument('forwards', nargs='*', type=int, default=[10, 100, 500])
+    args = parser.parse_args()
+
+    # Every relay forward needs a few file descriptors
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    dns = StubDns()
+    upstreams = [WhoamiServer() for _ in range(UPSTREAM_COUNT)]
+    print('%8s %9s %7s %7s %9s %8s %8s %6s %6s %8s %9s %9s' % (
+        'forwards', 'startup', 'spawns', 'failed', 'ipt time', 'children', 'dns sw', 'rss', 'thr', 'fds',
+        'cpu', 'shutdown') + '  leftover rules')
+    for forwards in args.forwards:
+        result = run(forwards, args.mode, args.iptables_delay, dns, upstreams)
+        print('%8d %8.2fs %7d %7d %8.2fs %8d %7.2fs %5.0fM %6d %8d %8.2fs %8.2fs  %d%s' % (
+            result['forwards'], result['startup_s'], result['calls'], result['failed_calls'],
+            result['iptables_s'], result['children'], result['dns_switch_s'], result['rss_mb'],
+            result['threads'], result['fds'], result['cpu_s'], result['shutdown_s'], result['leftover_rules'],
+            '' if result['ready'] else ' (forwards not ready)'))
+    print('dns queries: %d' % dns.queries)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Measures the accuracy and the CPU overhead of the relay bandwidth limits
+and the latency of an interactive forward while a bulk forward saturates the global limit.
+
+Usage: python -m bench.shaping_bench
+"""
+import resource
+import socket
+import threading
+from time import perf_counter
+from typing import Optional
+
+from bench.relay_bench import PING_SIZE
+from util.Relay import Relay
+from util.Shaper import Shaper, TokenBucket
+
+DURATION = 3
+
+
+class CountingSink:
+    """
+    Server which counts the received bytes and echos small messages
+    """
+
+    def __init__(self):
+        self.received = 0
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(16)
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self._server.accept()
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn: socket.socket):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = bytearray(65536)
+        while True:
+            received = conn.recv_into(buffer)
+            if received == 0:
+                return
+            self.received += received
+            if received <= PING_SIZE:
+                conn.sendall(buffer[:received])
+
+
+def create_relay(dst_port: int, shaper: Optional[Shaper]) -> Relay:
+    relay = Relay(4, 0, 4, dst_port, shaper=shaper)
+    relay.set_destination('127.0.0.1')
+    relay.start()
+    return relay
+
+
+def saturate(port: int, stop: threading.Event):
+    """
+    Sends as fast as possible until stop is set
+    """
+    chunk = b'x' * 65536
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.settimeout(0.2)
+        while not stop.is_set():
+            try:
+                sock.send(chunk)
+            except socket.timeout:
+                pass
+
+
+def cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def ping_latency(port: int, count: int = 500):
+    message = b'p' * PING_SIZE
+    times = []
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for _ in range(count):
+            start = perf_counter()
+            sock.sendall(message)
+            received = 0
+            while received < PING_SIZE:
+                received += len(sock.recv(PING_SIZE))
+            times.append(perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2], times[int(len(times) * 0.99)]
+
+
+def contention(sink_port: int, ping_priority: str):
+    global_bucket = TokenBucket(5 * 1024 * 1024, 512 * 1024, reserve=0.25)
+    bulk = create_relay(sink_port, Shaper(None, global_bucket, Shaper.PRIORITY_BULK))
+    interactive = create_relay(sink_port, Shaper(None, global_bucket, ping_priority))
+
+    stop = threading.Event()
+    thread = threading.Thread(target=saturate, args=(bulk.get_port(), stop))
+    thread.start()
+    p50, p99 = ping_latency(interactive.get_port())
+    stop.set()
+    thread.join()
+    bulk.stop()
+    interactive.stop()
+    return p50, p99
+
+
+def main():
+    sink = CountingSink()
+    sink_port = sink.port
+    print('rate accuracy (%ds per run)' % DURATION)
+    for rate in (None, 1024 * 1024, 10 * 1024 * 1024, 50 * 1024 * 1024):
+        relay_shaper = Shaper(TokenBucket(rate, rate / 10), None, Shaper.PRIORITY_BULK) if rate else None
+        relay = create_relay(sink_port, relay_shaper)
+        stop = threading.Event()
+        threading.Timer(DURATION, stop.set).start()
+        received_start = sink.received
+        cpu_start = cpu_time()
+        start = perf_counter()
+        saturate(relay.get_port(), stop)
+        duration = perf_counter() - start
+        cpu = cpu_time() - cpu_start
+        relay.stop()
+
+        mb = (sink.received - received_start) / 1024 / 1024
+        name = 'unlimited' if rate is None else '%.0f MB/s' % (rate / 1024 / 1024)
+        achieved = mb / duration
+        line = '  %-10s achieved %7.2f MB/s' % (name, achieved)
+        if rate is not None:
+            line += ' (%+.1f%%)' % ((achieved / (rate / 1024 / 1024) - 1) * 100)
+        line += ', cpu %.3f ms/MB' % (cpu * 1000 / mb)
+        print(line)
+
+    print('interactive ping latency while a bulk forward saturates a 5 MB/s global limit')
+    for priority in (Shaper.PRIORITY_BULK, Shaper.PRIORITY_INTERACTIVE):
+        p50, p99 = contention(sink_port, priority)
+        print('  ping forward %-12s p50 %7.2f ms, p99 %7.2f ms' % (priority, p50 * 1000, p99 * 1000))
+
+
+if __name__ == '__main__':
+    main()
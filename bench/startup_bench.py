@@ -0,0 +1,79 @@
+"""
+Measures the time until all tunnels have been started with a slow resolver,
+once without (cold) and once with a filled DNS cache (warm).
+
+Usage: python -m bench.startup_bench [forwards] [resolver delay in s]
+"""
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+from time import perf_counter
+from unittest import mock
+
+from config.Config import Config
+from util.DnsWatcher import DnsWatcher
+from util.Tunnel import Tunnel
+
+
+def create_config(forwards: int, cache_path: str) -> Config:
+    return Config({
+        'dest': 'host.example',
+        'dns': {'cache': cache_path},
+        'forward': [{
+            'prot': 'tcp',
+            'mode': 'relay',
+            'src': {'stack': 4, 'port': 0},
+            'dest': {'stack': 4, 'port': 10000 + i},
+        } for i in range(forwards)],
+    })
+
+
+def measure(forwards: int, delay: float, cache_path: str, result: multiprocessing.Queue):
+    def slow_getaddrinfo(host, port, family=0, *args):
+        time.sleep(delay)
+        return [(family, socket.SOCK_STREAM, 0, '', ('127.0.0.1', 0))]
+
+    config = create_config(forwards, cache_path)
+    with mock.patch('util.DnsWatcher.socket.getaddrinfo', slow_getaddrinfo), \
+            mock.patch('util.Tunnel.Iptables'):
+        start = perf_counter()
+        dns_watcher = DnsWatcher(config.dns)
+        tunnels = [Tunnel(forwarder, config, dns_watcher) for forwarder in config.forwarders]
+        for tunnel in tunnels:
+            tunnel.start()
+        duration = perf_counter() - start
+
+        # Background refresh, fills the cache
+        dns_watcher.check()
+        for tunnel in tunnels:
+            tunnel.stop()
+    result.put(duration)
+
+
+def run(forwards: int, delay: float, cache_path: str) -> float:
+    result = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=measure, args=(forwards, delay, cache_path, result))
+    proc.start()
+    duration = result.get()
+    proc.join()
+    return duration
+
+
+def main():
+    forwards = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_path = os.path.join(tmp_dir, 'dns.json')
+        cold = run(forwards, delay, cache_path)
+        warm = run(forwards, delay, cache_path)
+
+    print('%d forwards, resolver delay %.0f ms' % (forwards, delay * 1000))
+    print('  cold start: %.1f ms' % (cold * 1000))
+    print('  warm start: %.1f ms' % (warm * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Measures the cost of the idle / lifetime reaping of the native relay.
+The timer heap is compared with scanning all connections on every selector round,
+then idle connections of a real relay are reaped.
+
+Usage: python -m bench.timeout_bench
+"""
+import resource
+import socket
+import threading
+from time import perf_counter, sleep
+from typing import List
+
+from util.Relay import Relay, TimerHeap
+
+TIMER_CONNECTIONS = 100000
+ROUNDS = 1000
+EVENTS_PER_ROUND = 100
+RELAY_CONNECTIONS = 2000
+IDLE_TIMEOUT = 1.0
+
+
+class FakeConnection:
+    def __init__(self, active: float):
+        self.active: float = active
+
+
+def heap_rounds() -> float:
+    """
+    Every round a few connections are active and the due entries are checked like in the relay
+    """
+    connections = [FakeConnection(i / TIMER_CONNECTIONS) for i in range(TIMER_CONNECTIONS)]
+    timers = TimerHeap()
+    for conn in connections:
+        timers.push(conn.active + IDLE_TIMEOUT, conn)
+
+    start = perf_counter()
+    for i in range(ROUNDS):
+        now = 1 + i / ROUNDS
+        for j in range(EVENTS_PER_ROUND):
+            connections[(i * EVENTS_PER_ROUND + j * 997) % TIMER_CONNECTIONS].active = now
+        while True:
+            conn = timers.pop_due(now)
+            if conn is None:
+                break
+            # Active connections are pushed again, idle ones would be closed
+            if conn.active + IDLE_TIMEOUT > now:
+                timers.push(conn.active + IDLE_TIMEOUT, conn)
+    return perf_counter() - start
+
+
+def scan_rounds() -> float:
+    connections = [FakeConnection(i / TIMER_CONNECTIONS) for i in range(TIMER_CONNECTIONS)]
+    rounds = ROUNDS // 100
+    start = perf_counter()
+    for i in range(rounds):
+        now = 1 + i / rounds
+        for conn in connections:
+            if conn.active + IDLE_TIMEOUT <= now:
+                conn.active = now
+    return (perf_counter() - start) * 100
+
+
+def start_server() -> socket.socket:
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1024)
+    accepted: List[socket.socket] = []
+
+    def accept():
+        while True:
+            try:
+                accepted.append(server.accept()[0])
+            except OSError:
+                return
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server
+
+
+def reap_idle():
+    server = start_server()
+    relay = Relay(4, 0, 4, server.getsockname()[1], idle_timeout=IDLE_TIMEOUT)
+    relay.set_destination('127.0.0.1')
+    relay.start()
+
+    clients = [socket.create_connection(('127.0.0.1', relay.get_port())) for _ in range(RELAY_CONNECTIONS)]
+    cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = perf_counter()
+    while relay.active_connections() > 0 and perf_counter() - start < 30:
+        sleep(0.01)
+    duration = perf_counter() - start
+    cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (cpu_end.ru_utime - cpu_start.ru_utime) + (cpu_end.ru_stime - cpu_start.ru_stime)
+
+    print('relay (' + str(RELAY_CONNECTIONS) + ' idle connections, ' + str(IDLE_TIMEOUT) + 's timeout)')
+    print('  all closed after:           %.2f s' % duration)
+    print('  cpu while waiting + reaping: %.0f ms' % (cpu * 1000))
+    for client in clients:
+        client.close()
+    relay.stop()
+    server.close()
+
+
+def main():
+    print(str(TIMER_CONNECTIONS) + ' connections, ' + str(EVENTS_PER_ROUND) + ' active per selector round')
+    print('  timer heap per round:       %.1f us' % (heap_rounds() / ROUNDS * 1e6))
+    print('  full scan per round:        %.1f us' % (scan_rounds() / ROUNDS * 1e6))
+    reap_idle()
+
+
+if __name__ == '__main__':
+    main()
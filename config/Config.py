@@ -1,11 +1,20 @@
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 
 class PortConfig:
+    STACK_DUAL = 46
+    """
+    IPv4 and IPv6 on a single IPv6 socket ("stack": "dual", only used for the source)
+    """
+
     def __init__(self, data: Dict[str, any]):
-        self.stack: int = data['stack']
+        stack = data['stack']
+        if stack != 'dual' and stack not in (4, 6):
+            # The internal value of the dual stack is not accepted, only its name
+            raise ValueError('Invalid stack: ' + str(stack))
+        self.stack: int = PortConfig.STACK_DUAL if stack == 'dual' else stack
         """
-        IP stack (4 or 6)
+        IP stack (4, 6 or STACK_DUAL)
         """
 
         self.port: int = data['port']
@@ -13,12 +22,108 @@ class PortConfig:
         Port
         """
 
+        self.host: Optional[str] = data.get('host')
+        """
+        Destination host, overrides the global destination host (only used for the destination)
+        """
+
+        self.bind: Optional[str] = data.get('bind')
+        """
+        Local address the listener is bound to, None for the wildcard address (only used for the source)
+        """
+
+    def get_stacks(self) -> List[int]:
+        """
+        Returns the IP stacks (4 and/or 6) the port is reachable with
+        """
+        if self.stack != PortConfig.STACK_DUAL:
+            return [self.stack]
+        if self._get_mapped_ipv4() is not None:
+            # Bound to an IPv4 mapped address -> Only reachable with IPv4
+            return [4]
+        if self.bind is not None and self.bind != '::':
+            return [6]
+        return [4, 6]
+
+    def get_local_address(self, stack: int) -> Optional[str]:
+        """
+        Returns the local address the port is reachable at with the given stack (4 or 6),
+        None for all local addresses
+        """
+        if self.bind is None or self.bind in ('0.0.0.0', '::'):
+            return None
+        if stack == 4 and self.stack == PortConfig.STACK_DUAL:
+            return self._get_mapped_ipv4()
+        return self.bind
+
+    def _get_mapped_ipv4(self) -> Optional[str]:
+        if self.bind is not None and self.bind.lower().startswith('::ffff:') and '.' in self.bind:
+            return self.bind[7:]
+        return None
+
+    @staticmethod
+    def get_stack_name(stack: int) -> str:
+        return 'dual' if stack == PortConfig.STACK_DUAL else str(stack)
+
+
+class LimitConfig:
+    """
+    Bandwidth limit
+    """
+
+    def __init__(self, data: Dict[str, any]):
+        self.rate: float = data['rate']
+        """
+        Maximum rate in bytes per second (both directions together)
+        """
+
+        self.burst: float = data.get('burst', self.rate)
+        """
+        Maximum number of bytes which can be transferred at once after an idle period
+        """
+
+        self.reserve: float = data.get('reserve', 0.25)
+        """
+        Fraction of the burst reserved for interactive forwards (global limit only)
+        """
+        if self.rate <= 0 or self.burst <= 0:
+            raise ValueError('Invalid limit: rate and burst must be positive')
+        if not 0 <= self.reserve < 1:
+            raise ValueError('Invalid limit: reserve must be at least 0 and less than 1')
+
+
+class RouteConfig:
+    """
+    Destination of a multiplexed forward for one requested host name
+    """
+
+    def __init__(self, data: Dict[str, any]):
+        self.match: str = data['match']
+        """
+        Host name (TLS SNI or HTTP Host header), "*.domain" for all sub domains or "*" for all other connections
+        """
+
+        self.host: str = data['host']
+        """
+        Destination host
+        """
+
+        self.port: Optional[int] = data.get('port')
+        """
+        Destination port, defaults to the port of the forward destination
+        """
+
 
 class ForwardConfig:
     """
     Single forward config
     """
 
+    MODE_SOCAT = 'socat'
+    MODE_DNAT = 'dnat'
+    MODE_RELAY = 'relay'
+    MODE_MUX = 'mux'
+
     def __init__(self, data: Dict[str, any]):
         self.prot: str = data['prot']
         """
@@ -26,13 +131,234 @@ class ForwardConfig:
         """
         self.src = PortConfig(data['src'])
         self.dest = PortConfig(data['dest'])
+        if self.dest.stack == PortConfig.STACK_DUAL:
+            raise ValueError('The destination stack must be 4 or 6')
+
+        self.mode: str = data.get('mode', ForwardConfig.MODE_SOCAT)
+        """
+        How the traffic is forwarded (socat, dnat, relay or mux)
+        """
+        if self.mode not in (ForwardConfig.MODE_SOCAT, ForwardConfig.MODE_DNAT, ForwardConfig.MODE_RELAY,
+                             ForwardConfig.MODE_MUX):
+            raise ValueError('Unknown forward mode: ' + str(self.mode))
+
+        self.routes: List[RouteConfig] = [RouteConfig(route) for route in data.get('routes', [])]
+        """
+        Destinations by requested host name (mux mode only)
+        """
+        if self.mode == ForwardConfig.MODE_MUX:
+            if len(self.routes) == 0:
+                raise ValueError('The mux mode requires at least one route')
+            if self.prot.lower() != 'tcp':
+                raise ValueError('The mux mode only supports tcp')
+
+        self.buffer_size: int = data.get('buffer_size', 16384)
+        """
+        Size of the per connection and direction buffer of the relay in bytes
+        """
+
+        self.limit: Optional[LimitConfig] = None
+        """
+        Bandwidth limit of this forward (native relay only)
+        """
+        if 'limit' in data:
+            self.limit = LimitConfig(data['limit'])
+
+        self.priority: str = data.get('priority', 'bulk')
+        """
+        Priority class (interactive or bulk) when the global bandwidth limit is reached
+        """
+        if self.priority not in ('interactive', 'bulk'):
+            raise ValueError('Unknown priority: ' + str(self.priority))
+
+        self.idle_timeout: float = data.get('idle_timeout', 0)
+        """
+        Seconds without any transferred data after which a connection is closed, 0 to disable
+        """
+
+        self.max_lifetime: float = data.get('max_lifetime', 0)
+        """
+        Seconds after which a connection is closed no matter if it is active (native relay only), 0 to disable
+        """
+        if self.idle_timeout < 0 or self.max_lifetime < 0:
+            raise ValueError('Invalid timeout: idle_timeout and max_lifetime must not be negative')
+
+
+class DnsConfig:
+    """
+    Configuration of the DNS change detection
+    """
+
+    def __init__(self, data: Dict[str, any]):
+        self.confirmations: int = data.get('confirmations', 1)
+        """
+        Number of consecutive checks a changed address set has to be seen before it is accepted
+        """
+
+        self.min_interval: float = data.get('min_interval', 0)
+        """
+        Minimum time in seconds between two accepted changes
+        """
+
+        self.cache: Optional[str] = data.get('cache')
+        """
+        Optional path of the file the last known good addresses are persisted to
+        """
+
+        self.interval: float = data.get('interval', 60)
+        """
+        Time in seconds between two checks
+        """
+
+        self.nameserver: Optional[str] = data.get('nameserver')
+        """
+        Optional nameserver (ip or ip:port) which is queried directly instead of using the system resolver
+        """
+
+
+class HealthCheckConfig:
+    """
+    Configuration of the active upstream health checks
+    """
+
+    def __init__(self, data: Dict[str, any]):
+        self.interval: float = data.get('interval', 10)
+        """
+        Time between two probe rounds in seconds
+        """
+
+        self.timeout: float = data.get('timeout', 2)
+        """
+        Timeout of a single probe in seconds
+        """
+
+        self.rise: int = data.get('rise', 2)
+        """
+        Number of consecutive successful probes until an address is considered healthy again
+        """
+
+        self.fall: int = data.get('fall', 3)
+        """
+        Number of consecutive failed probes until an address is considered unhealthy
+        """
+
+        self.switch_margin: float = data.get('switch_margin', 0.2)
+        """
+        Relative RTT improvement required before switching away from a healthy address
+        """
+
+        self.status_file: Optional[str] = data.get('status_file')
+        """
+        Optional path of a json file the probe results are exported to
+        """
+
+
+class ConnectionLogConfig:
+    """
+    Configuration of the connection record export
+    """
+
+    def __init__(self, data: Dict[str, any]):
+        self.path: str = data['path']
+        """
+        Path of the file the records are written to
+        """
+
+        self.format: str = data.get('format', 'jsonl')
+        """
+        File format (jsonl or binary)
+        """
+        if self.format not in ('jsonl', 'binary'):
+            raise ValueError('Unknown connection log format: ' + str(self.format))
+
+        self.max_size: int = data.get('max_size', 100 * 1024 * 1024)
+        """
+        File size in bytes after which the file is rotated, 0 to disable
+        """
+
+        self.max_age: float = data.get('max_age', 0)
+        """
+        Time in seconds after which the file is rotated, 0 to disable
+        """
+
+        self.keep: int = data.get('keep', 5)
+        """
+        Number of rotated files which are kept
+        """
+
+        self.buffer: int = data.get('buffer', 65536)
+        """
+        Maximum number of buffered records, further records are dropped until the buffer has been written
+        """
+        if self.buffer < 1:
+            raise ValueError('Invalid connection log: buffer must be at least 1')
+
+        self.flush_interval: float = data.get('flush_interval', 1)
+        """
+        Time in seconds between two batch writes
+        """
 
 
 class Config:
     def __init__(self, data: Dict[str, any]):
-        self.dest_addr: str = data['dest']
+        self.dest_addr: Optional[str] = data.get('dest')
+        """
+        Destination host of all forwards which don't define their own host
+        """
+
+        self.fallback_addr: Optional[str] = data.get('fallback')
+        """
+        Secondary destination host which is used if no address of the destination host is healthy
         """
-        Destination host 
+
+        self.dns = DnsConfig(data.get('dns', {}))
+        """
+        DNS change detection configuration
+        """
+
+        self.health_check: Optional[HealthCheckConfig] = None
+        """
+        Health check configuration, None if health checking is disabled
+        """
+        if 'health_check' in data:
+            self.health_check = HealthCheckConfig(data['health_check'])
+
+        self.shutdown_timeout: float = data.get('shutdown_timeout', 30)
+        """
+        Maximum time in seconds open connections are waited for on shutdown
+        """
+
+        self.limit: Optional[LimitConfig] = None
+        """
+        Bandwidth limit shared by all forwards using the native relay
+        """
+        if 'limit' in data:
+            self.limit = LimitConfig(data['limit'])
+
+        self.connection_log: Optional[ConnectionLogConfig] = None
+        """
+        Export of connection records (native relay only), None if disabled
+        """
+        if 'connection_log' in data:
+            self.connection_log = ConnectionLogConfig(data['connection_log'])
+
+        self.handover_socket: Optional[str] = data.get('handover_socket')
+        """
+        Optional unix socket path used to hand the listening sockets over to a new instance
         """
 
         self.forwarders: List[ForwardConfig] = [ForwardConfig(cfg) for cfg in data['forward']]
+        for forwarder in self.forwarders:
+            if forwarder.mode == ForwardConfig.MODE_MUX:
+                # The routes define the destination hosts
+                continue
+            if forwarder.dest.host is None and self.dest_addr is None:
+                raise ValueError('No destination host for forward ' + forwarder.prot + ':' + str(forwarder.src.port))
+
+    def get_dest_addr(self, forwarder: ForwardConfig) -> str:
+        """
+        Returns the destination host of the given forward
+        """
+        if forwarder.dest.host is not None:
+            return forwarder.dest.host
+        return self.dest_addr
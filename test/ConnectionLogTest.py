@@ -0,0 +1,147 @@
+import json
+import os
+import socket
+import tempfile
+from time import sleep
+from unittest import TestCase
+
+from config.Config import ConnectionLogConfig
+from test.RelayTest import EchoServer
+from util.ConnectionLog import ConnectionLog, ConnectionRecord, BinaryFormat
+from util.Relay import Relay
+
+
+class ConnectionLogTest(TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'connections.log')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _config(self, **kwargs) -> ConnectionLogConfig:
+        data = {'path': self.path}
+        data.update(kwargs)
+        return ConnectionLogConfig(data)
+
+    @staticmethod
+    def _record(index: int, client_ip: str = '10.0.0.1') -> ConnectionRecord:
+        return ConnectionRecord('tcp:4:8080', client_ip, 40000 + index, '192.168.0.1', 80,
+                                1000.0 + index, 1001.5 + index, 100 * index, 200 * index)
+
+    def _read_jsonl(self, path: str):
+        with open(path) as file:
+            return [json.loads(line) for line in file]
+
+    def test_jsonl(self):
+        log = ConnectionLog(self._config())
+        log.add(self._record(1))
+        log.add(self._record(2))
+        log.stop()
+
+        records = self._read_jsonl(self.path)
+        self.assertEqual(2, len(records))
+        self.assertEqual('10.0.0.1', records[0]['client'])
+        self.assertEqual(40001, records[0]['client_port'])
+        self.assertEqual('192.168.0.1', records[0]['upstream'])
+        self.assertEqual(1.5, records[0]['duration'])
+        self.assertEqual(400, records[1]['bytes_in'])
+
+    def test_binary(self):
+        log = ConnectionLog(self._config(format='binary'))
+        log.add(self._record(1))
+        log.add(self._record(2, client_ip='2001:db8::1'))
+        log.stop()
+
+        records = list(BinaryFormat.read(self.path))
+        self.assertEqual(2, len(records))
+        self.assertEqual('10.0.0.1', records[0].client_ip)
+        self.assertEqual('2001:db8::1', records[1].client_ip)
+        self.assertEqual('8080', records[1].forward)
+        self.assertEqual(1.5, records[1].get_duration())
+        self.assertEqual(200, records[1].bytes_out)
+
+    def test_binary_invalid(self):
+        log = ConnectionLog(self._config(format='binary'))
+        log.start()
+        log.add(self._record(1, client_ip='fe80::1%eth0'))
+        log.add(self._record(2, client_ip='not an ip'))
+        log.add(self._record(3))
+        log.stop()
+
+        # The scope is stripped, the invalid record is skipped without stopping the writer
+        self.assertEqual(['fe80::1', '10.0.0.1'], [record.client_ip for record in BinaryFormat.read(self.path)])
+        self.assertEqual(1, log.invalid)
+        self.assertEqual(2, log.written)
+
+    def test_drop_when_full(self):
+        log = ConnectionLog(self._config(buffer=4))
+        for i in range(6):
+            log.add(self._record(i))
+        self.assertEqual(2, log.dropped)
+        log.stop()
+
+        # The oldest records are kept
+        self.assertEqual([40000, 40001, 40002, 40003], [r['client_port'] for r in self._read_jsonl(self.path)])
+
+    def test_invalid_buffer(self):
+        for buffer in (0, -1):
+            with self.assertRaises(ValueError):
+                self._config(buffer=buffer)
+
+    def test_wrap_around(self):
+        log = ConnectionLog(self._config(buffer=4))
+        for i in range(3):
+            log.add(self._record(i))
+        log._write_batch()
+        for i in range(3, 6):
+            log.add(self._record(i))
+        log.stop()
+        self.assertEqual(6, len(self._read_jsonl(self.path)))
+        self.assertEqual(0, log.dropped)
+        # Written records are not kept alive by the buffer
+        self.assertEqual([None] * 4, log._ring)
+
+    def test_rotate_by_size(self):
+        log = ConnectionLog(self._config(max_size=1, keep=2))
+        for i in range(4):
+            log.add(self._record(i))
+            log._write_batch()
+        log.stop()
+
+        # Every batch exceeds the size -> one record per file, the oldest one has been deleted
+        self.assertEqual(['connections.log', 'connections.log.1', 'connections.log.2'],
+                         sorted(os.listdir(self._dir.name)))
+        self.assertEqual(40003, self._read_jsonl(self.path)[0]['client_port'])
+        self.assertEqual(40001, self._read_jsonl(self.path + '.2')[0]['client_port'])
+
+    def test_relay_records(self):
+        echo = EchoServer()
+        log = ConnectionLog(self._config(flush_interval=0.05))
+        log.start()
+        relay = Relay(4, 0, 4, echo.port, connection_log=log)
+        relay.set_destination('127.0.0.1')
+        relay.start()
+        port = relay.get_port()
+
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+            client.sendall(b'ping')
+            self.assertEqual(b'ping', client.recv(4))
+        for _ in range(50):
+            if relay.active_connections() == 0:
+                break
+            sleep(0.05)
+        relay.stop()
+        log.stop()
+        echo.close()
+
+        records = self._read_jsonl(self.path)
+        self.assertEqual(1, len(records))
+        self.assertEqual('tcp:4:' + str(port), records[0]['forward'])
+        self.assertEqual('127.0.0.1', records[0]['client'])
+        self.assertEqual('127.0.0.1', records[0]['upstream'])
+        self.assertEqual(echo.port, records[0]['upstream_port'])
+        self.assertEqual(4, records[0]['bytes_out'])
+        self.assertEqual(4, records[0]['bytes_in'])
+        self.assertGreaterEqual(records[0]['duration'], 0)
@@ -0,0 +1,53 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from config.Config import DnsConfig
+from util.DnsCache import DnsCache
+from util.DnsWatcher import EntryWatch
+
+
+class DnsCacheTest(TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'dns.json')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_persist(self):
+        cache = DnsCache(self.path)
+        self.assertIsNone(cache.get('example.com', 4))
+        cache.put('example.com', 4, ['1.1.1.1'])
+        cache.put('example.com', 6, ['::1'])
+
+        cache = DnsCache(self.path)
+        self.assertEqual(['1.1.1.1'], cache.get('example.com', 4))
+        self.assertEqual(['::1'], cache.get('example.com', 6))
+        self.assertEqual(['dns.json'], os.listdir(self._dir.name))
+
+    def test_corrupt(self):
+        with open(self.path, 'w') as file:
+            file.write('{')
+        self.assertIsNone(DnsCache(self.path).get('example.com', 4))
+
+    def test_warm_start(self):
+        DnsCache(self.path).put('example.com', 4, ['1.1.1.1'])
+        changes = []
+        with mock.patch('util.DnsWatcher.socket') as socket_mock:
+            watch = EntryWatch('example.com', 4, DnsConfig({'confirmations': 3}), DnsCache(self.path))
+            watch.add_listener(changes.append)
+
+            # No resolver call on start
+            self.assertEqual('1.1.1.1', watch.resolve())
+            self.assertTrue(watch.is_cached())
+            socket_mock.getaddrinfo.assert_not_called()
+
+            # Outdated cache entries are replaced without waiting for confirmations
+            socket_mock.getaddrinfo.return_value = [(0, 0, 0, '', ('1.1.1.2', 0))]
+            watch.check()
+            self.assertEqual(['1.1.1.2'], changes)
+            self.assertFalse(watch.is_cached())
+
+        self.assertEqual(['1.1.1.2'], DnsCache(self.path).get('example.com', 4))
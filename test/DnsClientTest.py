@@ -0,0 +1,82 @@
+import socket
+import struct
+import threading
+from unittest import TestCase
+
+from util.DnsClient import DnsClient
+
+
+class DnsClientTest(TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.address = '127.0.0.1:' + str(self.server.getsockname()[1])
+
+    def tearDown(self):
+        self.server.close()
+
+    def _answer_once(self, flags: int, answers: bytes, count: int):
+        def serve():
+            query, addr = self.server.recvfrom(512)
+            question = query[12:]
+            header = struct.pack('!HHHHHH', struct.unpack('!H', query[:2])[0], flags, 1, count, 0, 0)
+            self.server.sendto(header + question + answers, addr)
+
+        threading.Thread(target=serve, daemon=True).start()
+
+    def test_parse_address(self):
+        self.assertEqual(('10.0.0.1', 53), DnsClient.parse_address('10.0.0.1'))
+        self.assertEqual(('10.0.0.1', 5353), DnsClient.parse_address('10.0.0.1:5353'))
+        self.assertEqual(('::1', 53), DnsClient.parse_address('::1'))
+        self.assertEqual(('::1', 5353), DnsClient.parse_address('[::1]:5353'))
+
+    def test_resolve(self):
+        # CNAME to a name outside of the question followed by two A records of the target
+        target = b'\x03www\x07example\x03com\x00'
+        answers = struct.pack('!HHHIH', 0xc00c, 5, 1, 60, len(target)) + target
+        answers += struct.pack('!HHHIH', 0xc00c, 1, 1, 60, 4) + socket.inet_aton('10.0.0.1')
+        answers += struct.pack('!HHHIH', 0xc00c, 1, 1, 60, 4) + socket.inet_aton('10.0.0.2')
+        self._answer_once(0x8180, answers, 3)
+
+        ips = DnsClient(self.address).resolve('host.example.com', 4)
+        self.assertEqual(['10.0.0.1', '10.0.0.2'], ips)
+
+    def test_truncated(self):
+        # Answer cut off in the middle of a record
+        answers = struct.pack('!HHHIH', 0xc00c, 1, 1, 60, 4) + socket.inet_aton('10.0.0.1')
+        self._answer_once(0x8180, answers[:8], 1)
+        with self.assertRaises(socket.gaierror):
+            DnsClient(self.address).resolve('host.example.com', 4)
+
+        # Record data shorter than its length
+        self._answer_once(0x8180, answers[:-2], 1)
+        with self.assertRaises(socket.gaierror):
+            DnsClient(self.address).resolve('host.example.com', 4)
+
+        # TC flag -> Only a part of the records
+        self._answer_once(0x8380, answers, 1)
+        with self.assertRaises(socket.gaierror):
+            DnsClient(self.address).resolve('host.example.com', 4)
+
+    def test_other_question(self):
+        # Reply with the id of the query to another name is ignored
+        def serve():
+            query, addr = self.server.recvfrom(512)
+            header = struct.pack('!HHHHHH', struct.unpack('!H', query[:2])[0], 0x8180, 1, 1, 0, 0)
+            question = DnsClient._encode_name('other.example.com') + struct.pack('!HH', DnsClient.TYPE_A, 1)
+            answer = struct.pack('!HHHIH', 0xc00c, 1, 1, 60, 4) + socket.inet_aton('10.0.0.1')
+            self.server.sendto(header + question + answer, addr)
+
+        threading.Thread(target=serve, daemon=True).start()
+        with self.assertRaises(socket.gaierror):
+            DnsClient(self.address, timeout=0.2, retries=0).resolve('host.example.com', 4)
+
+    def test_nxdomain(self):
+        self._answer_once(0x8183, b'', 0)
+        with self.assertRaises(socket.gaierror):
+            DnsClient(self.address).resolve('missing.example.com', 4)
+
+    def test_timeout(self):
+        with self.assertRaises(socket.gaierror):
+            DnsClient(self.address, timeout=0.05, retries=1).resolve('host.example.com', 6)
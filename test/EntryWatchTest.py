@@ -1,30 +1,140 @@
 from unittest import TestCase, mock
 
-from util.DnsWatcher import DnsWatcher
+from config.Config import DnsConfig
+from util.DnsWatcher import DnsWatcher, EntryWatch
+
+
+def _reply(*ips):
+    return [(0, 0, 0, '', (ip, 0)) for ip in ips]
 
 
 class EntryWatchTest(TestCase):
     def test_change(self):
         self._callbacks = 0
 
-        def callback():
+        def callback(ip):
             self._callbacks += 1
 
         with mock.patch('util.DnsWatcher.socket') as socket_mock:
-            socket_mock.getaddrinfo.return_value = [(0, 0, 0, '1.1.1.1', 0)]
+            socket_mock.getaddrinfo.return_value = _reply('1.1.1.1')
 
             watcher = DnsWatcher()
             watcher.add('google.com', 4, callback)
             watcher.check()
-            self.assertEquals(0, self._callbacks)
+            self.assertEqual(0, self._callbacks)
+
+            socket_mock.getaddrinfo.return_value = _reply('1.1.1.1')
+            watcher.check()
+            self.assertEqual(0, self._callbacks)
 
-            socket_mock.getaddrinfo.return_value = [(0, 0, 0, '1.1.1.1', 0)]
+            socket_mock.getaddrinfo.return_value = _reply('1.1.1.2')
             watcher.check()
-            self.assertEquals(0, self._callbacks)
+            self.assertEqual(1, self._callbacks)
+
+            watcher.check()
+            self.assertEqual(1, self._callbacks)
+
+    def test_rotating(self):
+        changes = []
+        with mock.patch('util.DnsWatcher.socket') as socket_mock:
+            watch = EntryWatch('example.com', 4)
+            watch.add_listener(changes.append)
+
+            answers = [('1.1.1.1', '1.1.1.2', '1.1.1.3'),
+                       ('1.1.1.2', '1.1.1.3', '1.1.1.1'),
+                       ('1.1.1.3', '1.1.1.1', '1.1.1.2')]
+            for i in range(30):
+                socket_mock.getaddrinfo.return_value = _reply(*answers[i % len(answers)])
+                watch.check()
+
+            # Same set in a different order is not a change
+            self.assertEqual([], changes)
+            self.assertEqual(['1.1.1.1', '1.1.1.2', '1.1.1.3'], watch.get_ips())
+
+            socket_mock.getaddrinfo.return_value = _reply('1.1.1.3', '1.1.1.4')
+            watch.check()
+            self.assertEqual(['1.1.1.3'], changes)
+
+    def test_confirmations(self):
+        changes = []
+        with mock.patch('util.DnsWatcher.socket') as socket_mock:
+            watch = EntryWatch('example.com', 4, DnsConfig({'confirmations': 3}))
+            watch.add_listener(changes.append)
+
+            socket_mock.getaddrinfo.return_value = _reply('1.1.1.1')
+            watch.check()
+
+            # Flapping answers never get confirmed
+            for i in range(10):
+                socket_mock.getaddrinfo.return_value = _reply('1.1.1.2' if i % 2 == 0 else '1.1.1.1')
+                watch.check()
+            self.assertEqual([], changes)
+
+            socket_mock.getaddrinfo.return_value = _reply('1.1.1.2')
+            watch.check()
+            watch.check()
+            self.assertEqual([], changes)
+            watch.check()
+            self.assertEqual(['1.1.1.2'], changes)
+
+    def test_min_interval(self):
+        changes = []
+        with mock.patch('util.DnsWatcher.socket') as socket_mock, \
+                mock.patch('util.DnsWatcher.monotonic') as time_mock:
+            time_mock.return_value = 1000
+            watch = EntryWatch('example.com', 4, DnsConfig({'min_interval': 60}))
+            watch.add_listener(changes.append)
+
+            socket_mock.getaddrinfo.return_value = _reply('1.1.1.1')
+            watch.check()
+            socket_mock.getaddrinfo.return_value = _reply('1.1.1.2')
+            watch.check()
+            self.assertEqual(['1.1.1.2'], changes)
+
+            socket_mock.getaddrinfo.return_value = _reply('1.1.1.3')
+            time_mock.return_value = 1030
+            watch.check()
+            self.assertEqual(['1.1.1.2'], changes)
+
+            time_mock.return_value = 1061
+            watch.check()
+            self.assertEqual(['1.1.1.2', '1.1.1.3'], changes)
+
+    def test_min_interval_after_boot(self):
+        changes = []
+        with mock.patch('util.DnsWatcher.socket') as socket_mock, \
+                mock.patch('util.DnsWatcher.monotonic') as time_mock:
+            # Host booted a few seconds ago
+            time_mock.return_value = 5
+            watch = EntryWatch('example.com', 4, DnsConfig({'min_interval': 60}))
+            watch.add_listener(changes.append)
+
+            socket_mock.getaddrinfo.return_value = _reply('1.1.1.1')
+            watch.check()
+            socket_mock.getaddrinfo.return_value = _reply('1.1.1.2')
+            watch.check()
+            # The first change is not delayed
+            self.assertEqual(['1.1.1.2'], changes)
+
+    def test_shared_resolution(self):
+        changes = []
+        with mock.patch('util.DnsWatcher.socket') as socket_mock:
+            socket_mock.getaddrinfo.return_value = _reply('1.1.1.1')
+            watcher = DnsWatcher()
+            first = watcher.add('a.example', 4, changes.append)
+            second = watcher.add('a.example', 4, changes.append)
+            other = watcher.add('b.example', 4, changes.append)
+            self.assertIs(first, second)
+            self.assertIsNot(first, other)
 
-            socket_mock.getaddrinfo.return_value = [(0, 0, 0, '1.1.1.2', 0)]
             watcher.check()
-            self.assertEquals(1, self._callbacks)
+            # One lookup per (host, stack)
+            self.assertEqual(2, socket_mock.getaddrinfo.call_count)
 
+            socket_mock.getaddrinfo.return_value = _reply('1.1.1.2')
             watcher.check()
-            self.assertEquals(1, self._callbacks)
+            # Fanned out to both listeners of each host
+            self.assertEqual(['1.1.1.2'] * 3, changes)
+
+            # Entries are not shared between watcher instances
+            self.assertIsNot(first, DnsWatcher().add('a.example', 4, changes.append))
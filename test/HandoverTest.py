@@ -0,0 +1,104 @@
+import os
+import socket
+import tempfile
+import threading
+from time import sleep
+from unittest import TestCase
+
+from test.RelayTest import EchoServer
+from util.Handover import HandoverServer, HandoverClient, ListenerRegistry
+from util.Relay import Relay
+
+
+class HandoverTest(TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'handover.sock')
+        self.echo = EchoServer()
+
+    def tearDown(self):
+        self.echo.close()
+        self._dir.cleanup()
+
+    def _create_relay(self) -> Relay:
+        relay = Relay(4, 0, 4, self.echo.port)
+        relay.set_destination('127.0.0.1')
+        return relay
+
+    def test_no_instance(self):
+        self.assertEqual([], HandoverClient(self.path).receive())
+
+    def test_registry(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('0.0.0.0', 0))
+            sock.listen(1)
+            port = sock.getsockname()[1]
+            registry = ListenerRegistry([sock])
+            self.assertIsNone(registry.take(socket.AF_INET6, port))
+            self.assertIsNone(registry.take(socket.AF_INET, port + 1))
+            self.assertIs(sock, registry.take(socket.AF_INET, port))
+            self.assertEqual(0, len(registry))
+
+    def test_registry_dual(self):
+        with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as v6_only, \
+                socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as dual:
+            v6_only.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            v6_only.bind(('::', 0))
+            v6_only.listen(1)
+            registry = ListenerRegistry([v6_only])
+            # An IPv6 only socket can't serve a dual stack forward
+            self.assertIsNone(registry.take(socket.AF_INET6, v6_only.getsockname()[1], dual=True))
+
+            dual.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            dual.bind(('::', 0))
+            dual.listen(1)
+            registry.add_all([dual])
+            self.assertIs(dual, registry.take(socket.AF_INET6, dual.getsockname()[1], dual=True))
+
+    def test_handover_under_load(self):
+        old_relay = self._create_relay()
+        old_relay.start()
+        port = old_relay.get_port()
+
+        server = HandoverServer(self.path, lambda: [old_relay.get_listener()])
+        server.on_handover += old_relay.stop_accepting
+        server.start()
+
+        results = {'ok': 0, 'refused': 0}
+        running = threading.Event()
+        running.set()
+
+        def load():
+            while running.is_set():
+                try:
+                    with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+                        client.sendall(b'ping')
+                        if client.recv(4) == b'ping':
+                            results['ok'] += 1
+                except ConnectionRefusedError:
+                    results['refused'] += 1
+
+        threads = [threading.Thread(target=load) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        sleep(0.2)
+
+        # New instance takes over while the old one drains
+        registry = ListenerRegistry(HandoverClient(self.path).receive())
+        new_relay = self._create_relay()
+        new_relay.start(registry.take(socket.AF_INET, port))
+        self.assertEqual(port, new_relay.get_port())
+        sleep(0.2)
+        old_relay.stop()
+        served_by_old = results['ok']
+        sleep(0.2)
+
+        running.clear()
+        for thread in threads:
+            thread.join()
+        new_relay.stop()
+
+        self.assertGreater(results['ok'], served_by_old)
+        self.assertEqual(0, results['refused'])
+        self.assertGreater(results['ok'], 0)
@@ -0,0 +1,65 @@
+import socket
+from unittest import TestCase
+
+from config.Config import HealthCheckConfig
+from util.HealthCheck import HealthChecker
+
+
+class HealthCheckTest(TestCase):
+
+    def _create_checker(self, rtts):
+        checker = HealthChecker('test', 'tcp', 80, 4, HealthCheckConfig({'rise': 1, 'fall': 2}))
+
+        def probe(address):
+            rtt = rtts[address]
+            if rtt is None:
+                raise socket.timeout('timed out')
+            return rtt
+
+        checker._probe = probe
+        return checker
+
+    def test_lowest_latency(self):
+        rtts = {'10.0.0.1': 0.050, '10.0.0.2': 0.010}
+        checker = self._create_checker(rtts)
+        checker.set_addresses(['10.0.0.1', '10.0.0.2'], [])
+        checker.probe_all()
+        self.assertEqual('10.0.0.2', checker.get_selected())
+
+    def test_switch_margin(self):
+        rtts = {'10.0.0.1': 0.010, '10.0.0.2': 0.020}
+        checker = self._create_checker(rtts)
+        checker.set_addresses(['10.0.0.1', '10.0.0.2'], [])
+        checker.probe_all()
+        self.assertEqual('10.0.0.1', checker.get_selected())
+
+        # Slightly faster is not enough to switch
+        rtts['10.0.0.2'] = 0.009
+        for _ in range(20):
+            checker.probe_all()
+        self.assertEqual('10.0.0.1', checker.get_selected())
+
+    def test_fallback(self):
+        selections = []
+        rtts = {'10.0.0.1': 0.010, '10.0.1.1': 0.100}
+        checker = self._create_checker(rtts)
+        checker.on_selection_changed += selections.append
+        checker.set_addresses(['10.0.0.1'], ['10.0.1.1'])
+        checker.probe_all()
+        self.assertEqual('10.0.0.1', checker.get_selected())
+
+        rtts['10.0.0.1'] = None
+        checker.probe_all()
+        # Single failure is below the fall threshold
+        self.assertEqual('10.0.0.1', checker.get_selected())
+        checker.probe_all()
+        self.assertEqual('10.0.1.1', checker.get_selected())
+
+        rtts['10.0.0.1'] = 0.010
+        checker.probe_all()
+        self.assertEqual('10.0.0.1', checker.get_selected())
+        self.assertEqual(['10.0.1.1', '10.0.0.1'], selections)
+
+        status = checker.get_status()
+        self.assertEqual('10.0.0.1', status['selected'])
+        self.assertEqual(2, len(status['addresses']))
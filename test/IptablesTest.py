@@ -1,3 +1,4 @@
+import subprocess
 from unittest import TestCase, mock
 from unittest.mock import MagicMock
 
@@ -39,3 +40,137 @@ num  target     prot opt source               destination
             # 1 Process() instance
             calls = len(proc_class_mock.call_args_list)
             self.assertEquals(2, calls)
+
+    def test_dnat_new(self):
+        with mock.patch('util.Iptables.Process') as proc_class_mock:
+            proc_mock = MagicMock()
+            proc_class_mock.return_value = proc_mock
+            proc_mock.get_out_lines.return_value = []
+            iptables = Iptables(4)
+            iptables.set_dnat('tcp', 80, '10.0.0.1', 8080)
+
+            # 3 listings + 1 restore
+            self.assertEqual(4, len(proc_class_mock.call_args_list))
+            self.assertEqual(['iptables-restore', '--noflush'], proc_class_mock.call_args_list[3][0][0])
+            rules = proc_mock.stdin.call_args[0][0].splitlines()
+            self.assertEqual(['*nat',
+                              '-A PREROUTING -p tcp --dport 80 -m addrtype --dst-type LOCAL '
+                              '-m comment --comment dynnat:tcp:80 -j DNAT --to-destination 10.0.0.1:8080',
+                              '-A OUTPUT -p tcp --dport 80 -m addrtype --dst-type LOCAL '
+                              '-m comment --comment dynnat:tcp:80 -j DNAT --to-destination 10.0.0.1:8080',
+                              '-A POSTROUTING -p tcp -d 10.0.0.1 --dport 8080 -m conntrack --ctstate DNAT '
+                              '-m comment --comment dynnat:tcp:80 -j MASQUERADE',
+                              'COMMIT'], rules)
+
+    def test_dnat_replace(self):
+        prerouting = """Chain PREROUTING (policy ACCEPT)
+num  target     prot opt source               destination
+1    DNAT       tcp  --  0.0.0.0/0            0.0.0.0/0            tcp dpt:22 to:10.0.0.5:22
+2    DNAT       tcp  --  0.0.0.0/0            0.0.0.0/0            /* dynnat:tcp:80 */ tcp dpt:80 ADDRTYPE match dst-type LOCAL to:10.0.0.1:8080
+"""
+        output = """Chain OUTPUT (policy ACCEPT)
+num  target     prot opt source               destination
+1    DNAT       tcp  --  0.0.0.0/0            0.0.0.0/0            /* dynnat:tcp:80 */ tcp dpt:80 ADDRTYPE match dst-type LOCAL to:10.0.0.1:8080
+"""
+        postrouting = """Chain POSTROUTING (policy ACCEPT)
+num  target     prot opt source               destination
+1    MASQUERADE  tcp  --  0.0.0.0/0            10.0.0.1             /* dynnat:tcp:80 */ tcp dpt:8080 ctstate DNAT
+"""
+        with mock.patch('util.Iptables.Process') as proc_class_mock:
+            proc_mock = MagicMock()
+            proc_class_mock.return_value = proc_mock
+            proc_mock.get_out_lines.side_effect = [prerouting.splitlines(), output.splitlines(),
+                                                   postrouting.splitlines()]
+            iptables = Iptables(4)
+            iptables.set_dnat('tcp', 80, '10.0.0.2', 8080)
+
+            rules = proc_mock.stdin.call_args[0][0].splitlines()
+            # All rules are rewritten in place within one transaction
+            self.assertEqual('-R PREROUTING 2 -p tcp --dport 80 -m addrtype --dst-type LOCAL '
+                             '-m comment --comment dynnat:tcp:80 -j DNAT --to-destination 10.0.0.2:8080', rules[1])
+            self.assertEqual('-R OUTPUT 1 -p tcp --dport 80 -m addrtype --dst-type LOCAL '
+                             '-m comment --comment dynnat:tcp:80 -j DNAT --to-destination 10.0.0.2:8080', rules[2])
+            self.assertEqual('-R POSTROUTING 1 -p tcp -d 10.0.0.2 --dport 8080 -m conntrack --ctstate DNAT '
+                             '-m comment --comment dynnat:tcp:80 -j MASQUERADE', rules[3])
+            self.assertEqual(5, len(rules))
+
+    def test_dnat_remove(self):
+        prerouting = """1    DNAT       tcp  --  0.0.0.0/0            0.0.0.0/0            /* dynnat:tcp:80 */ tcp dpt:80 to:10.0.0.1:8080
+3    DNAT       tcp  --  0.0.0.0/0            0.0.0.0/0            /* dynnat:tcp:80 */ tcp dpt:80 to:10.0.0.1:8080
+"""
+        output = """2    DNAT       tcp  --  0.0.0.0/0            0.0.0.0/0            /* dynnat:tcp:80 */ tcp dpt:80 to:10.0.0.1:8080
+"""
+        with mock.patch('util.Iptables.Process') as proc_class_mock:
+            proc_mock = MagicMock()
+            proc_class_mock.return_value = proc_mock
+            proc_mock.get_out_lines.side_effect = [prerouting.splitlines(), output.splitlines(), []]
+            iptables = Iptables(4)
+            iptables.remove_dnat('tcp', 80)
+
+            rules = proc_mock.stdin.call_args[0][0].splitlines()
+            self.assertEqual(['*nat', '-D PREROUTING 3', '-D PREROUTING 1', '-D OUTPUT 2', 'COMMIT'], rules)
+
+    def test_add_entries(self):
+        stdout = """1    ACCEPT     tcp  --  0.0.0.0/0            0.0.0.0/0            tcp dpt:80
+"""
+        with mock.patch('util.Iptables.Process') as proc_class_mock:
+            proc_mock = MagicMock()
+            proc_class_mock.return_value = proc_mock
+            proc_mock.get_out_lines.return_value = stdout.splitlines()
+            iptables = Iptables(6)
+            iptables.add_entries([('tcp', 80, None), ('tcp', 443, None), ('udp', 53, None), ('tcp', 443, None)])
+
+            # 1 listing + 1 restore for all ports
+            self.assertEqual(2, len(proc_class_mock.call_args_list))
+            self.assertEqual(['ip6tables-restore', '--noflush'], proc_class_mock.call_args_list[1][0][0])
+            rules = proc_mock.stdin.call_args[0][0].splitlines()
+            self.assertEqual(['*filter',
+                              '-A INPUT -p tcp --dport 443 -j ACCEPT',
+                              '-A INPUT -p udp --dport 53 -j ACCEPT',
+                              'COMMIT'], rules)
+
+    def test_entries_bound(self):
+        stdout = """1    ACCEPT     tcp  --  0.0.0.0/0            0.0.0.0/0            tcp dpt:80
+2    ACCEPT     tcp  --  0.0.0.0/0            192.168.1.2          tcp dpt:443
+"""
+        with mock.patch('util.Iptables.Process') as proc_class_mock:
+            proc_mock = MagicMock()
+            proc_class_mock.return_value = proc_mock
+            proc_mock.get_out_lines.return_value = stdout.splitlines()
+            iptables = Iptables(4)
+            iptables.add_entries([('tcp', 80, '192.168.1.2'), ('tcp', 443, '192.168.1.2'), ('tcp', 443, None)])
+
+            # The rules of all addresses and of a single address are different rules
+            rules = proc_mock.stdin.call_args[0][0].splitlines()
+            self.assertEqual(['*filter',
+                              '-A INPUT -p tcp -d 192.168.1.2 --dport 80 -j ACCEPT',
+                              '-A INPUT -p tcp --dport 443 -j ACCEPT',
+                              'COMMIT'], rules)
+
+    def test_parse_ipv6(self):
+        # No opt column in the listing of ip6tables
+        stdout = """num  target     prot opt source               destination
+1    ACCEPT     tcp      ::/0                 ::/0                 tcp dpt:80
+2    ACCEPT     tcp      ::/0                 2001:db8::1/128      tcp dpt:443
+"""
+        rules = Iptables(6)._parse_table(stdout.splitlines())
+        self.assertEqual([None, '2001:db8::1'], [rule.destination for rule in rules])
+
+    def test_probe(self):
+        with mock.patch('util.Iptables.os.geteuid') as euid_mock, \
+                mock.patch('util.Iptables.shutil.which') as which_mock, \
+                mock.patch('util.Iptables.Process') as proc_class_mock:
+            euid_mock.return_value = 1000
+            self.assertEqual('not running as root', Iptables(4).probe())
+
+            euid_mock.return_value = 0
+            which_mock.side_effect = lambda name: None if name == 'ip6tables-restore' else '/sbin/' + name
+            self.assertIsNone(Iptables(4).probe())
+            self.assertEqual('ip6tables-restore not found', Iptables(6).probe())
+
+            # A single listing of the nat table
+            proc_class_mock.assert_called_once_with(['iptables', '-t', 'nat', '-S'])
+
+            # No nat table (e.g. missing kernel module)
+            proc_class_mock.return_value.run.side_effect = subprocess.SubprocessError()
+            self.assertEqual('the nat table is not available', Iptables(4).probe())
@@ -0,0 +1,140 @@
+import socket
+import ssl
+import threading
+from unittest import TestCase
+
+from config.Config import RouteConfig
+from util.Mux import HostPeek, MuxRouter
+from util.Relay import Relay
+
+
+def client_hello(server_name: str) -> bytes:
+    """
+    Returns the ClientHello a TLS client sends for the server name
+    """
+    context = ssl.create_default_context()
+    incoming = ssl.MemoryBIO()
+    outgoing = ssl.MemoryBIO()
+    tls = context.wrap_bio(incoming, outgoing, server_hostname=server_name)
+    try:
+        tls.do_handshake()
+    except ssl.SSLWantReadError:
+        pass
+    return outgoing.read()
+
+
+class NamedServer:
+    """
+    Tcp server which answers every connection with its name followed by the received data
+    """
+
+    def __init__(self, name: bytes):
+        self.name = name
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        self.sock.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn: socket.socket):
+        with conn:
+            conn.sendall(self.name + b':')
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                conn.sendall(data)
+
+
+class MuxTest(TestCase):
+
+    def test_peek_tls(self):
+        hello = client_hello('Git.Example.com')
+        self.assertEqual((True, 'git.example.com'), HostPeek.parse(hello))
+        # Incomplete records need more data
+        self.assertEqual((False, None), HostPeek.parse(hello[:3]))
+        self.assertEqual((False, None), HostPeek.parse(hello[:len(hello) - 1]))
+
+    def test_peek_http(self):
+        request = b'GET / HTTP/1.1\r\nUser-Agent: test\r\nHost: www.example.com:8080\r\n\r\n'
+        self.assertEqual((True, 'www.example.com'), HostPeek.parse(request))
+        self.assertEqual((False, None), HostPeek.parse(request[:20]))
+        self.assertEqual((False, None), HostPeek.parse(b'GE'))
+        self.assertEqual((True, '::1'), HostPeek.parse(b'GET / HTTP/1.1\r\nHost: [::1]:80\r\n\r\n'))
+        self.assertEqual((True, None), HostPeek.parse(b'GET / HTTP/1.0\r\n\r\n'))
+
+    def test_peek_unknown(self):
+        self.assertEqual((True, None), HostPeek.parse(b'SSH-2.0-OpenSSH_9.0\r\n'))
+
+    def test_router_match(self):
+        router = MuxRouter([RouteConfig({'match': 'git.example.com', 'host': 'a'}),
+                            RouteConfig({'match': '*.example.com', 'host': 'b', 'port': 8443}),
+                            RouteConfig({'match': '*.dev.example.com', 'host': 'c'}),
+                            RouteConfig({'match': '*', 'host': 'd'})], 443)
+        self.assertEqual('git.example.com', router.match('git.example.com'))
+        self.assertEqual('*.example.com', router.match('www.example.com'))
+        self.assertEqual('*.dev.example.com', router.match('api.dev.example.com'))
+        self.assertEqual('*', router.match('example.com'))
+        self.assertEqual('*', router.match(None))
+
+        # Unresolved destinations have no route
+        self.assertIsNone(router.select('www.example.com'))
+        router.set_address('*.example.com', '10.0.0.1')
+        self.assertEqual(('10.0.0.1', 8443), router.select('www.example.com'))
+        router.set_address('*.example.com', None)
+        self.assertIsNone(router.select('www.example.com'))
+
+    def test_router_no_default(self):
+        router = MuxRouter([RouteConfig({'match': 'git.example.com', 'host': 'a'})], 443)
+        self.assertIsNone(router.match('www.example.com'))
+        self.assertIsNone(router.match(None))
+
+    def test_relay(self):
+        git = NamedServer(b'git')
+        web = NamedServer(b'web')
+        router = MuxRouter([RouteConfig({'match': 'git.example.com', 'host': 'git', 'port': git.port}),
+                            RouteConfig({'match': '*.example.com', 'host': 'web', 'port': web.port})], 0)
+        router.set_address('git.example.com', '127.0.0.1')
+        router.set_address('*.example.com', '127.0.0.1')
+        relay = Relay(4, 0, 4, 0, buffer_size=1024, router=router)
+        relay.start()
+        try:
+            hello = client_hello('git.example.com')
+            request = b'GET / HTTP/1.1\r\nHost: www.example.com\r\n\r\n'
+            for payload, name in ((hello, b'git'), (request, b'web')):
+                with socket.create_connection(('127.0.0.1', relay.get_port()), timeout=5) as sock:
+                    # Sent in two parts, the relay has to wait for the rest
+                    sock.sendall(payload[:10])
+                    sock.sendall(payload[10:])
+                    expected = name + b':' + payload
+                    self.assertEqual(expected, self._recv_exactly(sock, len(expected)))
+
+            # No matching route -> closed
+            with socket.create_connection(('127.0.0.1', relay.get_port()), timeout=5) as sock:
+                sock.sendall(b'GET / HTTP/1.1\r\nHost: other.org\r\n\r\n')
+                self.assertEqual(b'', sock.recv(16))
+        finally:
+            relay.stop()
+            git.close()
+            web.close()
+
+    @staticmethod
+    def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
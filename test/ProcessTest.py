@@ -1,6 +1,7 @@
 import os
+import subprocess
 import threading
-from time import sleep
+from time import sleep, perf_counter
 from unittest import TestCase
 
 from util.Process import Process
@@ -17,3 +18,69 @@ class ProcessTest(TestCase):
         threading.Thread(target=proc.run).start()
         sleep(1)
         proc.stop()
+
+    def test_timeout(self):
+        proc = Process(['bash', '-c', 'sleep 100'])
+        proc.set_timeout(0.5)
+        start = perf_counter()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            proc.run()
+        self.assertLess(perf_counter() - start, 5)
+
+    def test_timeout_open_pipe(self):
+        # The grandchild keeps stdout open after bash has been terminated
+        proc = Process(['bash', '-c', 'sleep 3 & sleep 100'])
+        proc.set_timeout(0.5, kill_after=0.5)
+        start = perf_counter()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            proc.run()
+        self.assertLess(perf_counter() - start, 2.5)
+
+    def test_async_timeout_kill(self):
+        # Ignores SIGTERM -> has to be killed
+        proc = Process(['bash', '-c', 'trap "" TERM; sleep 100'])
+        proc.set_timeout(0.5, kill_after=0.5)
+        start = perf_counter()
+        results = Process.run_all([proc])
+        self.assertIsInstance(results[0], subprocess.TimeoutExpired)
+        self.assertLess(perf_counter() - start, 5)
+
+    def test_async_output(self):
+        proc = Process(['bash', '-c', 'cat; echo err >&2; exit 3'])
+        proc.collect_output()
+        proc.hide_output()
+        proc.ignore_errors()
+        proc.stdin('hello')
+        self.assertEqual([3], Process.run_all([proc]))
+        self.assertEqual(['hello'], proc.get_out_lines())
+        self.assertEqual(['err'], proc.get_std_err_lines())
+
+        failing = Process(['bash', '-c', 'exit 1'])
+        failing.hide_output()
+        self.assertIsInstance(Process.run_all([failing])[0], subprocess.SubprocessError)
+
+    def test_run_all_limit(self):
+        def create():
+            proc = Process(['sleep', '0.3'])
+            proc.hide_output()
+            return proc
+
+        start = perf_counter()
+        self.assertEqual([0] * 4, Process.run_all([create() for _ in range(4)], limit=4))
+        parallel = perf_counter() - start
+
+        start = perf_counter()
+        Process.run_all([create() for _ in range(4)], limit=2)
+        limited = perf_counter() - start
+
+        self.assertLess(parallel, 1.0)
+        self.assertGreater(limited, 0.55)
+
+    def test_environment(self):
+        proc = Process(['bash', '-c', 'echo $DYN_NAT_TEST'])
+        proc.collect_output()
+        proc.hide_output()
+        proc.set_environment({'DYN_NAT_TEST': 'value'})
+        proc.run()
+        self.assertEqual(['value'], proc.get_out_lines())
+        self.assertNotIn('DYN_NAT_TEST', os.environ)
@@ -0,0 +1,235 @@
+import socket
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from config.Config import PortConfig
+from util.Relay import Relay, BufferPool, TimerHeap, Connection
+
+
+class EchoServer:
+    """
+    Simple threaded tcp echo server
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        self.sock.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._echo, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def _echo(conn: socket.socket):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                conn.sendall(data)
+
+
+class RelayTest(TestCase):
+
+    def setUp(self):
+        self.echo = EchoServer()
+        self.relay = Relay(4, 0, 4, self.echo.port, buffer_size=1024)
+        self.relay.set_destination('127.0.0.1')
+        self.relay.start()
+
+    def tearDown(self):
+        self.relay.stop()
+        self.echo.close()
+
+    def _connect(self) -> socket.socket:
+        sock = socket.create_connection(('127.0.0.1', self.relay.get_port()), timeout=5)
+        return sock
+
+    @staticmethod
+    def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_echo(self):
+        with self._connect() as sock:
+            sock.sendall(b'hello')
+            self.assertEqual(b'hello', self._recv_exactly(sock, 5))
+
+    def test_large_transfer(self):
+        # Much larger than the relay buffer, forces partial sends
+        payload = bytes(range(256)) * 4096
+        with self._connect() as sock:
+            threading.Thread(target=sock.sendall, args=(payload,), daemon=True).start()
+            self.assertEqual(payload, self._recv_exactly(sock, len(payload)))
+
+    def test_stop_accepting(self):
+        with self._connect() as sock:
+            sock.sendall(b'a')
+            self.assertEqual(b'a', self._recv_exactly(sock, 1))
+            port = self.relay.get_port()
+            self.relay.stop_accepting()
+
+            # Open connections keep working
+            sock.sendall(b'b')
+            self.assertEqual(b'b', self._recv_exactly(sock, 1))
+            self.assertEqual(1, self.relay.active_connections())
+
+            with self.assertRaises(ConnectionRefusedError):
+                socket.create_connection(('127.0.0.1', port), timeout=5)
+
+            self.assertEqual(1, self.relay.kill_connections())
+
+    def test_buffer_pool(self):
+        pool = BufferPool(16, grow_count=2)
+        buffers = [pool.acquire() for _ in range(3)]
+        self.assertEqual(4, pool.get_allocated())
+        for buffer in buffers:
+            self.assertEqual(16, len(buffer))
+            pool.release(buffer)
+        pool.acquire()
+        self.assertEqual(4, pool.get_allocated())
+
+    def test_dual_stack(self):
+        relay = Relay(PortConfig.STACK_DUAL, 0, 4, self.echo.port)
+        relay.set_destination('127.0.0.1')
+        relay.start()
+        try:
+            # One socket serves IPv4 and IPv6 clients
+            for address in ('127.0.0.1', '::1'):
+                with socket.create_connection((address, relay.get_port()), timeout=5) as sock:
+                    sock.sendall(b'hello')
+                    self.assertEqual(b'hello', self._recv_exactly(sock, 5))
+        finally:
+            relay.stop()
+
+    def test_bind_address(self):
+        relay = Relay(6, 0, 4, self.echo.port, bind_address='::1')
+        relay.set_destination('127.0.0.1')
+        relay.start()
+        try:
+            self.assertEqual('::1', relay.get_listener().getsockname()[0])
+            with socket.create_connection(('::1', relay.get_port()), timeout=5) as sock:
+                sock.sendall(b'hello')
+                self.assertEqual(b'hello', self._recv_exactly(sock, 5))
+        finally:
+            relay.stop()
+
+    def test_half_close(self):
+        # Server which answers once the client has finished sending
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+
+        def serve():
+            conn, _ = server.accept()
+            with conn:
+                request = b''
+                while True:
+                    data = conn.recv(1024)
+                    if not data:
+                        break
+                    request += data
+                conn.sendall(b'reply:' + request)
+
+        threading.Thread(target=serve, daemon=True).start()
+        relay = Relay(4, 0, 4, server.getsockname()[1])
+        relay.set_destination('127.0.0.1')
+        relay.start()
+        try:
+            with socket.create_connection(('127.0.0.1', relay.get_port()), timeout=5) as sock:
+                sock.sendall(b'request')
+                sock.shutdown(socket.SHUT_WR)
+                self.assertEqual(b'reply:request', self._recv_exactly(sock, 100))
+            self._wait_for_connections(relay, 0)
+        finally:
+            relay.stop()
+            server.close()
+
+    def test_idle_timeout(self):
+        relay = Relay(4, 0, 4, self.echo.port, idle_timeout=0.3)
+        relay.set_destination('127.0.0.1')
+        relay.start()
+        try:
+            with socket.create_connection(('127.0.0.1', relay.get_port()), timeout=5) as sock:
+                # Activity keeps the connection open
+                for _ in range(5):
+                    sock.sendall(b'a')
+                    self.assertEqual(b'a', self._recv_exactly(sock, 1))
+                    time.sleep(0.1)
+                self.assertEqual(1, relay.active_connections())
+
+                started = time.monotonic()
+                self.assertEqual(b'', sock.recv(1))
+                self.assertLess(time.monotonic() - started, 2)
+        finally:
+            relay.stop()
+
+    def test_max_lifetime(self):
+        relay = Relay(4, 0, 4, self.echo.port, idle_timeout=10, max_lifetime=0.3)
+        relay.set_destination('127.0.0.1')
+        relay.start()
+        try:
+            with socket.create_connection(('127.0.0.1', relay.get_port()), timeout=5) as sock:
+                started = time.monotonic()
+                # Closed even though it is active
+                while time.monotonic() - started < 2:
+                    try:
+                        sock.sendall(b'a')
+                        if self._recv_exactly(sock, 1) == b'':
+                            break
+                    except ConnectionError:
+                        break
+                    time.sleep(0.05)
+                self.assertLess(time.monotonic() - started, 2)
+                self._wait_for_connections(relay, 0)
+        finally:
+            relay.stop()
+
+    def test_closed_in_same_round(self):
+        # A connection closed by an earlier event of the same select call still has pending events,
+        # its sockets are closed (and the fd may already be reused) -> The events must be ignored
+        relay = Relay(4, 0, 4, self.echo.port)
+        client = MagicMock()
+        conn = Connection(client, ('127.0.0.1', 1234), BufferPool(16), 0)
+        conn.set_upstream(MagicMock(), '127.0.0.1', self.echo.port)
+        relay._handle(conn, client, 1)
+        client.recv_into.assert_not_called()
+        client.close.assert_not_called()
+
+    def test_timer_heap(self):
+        timers = TimerHeap()
+        self.assertIsNone(timers.next_due())
+        for due, item in ((3, 'c'), (1, 'a'), (2, 'b'), (1, 'd')):
+            timers.push(due, item)
+        self.assertEqual(1, timers.next_due())
+        self.assertEqual('a', timers.pop_due(1.5))
+        self.assertEqual('d', timers.pop_due(1.5))
+        self.assertIsNone(timers.pop_due(1.5))
+
+        timers.retain({'c'})
+        self.assertEqual(1, len(timers))
+        self.assertEqual('c', timers.pop_due(3))
+
+    def _wait_for_connections(self, relay: Relay, count: int):
+        for _ in range(100):
+            if relay.active_connections() == count:
+                break
+            time.sleep(0.01)
+        self.assertEqual(count, relay.active_connections())
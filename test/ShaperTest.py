@@ -0,0 +1,81 @@
+import socket
+import threading
+from time import perf_counter
+from unittest import TestCase, mock
+
+from config.Config import LimitConfig
+from test.RelayTest import EchoServer
+from util.Relay import Relay
+from util.Shaper import TokenBucket, Shaper
+
+
+class ShaperTest(TestCase):
+
+    def test_bucket(self):
+        with mock.patch('util.Shaper.monotonic') as time_mock:
+            time_mock.return_value = 100
+            bucket = TokenBucket(1000, 500)
+            self.assertEqual(500, bucket.available())
+            bucket.consume(500)
+            self.assertEqual(0, bucket.available())
+            self.assertAlmostEqual(0.2, bucket.delay(200))
+
+            time_mock.return_value = 100.25
+            self.assertEqual(250, bucket.available())
+
+            # Never more than the burst
+            time_mock.return_value = 200
+            self.assertEqual(500, bucket.available())
+
+    def test_reserve(self):
+        with mock.patch('util.Shaper.monotonic') as time_mock:
+            time_mock.return_value = 100
+            bucket = TokenBucket(1000, 1000, reserve=0.5)
+            interactive = Shaper(None, bucket, Shaper.PRIORITY_INTERACTIVE)
+            bulk = Shaper(None, bucket, Shaper.PRIORITY_BULK)
+
+            self.assertEqual(500, bulk.allowance())
+            bulk.consume(500)
+            # Bulk traffic can't use the reserve, interactive traffic can
+            self.assertEqual(0, bulk.allowance())
+            self.assertEqual(500, interactive.allowance())
+
+    def test_reserve_limits(self):
+        for reserve in (-0.1, 1, 2):
+            with self.assertRaises(ValueError):
+                LimitConfig({'rate': 1000, 'reserve': reserve})
+        # Bulk reads never shrink to 0 bytes, which would look like the end of the stream
+        self.assertEqual(1, Shaper(None, TokenBucket(1000, 1000, reserve=0.9999), Shaper.PRIORITY_BULK).min_chunk)
+
+    def test_combined(self):
+        with mock.patch('util.Shaper.monotonic') as time_mock:
+            time_mock.return_value = 100
+            shaper = Shaper(TokenBucket(1000, 100), TokenBucket(1000, 10000), Shaper.PRIORITY_BULK)
+            self.assertEqual(100, shaper.allowance())
+            self.assertEqual(100, shaper.min_chunk)
+            shaper.consume(100)
+            self.assertAlmostEqual(0.1, shaper.delay())
+
+    def test_relay_rate(self):
+        echo = EchoServer()
+        rate = 2 * 1024 * 1024
+        shaper = Shaper(TokenBucket(rate, 64 * 1024), None, Shaper.PRIORITY_BULK)
+        relay = Relay(4, 0, 4, echo.port, shaper=shaper)
+        relay.set_destination('127.0.0.1')
+        relay.start()
+
+        # Echo doubles the relayed bytes
+        payload = b'x' * (512 * 1024)
+        start = perf_counter()
+        with socket.create_connection(('127.0.0.1', relay.get_port()), timeout=10) as sock:
+            threading.Thread(target=sock.sendall, args=(payload,), daemon=True).start()
+            received = 0
+            while received < len(payload):
+                received += len(sock.recv(65536))
+        duration = perf_counter() - start
+        relay.stop()
+        echo.close()
+
+        expected = (2 * len(payload) - 64 * 1024) / rate
+        self.assertGreater(duration, expected * 0.8)
+        self.assertLess(duration, expected * 1.5)
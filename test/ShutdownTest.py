@@ -0,0 +1,116 @@
+import os
+import stat
+import tempfile
+import threading
+from time import sleep
+from unittest import TestCase, mock
+from unittest.mock import MagicMock
+
+from config.Config import Config, PortConfig
+from util.Process import Process
+from util.Shutdown import GracefulShutdown
+from util.Tunnel import Tunnel
+
+
+class ShutdownTest(TestCase):
+
+    @staticmethod
+    def _create_tunnel(stack: int, port: int, connections: list):
+        tunnel = MagicMock()
+        tunnel.get_stacks.return_value = [4, 6] if stack == PortConfig.STACK_DUAL else [stack]
+        tunnel.get_firewall_entry.return_value = ('tcp', port, None)
+        tunnel.active_connections.side_effect = lambda: len(connections)
+        tunnel.kill_connections.side_effect = lambda: len(connections)
+        return tunnel
+
+    def test_drain(self):
+        connections = [1]
+        tunnel4 = self._create_tunnel(4, 80, connections)
+        tunnel6 = self._create_tunnel(6, 80, [])
+        tunnel4b = self._create_tunnel(4, 443, [])
+        tunnel_dual = self._create_tunnel(PortConfig.STACK_DUAL, 8080, [])
+
+        # Connection finishes during the drain phase
+        threading.Timer(0.3, connections.clear).start()
+
+        with mock.patch('util.Shutdown.Iptables') as iptables_mock:
+            GracefulShutdown([tunnel4, tunnel6, tunnel4b, tunnel_dual], 10).run()
+
+            # One batch per stack
+            self.assertEqual(2, len(iptables_mock.get.call_args_list))
+            iptables_mock.get.return_value.remove_entries.assert_any_call([('tcp', 80, None), ('tcp', 443, None),
+                                                                           ('tcp', 8080, None)])
+            iptables_mock.get.return_value.remove_entries.assert_any_call([('tcp', 80, None), ('tcp', 8080, None)])
+
+        tunnel4.stop_accepting.assert_called_once()
+        tunnel4.stop.assert_called_once_with(remove_firewall=False)
+
+    def test_deadline(self):
+        connections = [1, 2]
+        tunnel = self._create_tunnel(4, 80, connections)
+        shutdown = GracefulShutdown([tunnel], 0.3)
+        with mock.patch('util.Shutdown.Iptables'):
+            shutdown.run()
+
+        tunnel.kill_connections.assert_called_once()
+
+    def test_force(self):
+        tunnel = self._create_tunnel(4, 80, [1])
+        shutdown = GracefulShutdown([tunnel], 60)
+        threading.Timer(0.2, shutdown.force).start()
+        with mock.patch('util.Shutdown.Iptables'):
+            shutdown.run(remove_firewall=False)
+
+        tunnel.kill_connections.assert_called_once()
+        tunnel.get_firewall_entry.assert_not_called()
+
+    def test_drain_socat(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # Fake socat which forks two connection processes
+            pid_file = os.path.join(directory, 'pids')
+            socat = os.path.join(directory, 'socat')
+            with open(socat, 'w') as file:
+                file.write('#!/bin/bash\nfor i in 1 2; do sleep 100 & echo $! >> "$DYN_NAT_PIDS"; done\nwait\n')
+            os.chmod(socat, os.stat(socat).st_mode | stat.S_IEXEC)
+
+            config = Config({'dest': 'example.com', 'forward': [
+                {'prot': 'tcp', 'src': {'stack': 4, 'port': 80}, 'dest': {'stack': 4, 'port': 8080}}]})
+            dns_watcher = MagicMock()
+            dns_watcher.add.return_value.resolve.return_value = '10.0.0.1'
+            environment = {'PATH': directory + os.pathsep + os.environ['PATH'], 'DYN_NAT_PIDS': pid_file}
+            with mock.patch.dict(os.environ, environment), mock.patch('util.Tunnel.Iptables'), \
+                    mock.patch('util.Shutdown.Iptables'):
+                tunnel = Tunnel(config.forwarders[0], config, dns_watcher)
+                tunnel.start()
+                pids = self._wait_for_pids(pid_file, 2)
+                socat_pid = tunnel._forwarder._proc.get_pid()
+
+                draining = []
+                threading.Timer(0.1, lambda: draining.append(tunnel.active_connections())).start()
+                GracefulShutdown([tunnel], 0.3).run()
+
+            # The listening process is gone right away, the connections are kept until the deadline has passed
+            self.assertEqual([2], draining)
+            # The processes are only signalled, they exit shortly after
+            for pid in [socat_pid] + pids:
+                self.assertTrue(self._wait_for_exit(pid), 'Process ' + str(pid) + ' is still running')
+            self.assertEqual(0, tunnel.active_connections())
+
+    @staticmethod
+    def _wait_for_pids(path: str, count: int) -> list:
+        for _ in range(500):
+            if os.path.exists(path):
+                with open(path) as file:
+                    pids = [int(line) for line in file.read().split()]
+                if len(pids) == count:
+                    return pids
+            sleep(0.01)
+        raise AssertionError('Fake socat did not start')
+
+    @staticmethod
+    def _wait_for_exit(pid: int) -> bool:
+        for _ in range(500):
+            if not Process.is_alive(pid):
+                return True
+            sleep(0.01)
+        return False
@@ -0,0 +1,62 @@
+import os
+import stat
+import tempfile
+from time import sleep
+from unittest import TestCase, mock
+
+from config.Config import PortConfig
+from util.Socat import Socat, SocatBuilder
+
+
+class SocatTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.starts = os.path.join(self.directory.name, 'starts')
+        # Fake socat which fails on its first start (port still in use) and keeps running afterwards
+        socat = os.path.join(self.directory.name, 'socat')
+        with open(socat, 'w') as file:
+            file.write('#!/bin/bash\necho "$@" >> "$DYN_NAT_STARTS"\n'
+                       '[ $(wc -l < "$DYN_NAT_STARTS") -eq 1 ] && exit 1\nexec sleep 100\n')
+        os.chmod(socat, os.stat(socat).st_mode | stat.S_IEXEC)
+        self.environment = mock.patch.dict(os.environ, {
+            'PATH': self.directory.name + os.pathsep + os.environ['PATH'], 'DYN_NAT_STARTS': self.starts})
+        self.environment.start()
+
+    def tearDown(self):
+        self.environment.stop()
+        self.directory.cleanup()
+
+    def _get_starts(self) -> list:
+        if not os.path.exists(self.starts):
+            return []
+        with open(self.starts) as file:
+            return file.read().splitlines()
+
+    def _wait_for_starts(self, count: int):
+        for _ in range(500):
+            if len(self._get_starts()) >= count:
+                return
+            sleep(0.01)
+
+    def test_args(self):
+        socat = SocatBuilder().protocol('tcp').from_address(80, PortConfig.STACK_DUAL, '::1') \
+            .to_address('10.0.0.1', 8080, 4).timeout(300).build()
+        with mock.patch.object(Socat, 'RESTART_DELAY', 0.05):
+            socat.start()
+            self._wait_for_starts(1)
+            socat.stop()
+        self.assertEqual('-T 300 TCP6-LISTEN:80,fork,su=nobody,ipv6only=0,bind=[::1] TCP4:10.0.0.1:8080',
+                         self._get_starts()[0])
+
+    def test_restart(self):
+        socat = SocatBuilder().protocol('tcp').from_address(80).to_address('10.0.0.1', 8080, 4).build()
+        with mock.patch.object(Socat, 'RESTART_DELAY', 0.05):
+            socat.start()
+            # Restarted after the first attempt failed
+            self._wait_for_starts(2)
+            self.assertEqual(2, len(self._get_starts()))
+            socat.stop()
+            sleep(0.2)
+        # Not restarted once stopped
+        self.assertEqual(2, len(self._get_starts()))
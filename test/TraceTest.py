@@ -0,0 +1,113 @@
+import json
+import os
+import tempfile
+import threading
+from time import sleep
+from unittest import TestCase
+
+from util.Trace import Trace, StackSampler, TraceSession
+
+
+class TraceTest(TestCase):
+
+    def tearDown(self):
+        Trace.stop()
+
+    @staticmethod
+    @Trace.traced('test')
+    def _traced(value: int) -> int:
+        return value * 2
+
+    def test_disabled(self):
+        Trace.start()
+        Trace.stop()
+        self.assertEqual(4, self._traced(2))
+        with Trace.span('block', 'test'):
+            pass
+        self.assertEqual([], Trace.get_events())
+
+    def test_spans(self):
+        Trace.start()
+        self.assertEqual(4, self._traced(2))
+        with Trace.span('block', 'test', {'port': 80}):
+            pass
+
+        events = Trace.get_events()
+        self.assertEqual(2, len(events))
+        self.assertEqual('TraceTest._traced', events[0][1])
+        self.assertEqual('test', events[0][2])
+        self.assertEqual({'port': 80}, events[1][6])
+
+    def test_ring_buffer(self):
+        Trace.start(capacity=4)
+        for i in range(10):
+            Trace.add('span' + str(i), 'test', 0, 0)
+        # Only the newest spans are kept
+        self.assertEqual(['span6', 'span7', 'span8', 'span9'], [event[1] for event in Trace.get_events()])
+
+    def test_chrome_trace(self):
+        Trace.start()
+        with Trace.span('block', 'test'):
+            pass
+        trace = Trace.to_chrome_trace()
+        spans = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+        self.assertEqual(1, len(spans))
+        self.assertEqual('block', spans[0]['name'])
+        self.assertEqual(threading.get_ident(), spans[0]['tid'])
+        self.assertGreaterEqual(spans[0]['dur'], 0)
+        # Thread names for the viewer
+        self.assertIn(threading.current_thread().name,
+                      [event['args']['name'] for event in trace['traceEvents'] if event['ph'] == 'M'])
+
+    def test_sampler(self):
+        running = threading.Event()
+        running.set()
+
+        def busy_loop():
+            while running.is_set():
+                sum(range(1000))
+
+        thread = threading.Thread(target=busy_loop)
+        thread.start()
+        sampler = StackSampler()
+        for _ in range(20):
+            sampler.sample(threading.get_ident())
+        running.clear()
+        thread.join()
+
+        stacks = sampler.get_stacks()
+        self.assertEqual(20, sampler.samples)
+        self.assertTrue(any(stack.endswith('TraceTest.py:busy_loop') for stack in stacks))
+
+    def test_session(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trace.json')
+            session = TraceSession(path)
+            session.toggle()
+            self.assertTrue(Trace.enabled)
+            self._traced(1)
+            session.toggle()
+            self.assertFalse(Trace.enabled)
+
+            with open(path) as file:
+                self.assertIn('TraceTest._traced', [event['name'] for event in json.load(file)['traceEvents']])
+            self.assertTrue(os.path.isfile(path + '.stacks'))
+
+    def test_request_toggle(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trace.json')
+            session = TraceSession(path)
+            session.handle_toggle_requests()
+
+            session.request_toggle()
+            self._wait_for(session.is_running)
+            session.request_toggle()
+            self._wait_for(lambda: not session.is_running())
+            self.assertTrue(os.path.isfile(path))
+
+    @staticmethod
+    def _wait_for(condition):
+        for _ in range(500):
+            if condition():
+                return
+            sleep(0.01)
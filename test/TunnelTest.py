@@ -0,0 +1,87 @@
+import json
+import os
+import subprocess
+import tempfile
+from unittest import TestCase, mock
+from unittest.mock import MagicMock
+
+from config.Config import Config, PortConfig
+from util.HealthCheck import StatusExporter
+from util.Tunnel import Tunnel
+
+
+class TunnelTest(TestCase):
+
+    @staticmethod
+    def _create_config(mode: str) -> Config:
+        return Config({'dest': 'example.com', 'forward': [
+            {'prot': 'tcp', 'mode': mode, 'src': {'stack': 4, 'port': 80}, 'dest': {'stack': 4, 'port': 8080}}]})
+
+    def test_dnat_retry(self):
+        config = self._create_config('dnat')
+        dns_watcher = MagicMock()
+        dns_watcher.add.return_value.resolve.return_value = '10.0.0.1'
+        dns_watcher.add.return_value.get_ips.return_value = ['10.0.0.1']
+        with mock.patch('util.Tunnel.Iptables') as iptables_mock:
+            iptables = iptables_mock.get.return_value
+            iptables.set_dnat.side_effect = [subprocess.SubprocessError(), None]
+            tunnel = Tunnel(config.forwarders[0], config, dns_watcher)
+            tunnel.start()
+
+            # The failed address is tried again on the next DNS check
+            tunnel._dns_changed('10.0.0.1')
+            self.assertEqual(2, iptables.set_dnat.call_count)
+            tunnel.stop()
+            iptables.remove_dnat.assert_called_once_with('tcp', 80)
+
+    def test_dnat_failed_stop(self):
+        config = self._create_config('dnat')
+        dns_watcher = MagicMock()
+        dns_watcher.add.return_value.resolve.return_value = '10.0.0.1'
+        with mock.patch('util.Tunnel.Iptables') as iptables_mock:
+            iptables = iptables_mock.get.return_value
+            iptables.set_dnat.side_effect = subprocess.SubprocessError()
+            tunnel = Tunnel(config.forwarders[0], config, dns_watcher)
+            tunnel.start()
+            # Nothing has been installed -> Nothing to remove
+            tunnel.stop()
+            iptables.remove_dnat.assert_not_called()
+
+    def test_stack(self):
+        self.assertEqual(PortConfig.STACK_DUAL, PortConfig({'stack': 'dual', 'port': 80}).stack)
+        # Only the name of the dual stack is a valid configuration
+        with self.assertRaises(ValueError):
+            PortConfig({'stack': PortConfig.STACK_DUAL, 'port': 80})
+
+    def test_firewall_entry_bind(self):
+        config = Config({'dest': 'example.com', 'forward': [
+            {'prot': 'tcp', 'mode': 'relay', 'src': {'stack': 'dual', 'port': 80, 'bind': '::ffff:192.168.1.2'},
+             'dest': {'stack': 4, 'port': 8080}},
+            {'prot': 'tcp', 'mode': 'relay', 'src': {'stack': 'dual', 'port': 443},
+             'dest': {'stack': 4, 'port': 8443}},
+            {'prot': 'udp', 'mode': 'relay', 'src': {'stack': 6, 'port': 53, 'bind': '::'},
+             'dest': {'stack': 4, 'port': 53}}]})
+        with mock.patch('util.Tunnel.Iptables'):
+            tunnels = [Tunnel(forwarder, config, MagicMock()) for forwarder in config.forwarders]
+            self.assertEqual({4: [('tcp', 80, '192.168.1.2'), ('tcp', 443, None)],
+                              6: [('tcp', 443, None), ('udp', 53, None)]}, Tunnel.get_firewall_entries(tunnels))
+
+    def test_status_export_mux(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'status.json')
+            config = Config({'dest': 'example.com', 'health_check': {'status_file': path}, 'forward': [
+                {'prot': 'tcp', 'mode': 'mux', 'src': {'stack': 4, 'port': 443}, 'dest': {'stack': 4, 'port': 443},
+                 'routes': [{'match': '*', 'host': 'web.example.com'}]},
+                {'prot': 'tcp', 'mode': 'relay', 'src': {'stack': 4, 'port': 80}, 'dest': {'stack': 4, 'port': 8080}}]})
+            with mock.patch('util.Tunnel.Iptables'):
+                tunnels = [Tunnel(forwarder, config, MagicMock()) for forwarder in config.forwarders]
+            self.assertIsNone(tunnels[0].get_health_checker())
+
+            # The mux forward has no health checker and is skipped
+            exporter = StatusExporter(path)
+            for tunnel in tunnels:
+                exporter.add(tunnel.get_health_checker())
+            checker = tunnels[1].get_health_checker()
+            checker.on_probe.fire(checker)
+            with open(path) as file:
+                self.assertEqual([checker.name], list(json.load(file).keys()))
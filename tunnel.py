@@ -1,14 +1,23 @@
-import argparse
-import json
-import logging
-import os
-import signal
-import sys
+from time import perf_counter
 
-from config.Config import Config
-from util.DnsWatcher import DnsWatcher
-from util.Loggable import Loggable
-from util.Tunnel import Tunnel
+LAUNCHED = perf_counter()
+
+import argparse  # noqa: E402
+import json  # noqa: E402
+import logging  # noqa: E402
+import os  # noqa: E402
+import signal  # noqa: E402
+import sys  # noqa: E402
+
+from config.Config import Config  # noqa: E402
+from util.DnsWatcher import DnsWatcher  # noqa: E402
+from util.Iptables import Iptables  # noqa: E402
+from util.Loggable import Loggable  # noqa: E402
+from util.Shutdown import GracefulShutdown  # noqa: E402
+from util.Trace import TraceSession  # noqa: E402
+from util.Tunnel import Tunnel  # noqa: E402
+
+IMPORTED = perf_counter()
 
 
 def main():
@@ -18,6 +27,10 @@ def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', dest='config', default='config.json', help='Config which should be used')
+    parser.add_argument('--trace', action='store_true',
+                        help='Record timing spans and stack samples from the start (SIGUSR1 toggles recording)')
+    parser.add_argument('--trace-file', dest='trace_file', default='trace.json',
+                        help='Chrome trace file which is written when the recording stops')
     args = parser.parse_args()
     if not os.path.isfile(args.config):
         raise FileNotFoundError('Config not found: ' + str(args.config))
@@ -25,26 +38,108 @@ def main():
     with open(args.config) as file:
         config = Config(json.load(file))
 
-    dns_watcher = DnsWatcher()
+    trace = TraceSession(args.trace_file)
+    if args.trace:
+        trace.start()
+    # The signal handler may interrupt the trace while it holds its lock -> Toggled by a separate thread
+    trace.handle_toggle_requests()
+    signal.signal(signal.SIGUSR1, lambda sig, frame: trace.request_toggle())
+
+    # Optional subsystems are only imported if they are configured
+    # Listening sockets of systemd socket activation or of the instance we are replacing
+    listeners = None
+    if 'LISTEN_FDS' in os.environ or config.handover_socket is not None:
+        from util.Handover import ListenerRegistry, HandoverClient
+        listeners = ListenerRegistry.from_systemd()
+        if config.handover_socket is not None:
+            listeners.add_all(HandoverClient(config.handover_socket).receive())
+
+    dns_watcher = DnsWatcher(config.dns)
+    global_bucket = None
+    if config.limit is not None:
+        from util.Shaper import TokenBucket
+        global_bucket = TokenBucket.from_config(config.limit)
+    connection_log = None
+    if config.connection_log is not None:
+        from util.ConnectionLog import ConnectionLog
+        connection_log = ConnectionLog(config.connection_log)
+        connection_log.start()
     tunnels = []
     for forwarder in config.forwarders:
-        tunnels.append(Tunnel(forwarder, config.dest_addr, dns_watcher))
+        tunnels.append(Tunnel(forwarder, config, dns_watcher, listeners, global_bucket, connection_log))
+
+    if config.health_check is not None and config.health_check.status_file is not None:
+        from util.HealthCheck import StatusExporter
+        exporter = StatusExporter(config.health_check.status_file)
+        for tunnel in tunnels:
+            exporter.add(tunnel.get_health_checker())
+    setup_done = perf_counter()
+
+    # One listing and one transaction per stack instead of two iptables calls per tunnel
+    for stack, entries in Tunnel.get_firewall_entries(tunnels).items():
+        firewall = Iptables.get(stack)
+        if firewall is not None:
+            firewall.add_entries(entries)
+    firewall_done = perf_counter()
 
+    first_listener = None
     for tunnel in tunnels:
-        tunnel.start()
+        tunnel.start(add_firewall=False)
+        if first_listener is None:
+            first_listener = perf_counter()
+    started = perf_counter()
+
+    log = Loggable.create_logger('Main')
+    log.info('Started ' + str(len(tunnels)) + ' tunnels in ' + str(round((started - setup_done) * 1000, 1)) +
+             'ms (' + str(dns_watcher.get_cached_count()) + ' destinations from DNS cache)')
+    log.info('Startup: imports ' + str(round((IMPORTED - LAUNCHED) * 1000, 1)) +
+             'ms, setup ' + str(round((setup_done - IMPORTED) * 1000, 1)) +
+             'ms, firewall ' + str(round((firewall_done - setup_done) * 1000, 1)) +
+             'ms, first listener after ' + str(round(((first_listener or started) - LAUNCHED) * 1000, 1)) + 'ms')
+    if listeners is not None:
+        listeners.close_unused()
+
+    shutdown = GracefulShutdown(tunnels, config.shutdown_timeout)
+    shutdown_requested = False
+    handed_over = False
 
     def signal_handler(sig, frame):
-        # Gracefully terminate to revert the iptables config
+        nonlocal shutdown_requested
+        if shutdown_requested:
+            # Second signal -> Don't wait for open connections
+            shutdown.force()
+            return
+        shutdown_requested = True
+        dns_watcher.stop()
+
+    def handover_completed():
+        # A new instance took over the listeners -> Drain and exit without touching the firewall
+        nonlocal handed_over
+        handed_over = True
         dns_watcher.stop()
-        for t in tunnels:
-            t.stop()
-        sys.exit(0)
 
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
+    handover_server = None
+    if config.handover_socket is not None:
+        from util.Handover import HandoverServer
+        handover_server = HandoverServer(config.handover_socket, lambda: [
+            listener for listener in (t.get_listener() for t in tunnels) if listener is not None])
+        handover_server.on_handover += handover_completed
+        handover_server.start()
+
     dns_watcher.wait_for_changes()
 
+    if handover_server is not None:
+        handover_server.stop()
+    # Gracefully terminate to revert the iptables config
+    shutdown.run(remove_firewall=not handed_over)
+    trace.stop()
+    if connection_log is not None:
+        connection_log.stop()
+    sys.exit(0)
+
 
 if __name__ == '__main__':
     main()
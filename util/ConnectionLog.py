@@ -0,0 +1,292 @@
+import json
+import os
+import socket
+import struct
+import threading
+from time import monotonic
+from typing import List, Optional, Iterator
+
+from config.Config import ConnectionLogConfig
+from util.Loggable import Loggable
+
+
+class ConnectionRecord:
+    """
+    A completed relayed connection
+    """
+
+    def __init__(self, forward: str, client_ip: str, client_port: int, upstream_ip: str, upstream_port: int,
+                 start: float, end: float, bytes_out: int, bytes_in: int):
+        self.forward: str = forward
+        """
+        Name of the forward (prot:stack:port)
+        """
+        self.client_ip: str = client_ip
+        self.client_port: int = client_port
+        self.upstream_ip: str = upstream_ip
+        self.upstream_port: int = upstream_port
+        self.start: float = start
+        """
+        Unix timestamp of the accept
+        """
+        self.end: float = end
+        """
+        Unix timestamp of the close
+        """
+        self.bytes_out: int = bytes_out
+        """
+        Bytes sent from the client to the upstream
+        """
+        self.bytes_in: int = bytes_in
+        """
+        Bytes sent from the upstream to the client
+        """
+
+    def get_duration(self) -> float:
+        return self.end - self.start
+
+    def to_dict(self) -> dict:
+        return {
+            'forward': self.forward,
+            'client': self.client_ip,
+            'client_port': self.client_port,
+            'upstream': self.upstream_ip,
+            'upstream_port': self.upstream_port,
+            'start': round(self.start, 6),
+            'end': round(self.end, 6),
+            'duration': round(self.get_duration(), 6),
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+        }
+
+
+class BinaryFormat:
+    """
+    Compact fixed size record format.
+    IPv4 addresses are stored as IPv4 mapped IPv6 addresses, the forward is stored as its listening port.
+    """
+
+    HEADER = b'DNTC\x01\x00\x00\x00'
+    """
+    Written at the start of every file (magic + version)
+    """
+
+    RECORD = struct.Struct('<ddH16sH16sHQQ')
+    """
+    start, end, listening port, client ip, client port, upstream ip, upstream port, bytes out, bytes in
+    """
+
+    @staticmethod
+    def pack(record: ConnectionRecord) -> bytes:
+        return BinaryFormat.RECORD.pack(record.start, record.end, BinaryFormat._port(record.forward),
+                                        BinaryFormat._pack_ip(record.client_ip), record.client_port,
+                                        BinaryFormat._pack_ip(record.upstream_ip), record.upstream_port,
+                                        record.bytes_out, record.bytes_in)
+
+    @staticmethod
+    def read(path: str) -> Iterator[ConnectionRecord]:
+        """
+        Reads all records of a binary connection log file
+        """
+        with open(path, 'rb') as file:
+            data = file.read()
+        if not data.startswith(BinaryFormat.HEADER):
+            raise ValueError('Not a binary connection log: ' + path)
+        for values in BinaryFormat.RECORD.iter_unpack(data[len(BinaryFormat.HEADER):]):
+            start, end, port, client_ip, client_port, upstream_ip, upstream_port, bytes_out, bytes_in = values
+            yield ConnectionRecord(str(port), BinaryFormat._unpack_ip(client_ip), client_port,
+                                   BinaryFormat._unpack_ip(upstream_ip), upstream_port,
+                                   start, end, bytes_out, bytes_in)
+
+    @staticmethod
+    def _port(forward: str) -> int:
+        return int(forward.rsplit(':', 1)[-1])
+
+    @staticmethod
+    def _pack_ip(ip: str) -> bytes:
+        if ip == '':
+            # Closed before an upstream was chosen
+            return b'\0' * 16
+        # The scope of link local addresses (fe80::1%eth0) is not stored
+        ip = ip.split('%', 1)[0]
+        if ':' in ip:
+            return socket.inet_pton(socket.AF_INET6, ip)
+        return b'\0' * 10 + b'\xff\xff' + socket.inet_pton(socket.AF_INET, ip)
+
+    @staticmethod
+    def _unpack_ip(data: bytes) -> str:
+        if data.startswith(b'\0' * 10 + b'\xff\xff'):
+            return socket.inet_ntop(socket.AF_INET, data[12:])
+        return socket.inet_ntop(socket.AF_INET6, data)
+
+
+class ConnectionLog(Loggable):
+    """
+    Exports connection records to a file.
+    Records are buffered in a fixed size ring buffer and written in batches by a background thread,
+    so the relay never waits for the disk. If the buffer is full, new records are dropped and counted.
+    """
+
+    FORMAT_JSONL = 'jsonl'
+    FORMAT_BINARY = 'binary'
+
+    def __init__(self, config: ConnectionLogConfig):
+        super().__init__('ConnectionLog')
+        self._config: ConnectionLogConfig = config
+        self._binary: bool = config.format == ConnectionLog.FORMAT_BINARY
+
+        self._ring: List[Optional[ConnectionRecord]] = [None] * config.buffer
+        self._head: int = 0
+        """
+        Index of the oldest buffered record
+        """
+        self._count: int = 0
+        """
+        Number of buffered records
+        """
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped: bool = False
+
+        self.dropped: int = 0
+        """
+        Number of records which have been dropped because the buffer was full
+        """
+        self._reported_dropped: int = 0
+        self.invalid: int = 0
+        """
+        Number of records which have been skipped because they couldn't be encoded
+        """
+        self.written: int = 0
+        """
+        Number of records which have been written
+        """
+
+        self._file = None
+        self._file_size: int = 0
+        self._file_opened: float = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='connection-log', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Writes all buffered records and closes the file
+        """
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        else:
+            self._write_batch()
+        self._close_file()
+
+    def add(self, record: ConnectionRecord):
+        """
+        Buffers a record, never blocks on I/O
+        """
+        with self._lock:
+            capacity = len(self._ring)
+            if self._count == capacity:
+                self.dropped += 1
+                return
+            self._ring[(self._head + self._count) % capacity] = record
+            self._count += 1
+            wake = self._count == capacity // 2
+        if wake:
+            # Don't wait for the flush interval if the buffer is filling up
+            self._wakeup.set()
+
+    def _take_all(self) -> List[ConnectionRecord]:
+        with self._lock:
+            capacity = len(self._ring)
+            end = self._head + self._count
+            if end <= capacity:
+                records = self._ring[self._head:end]
+                self._ring[self._head:end] = [None] * self._count
+            else:
+                records = self._ring[self._head:] + self._ring[:end - capacity]
+                self._ring[self._head:] = [None] * (capacity - self._head)
+                self._ring[:end - capacity] = [None] * (end - capacity)
+            self._head = end % capacity
+            self._count = 0
+        return records
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self._config.flush_interval)
+            self._wakeup.clear()
+            self._write_batch()
+        self._write_batch()
+
+    def _write_batch(self):
+        records = self._take_all()
+        if self.dropped > self._reported_dropped:
+            self.log.warning('Connection log buffer full, ' + str(self.dropped - self._reported_dropped) +
+                             ' records dropped')
+            self._reported_dropped = self.dropped
+        if len(records) == 0:
+            return
+
+        encoded = []
+        for record in records:
+            try:
+                if self._binary:
+                    encoded.append(BinaryFormat.pack(record))
+                else:
+                    encoded.append((json.dumps(record.to_dict()) + '\n').encode())
+            except (OSError, ValueError, struct.error) as e:
+                # A single bad record must not stop the writer
+                self.invalid += 1
+                self.log.warning('Skipping connection record of ' + str(record.client_ip) + ': ' + str(e))
+        data = b''.join(encoded)
+
+        try:
+            self._rotate_if_required()
+            if self._file is None:
+                self._open_file()
+            self._file.write(data)
+            self._file.flush()
+        except OSError as e:
+            self.log.warning('Could not write connection log ' + self._config.path + ': ' + str(e))
+            self._close_file()
+            return
+        self._file_size += len(data)
+        self.written += len(encoded)
+
+    def _open_file(self):
+        self._file = open(self._config.path, 'ab')
+        self._file_size = self._file.tell()
+        self._file_opened = monotonic()
+        if self._binary and self._file_size == 0:
+            self._file.write(BinaryFormat.HEADER)
+            self._file_size = len(BinaryFormat.HEADER)
+
+    def _close_file(self):
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        self._file = None
+
+    def _rotate_if_required(self):
+        if self._file is None:
+            return
+        config = self._config
+        too_large = 0 < config.max_size <= self._file_size
+        too_old = 0 < config.max_age <= monotonic() - self._file_opened
+        if not too_large and not too_old:
+            return
+
+        self._close_file()
+        # log -> log.1 -> log.2 ... the oldest file is deleted
+        for index in range(config.keep, 0, -1):
+            src = config.path if index == 1 else config.path + '.' + str(index - 1)
+            if os.path.exists(src):
+                os.replace(src, config.path + '.' + str(index))
+        if config.keep == 0:
+            os.remove(config.path)
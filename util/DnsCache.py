@@ -0,0 +1,69 @@
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+from util.Loggable import Loggable
+
+
+class DnsCache(Loggable):
+    """
+    Persists the last known good addresses per (host, stack),
+    so tunnels can be started without waiting for the resolver.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: Path of the json cache file
+        """
+        super().__init__('DnsCache')
+        self._path: str = path
+        self._entries: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def get(self, address: str, stack: int) -> Optional[List[str]]:
+        """
+        Returns the cached addresses or None if the entry isn't cached
+        """
+        ips = self._entries.get(self._key(address, stack))
+        return list(ips) if ips else None
+
+    def put(self, address: str, stack: int, ips: List[str]):
+        """
+        Stores the addresses, the file is only written if they have changed
+        """
+        key = self._key(address, stack)
+        with self._lock:
+            if self._entries.get(key) == ips:
+                return
+            self._entries[key] = list(ips)
+            self._write()
+
+    @staticmethod
+    def _key(address: str, stack: int) -> str:
+        return str(stack) + ':' + address
+
+    def _load(self):
+        if not os.path.isfile(self._path):
+            return
+        try:
+            with open(self._path) as file:
+                entries = json.load(file)
+        except (OSError, ValueError) as e:
+            self.log.warning('Ignoring unreadable DNS cache ' + self._path + ': ' + str(e))
+            return
+        if isinstance(entries, dict):
+            self._entries = entries
+
+    def _write(self):
+        # Write to a temporary file first, so a crash never leaves a truncated cache behind
+        tmp_path = self._path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as file:
+                json.dump(self._entries, file, indent=2)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            self.log.warning('Could not write DNS cache ' + self._path + ': ' + str(e))
@@ -0,0 +1,137 @@
+import random
+import socket
+import struct
+from typing import List, Tuple
+
+
+class DnsClient:
+    """
+    Minimal DNS client which queries a single nameserver directly over UDP
+    instead of using the resolver of the system
+    """
+
+    TYPE_A = 1
+    TYPE_AAAA = 28
+
+    RCODE_NXDOMAIN = 3
+
+    FLAG_TRUNCATED = 0x0200
+
+    def __init__(self, nameserver: str, timeout: float = 2, retries: int = 2):
+        """
+        :param nameserver: Address of the nameserver (ip, ip:port or [ipv6]:port)
+        :param timeout: Timeout of a single query in seconds
+        :param retries: Number of additional attempts after a timeout
+        """
+        self._address: Tuple[str, int] = DnsClient.parse_address(nameserver)
+        self._family: int = socket.AF_INET6 if ':' in self._address[0] else socket.AF_INET
+        self._timeout: float = timeout
+        self._retries: int = retries
+
+    @staticmethod
+    def parse_address(nameserver: str) -> Tuple[str, int]:
+        if nameserver.startswith('['):
+            host, _, port = nameserver[1:].partition(']')
+            return host, int(port[1:]) if port.startswith(':') else 53
+        if nameserver.count(':') == 1:
+            host, port = nameserver.split(':')
+            return host, int(port)
+        return nameserver, 53
+
+    def resolve(self, name: str, stack: int) -> List[str]:
+        """
+        Returns the A (stack 4) or AAAA (stack 6) records of the given name
+        :raises socket.gaierror: If the name doesn't exist, the nameserver doesn't answer or the reply is invalid
+        """
+        qtype = DnsClient.TYPE_AAAA if stack == 6 else DnsClient.TYPE_A
+        query_id = random.randint(0, 0xffff)
+        query = DnsClient._build_query(query_id, name, qtype)
+        question = query[12:]
+
+        with socket.socket(self._family, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self._timeout)
+            for _ in range(self._retries + 1):
+                sock.sendto(query, self._address)
+                try:
+                    while True:
+                        reply, _ = sock.recvfrom(4096)
+                        # Replies to other queries are ignored
+                        if len(reply) >= 12 and struct.unpack('!H', reply[:2])[0] == query_id \
+                                and DnsClient._has_question(reply, question):
+                            return DnsClient._parse_reply(reply, name, qtype)
+                except socket.timeout:
+                    continue
+        raise socket.gaierror('No reply from nameserver ' + self._address[0] + ' for ' + name)
+
+    @staticmethod
+    def _build_query(query_id: int, name: str, qtype: int) -> bytes:
+        # Recursion desired, one question
+        header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+        return header + DnsClient._encode_name(name) + struct.pack('!HH', qtype, 1)
+
+    @staticmethod
+    def _encode_name(name: str) -> bytes:
+        data = b''
+        for label in name.rstrip('.').split('.'):
+            encoded = label.encode('idna')
+            data += bytes([len(encoded)]) + encoded
+        return data + b'\0'
+
+    @staticmethod
+    def _skip_name(data: bytes, offset: int) -> int:
+        while True:
+            length = data[offset]
+            if length == 0:
+                return offset + 1
+            if length & 0xc0 == 0xc0:
+                # Compression pointer
+                return offset + 2
+            offset += length + 1
+
+    @staticmethod
+    def _has_question(data: bytes, question: bytes) -> bool:
+        """
+        Checks if the reply contains the single question of the query
+        """
+        qdcount = struct.unpack('!H', data[4:6])[0]
+        # Names are compared case insensitive, the nameserver may change the case
+        return qdcount == 1 and data[12:12 + len(question)].lower() == question.lower()
+
+    @staticmethod
+    def _parse_reply(data: bytes, name: str, qtype: int) -> List[str]:
+        try:
+            return DnsClient._parse_records(data, name, qtype)
+        except (struct.error, IndexError, ValueError):
+            raise socket.gaierror('Malformed reply from nameserver for ' + name)
+
+    @staticmethod
+    def _parse_records(data: bytes, name: str, qtype: int) -> List[str]:
+        _, flags, qdcount, ancount, _, _ = struct.unpack('!HHHHHH', data[:12])
+        rcode = flags & 0x0f
+        if rcode == DnsClient.RCODE_NXDOMAIN:
+            raise socket.gaierror('Name does not exist: ' + name)
+        if rcode != 0:
+            raise socket.gaierror('Nameserver error ' + str(rcode) + ' for ' + name)
+        if flags & DnsClient.FLAG_TRUNCATED:
+            # The answer doesn't fit into a udp reply, a partial list of ips would replace the complete one
+            raise socket.gaierror('Truncated reply from nameserver for ' + name)
+
+        offset = 12
+        for _ in range(qdcount):
+            offset = DnsClient._skip_name(data, offset) + 4
+
+        ips = []
+        for _ in range(ancount):
+            offset = DnsClient._skip_name(data, offset)
+            rtype, _, _, length = struct.unpack('!HHIH', data[offset:offset + 10])
+            offset += 10
+            if offset + length > len(data):
+                raise ValueError('Record exceeds the reply')
+            rdata = data[offset:offset + length]
+            offset += length
+            # CNAME records are followed by the records of the target in the same answer
+            if rtype == qtype == DnsClient.TYPE_A and length == 4:
+                ips.append(socket.inet_ntop(socket.AF_INET, rdata))
+            elif rtype == qtype == DnsClient.TYPE_AAAA and length == 16:
+                ips.append(socket.inet_ntop(socket.AF_INET6, rdata))
+        return ips
@@ -1,9 +1,15 @@
+import math
 import socket
+import threading
 from abc import abstractmethod
-from time import sleep
+from time import monotonic
 from typing import List, Optional, Callable, Dict
 
+from config.Config import DnsConfig
+from util.DnsCache import DnsCache
+from util.DnsClient import DnsClient
 from util.Loggable import Loggable
+from util.Trace import Trace
 
 
 class EntryListener:
@@ -13,43 +19,145 @@ class EntryListener:
 
 
 class EntryWatch(Loggable):
-    def __init__(self, address: str, stack: int):
+    def __init__(self, address: str, stack: int, config: Optional[DnsConfig] = None,
+                 cache: Optional[DnsCache] = None):
         super().__init__('EntryWatch')
         self._address: str = address
+        self._stack_num: int = stack
         self._stack: int = socket.AF_INET6 if stack == 6 else socket.AF_INET
+        self._config: DnsConfig = config if config is not None else DnsConfig({})
+        self._cache: Optional[DnsCache] = cache
+        self._client: Optional[DnsClient] = None
+        if self._config.nameserver is not None:
+            self._client = DnsClient(self._config.nameserver)
         self.listener: List[Callable] = []
 
-        self._last_ip: Optional[str] = None
+        self._ips: Optional[List[str]] = None
+        """
+        Sorted set of the currently accepted addresses
+        """
 
-    def check(self):
+        self._from_cache: bool = False
         """
-        Checks if the dns entry has been changed
+        True while the accepted addresses are the last known good ones from the cache
         """
-        ips = self.resolve_ips()
+        if cache is not None:
+            self._ips = cache.get(address, stack)
+            self._from_cache = self._ips is not None
 
-        last_ip = None
-        for ip in ips:
-            if self._last_ip is None:
-                self._last_ip = ip
-                return
-            if self._last_ip == ip:
-                return
+        self._candidate: Optional[List[str]] = None
+        """
+        Changed address set which has not been confirmed often enough yet
+        """
+        self._candidate_count: int = 0
 
-            last_ip = ip
+        self._last_switch: float = -math.inf
+        """
+        Time of the last accepted change. The monotonic clock starts at boot, so the initial value
+        must not delay the first change on a freshly booted host.
+        """
 
-        self._last_ip = last_ip
+    def check(self):
+        """
+        Checks if the dns entry has been changed.
+        The order of the returned addresses is ignored and a changed set only gets
+        accepted once it has been seen for the configured number of consecutive checks
+        and the minimum interval since the last change has passed.
+        """
+        try:
+            ips = self._resolve_set()
+        except socket.gaierror:
+            # Keep the current addresses, the error has already been logged
+            return
+
+        if self._ips is None:
+            self._accept(ips)
+            return
+
+        if ips == self._ips:
+            self._from_cache = False
+            self._candidate = None
+            self._candidate_count = 0
+            return
+
+        if self._from_cache:
+            # The cached addresses are outdated -> Switch right away
+            self.log.info(self._address + ' changed from cached ' + str(self._ips) + ' to ' + str(ips))
+            self._accept(ips)
+            self._notify()
+            return
+
+        if ips == self._candidate:
+            self._candidate_count += 1
+        else:
+            self._candidate = ips
+            self._candidate_count = 1
+
+        if self._candidate_count < self._config.confirmations:
+            self.log.debug(self._address + ' changed to ' + str(ips) + ', waiting for confirmation')
+            return
+        if monotonic() - self._last_switch < self._config.min_interval:
+            self.log.debug(self._address + ' changed to ' + str(ips) + ', waiting for minimum switch interval')
+            return
+
+        self.log.info(self._address + ' changed from ' + str(self._ips) + ' to ' + str(ips))
+        self._accept(ips)
+        self._last_switch = monotonic()
+        self._notify()
+
+    def _accept(self, ips: List[str]):
+        self._ips = ips
+        self._from_cache = False
+        self._candidate = None
+        self._candidate_count = 0
+        if self._cache is not None:
+            self._cache.put(self._address, self._stack_num, ips)
+
+    def _notify(self):
         # IP has changed, notify listeners
         for listener in self.listener:
-            listener(last_ip)
+            listener(self._ips[0])
 
     def add_listener(self, callback_method: Callable):
         self.listener.append(callback_method)
 
     def resolve(self) -> str:
-        ips = self.resolve_ips()
-        return ips[0]
+        """
+        Returns the first accepted address, resolves the entry if it hasn't been resolved
+        yet and isn't cached
+        """
+        if self._ips is None:
+            self._accept(self._resolve_set())
+        return self._ips[0]
 
+    def is_cached(self) -> bool:
+        """
+        Returns True if the accepted addresses come from the cache and haven't been refreshed yet
+        """
+        return self._from_cache
+
+    def get_ips(self) -> List[str]:
+        """
+        Returns all currently accepted addresses
+        """
+        return list(self._ips) if self._ips is not None else []
+
+    def _resolve_set(self) -> List[str]:
+        ips = sorted(set(self.resolve_ips()))
+        if len(ips) == 0:
+            raise socket.gaierror('No addresses for ' + self._address)
+        return ips
+
+    @Trace.traced('dns')
     def resolve_ips(self) -> List[str]:
+        if self._client is not None:
+            try:
+                return self._client.resolve(self._address, self._stack_num)
+            except OSError as e:
+                self.log.error('Could not resolve ' + self._address + ' for stack ' + str(self._stack_num) +
+                               ': ' + str(e))
+                raise socket.gaierror(str(e))
+
         try:
             reply = socket.getaddrinfo(self._address, None, self._stack)
         except socket.gaierror:
@@ -68,12 +176,26 @@ class DnsWatcher:
     Watches for DNS changes
     """
 
-    _check: bool = False
-    """
-    Indicates if the dns watch is running
-    """
+    def __init__(self, config: Optional[DnsConfig] = None):
+        """
+        :param config: DNS configuration, defaults are used if not set
+        """
+        self._config: Optional[DnsConfig] = config
+        self._interval: float = config.interval if config is not None else 60
+        self._cache: Optional[DnsCache] = None
+        if config is not None and config.cache is not None:
+            self._cache = DnsCache(config.cache)
 
-    _addrs: Dict[str, EntryWatch] = {}
+        self._stopped: threading.Event = threading.Event()
+        """
+        Set once the dns watch should stop
+        """
+
+        self._addrs: Dict[str, EntryWatch] = {}
+        """
+        Watched entries by stack and domain. Each entry is resolved once per check,
+        no matter how many tunnels use it.
+        """
 
     def add(self, addr: str, stack: int, callback_method: Callable) -> EntryWatch:
         """
@@ -82,17 +204,23 @@ class DnsWatcher:
         :param stack: IP stack (4 or 6)
         :param callback_method: Method which should be called on change
         """
-        key = str(stack) + addr
+        key = str(stack) + ':' + addr
         if key in self._addrs:
             watch = self._addrs[key]
             watch.add_listener(callback_method)
             return watch
 
-        watch = EntryWatch(addr, stack)
+        watch = EntryWatch(addr, stack, self._config, self._cache)
         watch.add_listener(callback_method)
         self._addrs[key] = watch
         return watch
 
+    def get_cached_count(self) -> int:
+        """
+        Returns the number of entries which currently use addresses from the cache
+        """
+        return len([watch for watch in self._addrs.values() if watch.is_cached()])
+
     def check(self):
         """
         Checks for changed dns entries
@@ -101,14 +229,14 @@ class DnsWatcher:
             watchers.check()
 
     def stop(self):
-        self._check = False
+        self._stopped.set()
 
     def wait_for_changes(self):
         """
         Checks for DNS changes in regular intervals.
         This call blocks until "stop" is called
         """
-        self._check = True
-        while self._check:
+        self._stopped.clear()
+        while not self._stopped.is_set():
             self.check()
-            sleep(60)
+            self._stopped.wait(self._interval)
@@ -0,0 +1,194 @@
+import array
+import json
+import os
+import socket
+import threading
+from typing import List, Optional, Callable
+
+from util.Events import EventHook
+from util.Loggable import Loggable
+
+
+class ListenerRegistry(Loggable):
+    """
+    Already bound listening sockets which have been inherited from
+    systemd (socket activation) or from a previous instance (handover)
+    """
+
+    SD_LISTEN_FDS_START = 3
+
+    def __init__(self, sockets: Optional[List[socket.socket]] = None):
+        super().__init__('ListenerRegistry')
+        self._sockets: List[socket.socket] = sockets if sockets is not None else []
+
+    @staticmethod
+    def from_systemd() -> 'ListenerRegistry':
+        """
+        Creates a registry from the sockets passed via LISTEN_FDS
+        """
+        sockets = []
+        if os.environ.get('LISTEN_PID') == str(os.getpid()):
+            count = int(os.environ.get('LISTEN_FDS', '0'))
+            for fd in range(ListenerRegistry.SD_LISTEN_FDS_START, ListenerRegistry.SD_LISTEN_FDS_START + count):
+                os.set_inheritable(fd, False)
+                sockets.append(socket.socket(fileno=fd))
+            for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+                os.environ.pop(name, None)
+        return ListenerRegistry(sockets)
+
+    def add_all(self, sockets: List[socket.socket]):
+        self._sockets += sockets
+
+    def __len__(self):
+        return len(self._sockets)
+
+    def take(self, family: int, port: int, address: str = '', dual: bool = False) -> Optional[socket.socket]:
+        """
+        Removes and returns the listening socket which matches the given parameters
+        :param family: Address family
+        :param port: Port
+        :param address: Bind address, empty for the wildcard address
+        :param dual: True if the socket has to accept IPv4 clients as well (IPV6_V6ONLY disabled)
+        :return: Socket or None if no socket matches
+        """
+        for sock in self._sockets:
+            if sock.family != family or sock.type != socket.SOCK_STREAM:
+                continue
+            if dual and sock.getsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY) != 0:
+                continue
+            bound = sock.getsockname()
+            if bound[1] != port:
+                continue
+            if address != '' and bound[0] != address:
+                continue
+            if address == '' and bound[0] not in ('0.0.0.0', '::'):
+                continue
+            self._sockets.remove(sock)
+            return sock
+        return None
+
+    def close_unused(self):
+        """
+        Closes all sockets which haven't been taken
+        """
+        for sock in self._sockets:
+            self.log.warning('Closing unused inherited listener ' + str(sock.getsockname()))
+            sock.close()
+        self._sockets = []
+
+
+class HandoverServer(Loggable):
+    """
+    Hands the listening sockets of this instance over to a new instance
+    using SCM_RIGHTS over a unix socket
+    """
+
+    MAX_FDS_PER_MESSAGE = 250
+    """
+    The kernel limits the number of file descriptors per message (SCM_MAX_FD)
+    """
+
+    def __init__(self, path: str, get_listeners: Callable[[], List[socket.socket]]):
+        """
+        :param path: Path of the unix socket
+        :param get_listeners: Returns the listening sockets which should be handed over
+        """
+        super().__init__('HandoverServer')
+        self._path: str = path
+        self._get_listeners = get_listeners
+        self._sock: Optional[socket.socket] = None
+
+        self.on_handover = EventHook()
+        """
+        Fired once a new instance has received the listeners
+        """
+
+    def start(self):
+        if os.path.exists(self._path):
+            # Socket of the previous instance - it has already handed over its listeners
+            os.unlink(self._path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._sock.bind(self._path)
+        os.chmod(self._path, 0o600)
+        self._sock.listen(1)
+        threading.Thread(target=self._run, name='handover', daemon=True).start()
+
+    def stop(self):
+        if self._sock is None:
+            return
+        self._sock.close()
+        self._sock = None
+
+    def _run(self):
+        while self._sock is not None:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    if self._hand_over(conn):
+                        self.stop()
+                        self.on_handover.fire()
+                        return
+                except OSError as e:
+                    self.log.warning('Handover failed: ' + str(e))
+
+    def _hand_over(self, conn: socket.socket) -> bool:
+        listeners = self._get_listeners()
+        self.log.info('Handing over ' + str(len(listeners)) + ' listeners')
+        header = json.dumps({'count': len(listeners)}).encode('utf-8')
+        conn.sendall(header)
+        for i in range(0, len(listeners), HandoverServer.MAX_FDS_PER_MESSAGE):
+            batch = listeners[i:i + HandoverServer.MAX_FDS_PER_MESSAGE]
+            fds = array.array('i', [sock.fileno() for sock in batch])
+            conn.sendmsg([b'F'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+        # Only give up the listeners once the new instance has confirmed that it received them
+        return conn.recv(16) == b'OK'
+
+
+class HandoverClient(Loggable):
+    """
+    Receives the listening sockets of a running instance
+    """
+
+    def __init__(self, path: str):
+        super().__init__('HandoverClient')
+        self._path: str = path
+
+    def receive(self, timeout: float = 10) -> List[socket.socket]:
+        """
+        Receives the listeners of the running instance.
+        :return: Listening sockets, empty if no instance is running
+        """
+        if not os.path.exists(self._path):
+            return []
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self._path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            sock.close()
+            return []
+
+        sockets = []
+        with sock:
+            count = json.loads(sock.recv(4096).decode('utf-8'))['count']
+            fd_size = array.array('i').itemsize
+            while len(sockets) < count:
+                msg, ancdata, flags, addr = sock.recvmsg(
+                    16, socket.CMSG_SPACE(HandoverServer.MAX_FDS_PER_MESSAGE * fd_size))
+                if not msg:
+                    raise ConnectionError('Handover aborted after ' + str(len(sockets)) + ' listeners')
+                for level, msg_type, data in ancdata:
+                    if level != socket.SOL_SOCKET or msg_type != socket.SCM_RIGHTS:
+                        continue
+                    fds = array.array('i')
+                    fds.frombytes(data[:len(data) - (len(data) % fd_size)])
+                    sockets += [socket.socket(fileno=fd) for fd in fds]
+            sock.sendall(b'OK')
+
+        self.log.info('Received ' + str(len(sockets)) + ' listeners')
+        return sockets
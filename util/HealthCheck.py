@@ -0,0 +1,302 @@
+import json
+import os
+import socket
+import threading
+from time import perf_counter, time
+from typing import Dict, List, Optional
+
+from config.Config import HealthCheckConfig
+from util.Events import EventHook
+from util.Loggable import Loggable
+
+
+class UpstreamState:
+    """
+    Health and latency state of a single destination address
+    """
+
+    RTT_ALPHA = 0.125
+    """
+    Smoothing factor for the RTT (same as the TCP SRTT estimator)
+    """
+
+    def __init__(self, address: str, fallback: bool):
+        self.address: str = address
+        self.fallback: bool = fallback
+        """
+        True if the address belongs to the fallback host
+        """
+
+        self.rtt: Optional[float] = None
+        """
+        Smoothed round trip time in seconds, None if unknown
+        """
+
+        self.healthy: bool = True
+        """
+        Addresses are considered healthy until proven otherwise
+        """
+
+        self.successes: int = 0
+        """
+        Number of consecutive successful probes
+        """
+
+        self.failures: int = 0
+        """
+        Number of consecutive failed probes
+        """
+
+        self.last_error: Optional[str] = None
+        self.last_probe: Optional[float] = None
+
+    def record_success(self, rtt: Optional[float], rise: int):
+        self.failures = 0
+        self.successes += 1
+        self.last_error = None
+        self.last_probe = time()
+        if rtt is not None:
+            if self.rtt is None:
+                self.rtt = rtt
+            else:
+                self.rtt += UpstreamState.RTT_ALPHA * (rtt - self.rtt)
+
+        if not self.healthy and self.successes >= rise:
+            self.healthy = True
+
+    def record_failure(self, error: str, fall: int):
+        self.successes = 0
+        self.failures += 1
+        self.last_error = error
+        self.last_probe = time()
+        if self.healthy and self.failures >= fall:
+            self.healthy = False
+
+    def sort_key(self) -> float:
+        return self.rtt if self.rtt is not None else float('inf')
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            'address': self.address,
+            'fallback': self.fallback,
+            'healthy': self.healthy,
+            'rtt_ms': None if self.rtt is None else round(self.rtt * 1000, 3),
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'last_probe': self.last_probe,
+        }
+
+
+class HealthChecker(Loggable):
+    """
+    Periodically probes all addresses of a destination and selects the
+    healthy address with the lowest latency
+    """
+
+    def __init__(self, name: str, prot: str, port: int, stack: int, config: HealthCheckConfig):
+        """
+        :param name: Name of the checker, used for logging and export
+        :param prot: Protocol (tcp or udp)
+        :param port: Destination port which should be probed
+        :param stack: IP stack (4 or 6)
+        :param config: Health check configuration
+        """
+        super().__init__('HealthChecker')
+        self.name: str = name
+        self._prot: str = prot.lower()
+        self._port: int = port
+        self._family: int = socket.AF_INET6 if stack == 6 else socket.AF_INET
+        self._config: HealthCheckConfig = config
+
+        self._states: Dict[str, UpstreamState] = {}
+        self._selected: Optional[str] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.on_probe = EventHook()
+        """
+        Fired after each probe round with the checker as argument
+        """
+
+        self.on_selection_changed = EventHook()
+        """
+        Fired with the newly selected address
+        """
+
+    def set_addresses(self, primary: List[str], fallback: List[str]):
+        """
+        Updates the addresses which should be probed.
+        The state of addresses which are still present is kept.
+        :param primary: Addresses of the destination host
+        :param fallback: Addresses of the fallback host
+        """
+        with self._lock:
+            states = {}
+            for address in primary:
+                states[address] = self._states.get(address) or UpstreamState(address, False)
+                states[address].fallback = False
+            for address in fallback:
+                if address not in states:
+                    states[address] = self._states.get(address) or UpstreamState(address, True)
+                    states[address].fallback = True
+            self._states = states
+        self._update_selection()
+
+    def get_selected(self) -> Optional[str]:
+        return self._selected
+
+    def get_status(self) -> Dict[str, any]:
+        """
+        Returns a snapshot of the probe results and the current selection
+        """
+        with self._lock:
+            return {
+                'selected': self._selected,
+                'addresses': [state.to_dict() for state in self._states.values()],
+            }
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='health-' + self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def probe_all(self):
+        """
+        Probes every known address once and updates the selection
+        """
+        with self._lock:
+            states = list(self._states.values())
+
+        for state in states:
+            error = None
+            rtt = None
+            try:
+                rtt = self._probe(state.address)
+            except OSError as e:
+                error = str(e) or type(e).__name__
+
+            with self._lock:
+                was_healthy = state.healthy
+                if error is None:
+                    state.record_success(rtt, self._config.rise)
+                else:
+                    state.record_failure(error, self._config.fall)
+
+            if was_healthy != state.healthy:
+                self.log.warning(self.name + ': ' + state.address + ' is now ' +
+                                 ('healthy' if state.healthy else 'unhealthy (' + str(error) + ')'))
+
+        self._update_selection()
+        self.on_probe.fire(self)
+
+    def select(self) -> Optional[str]:
+        """
+        Returns the address new connections should be sent to.
+        Healthy addresses of the destination host are preferred over the fallback host,
+        within each group the lowest smoothed RTT wins.
+        """
+        with self._lock:
+            states = list(self._states.values())
+            current = self._states.get(self._selected) if self._selected is not None else None
+
+        if len(states) == 0:
+            return None
+
+        candidates = [state for state in states if state.healthy and not state.fallback]
+        if len(candidates) == 0:
+            candidates = [state for state in states if state.healthy]
+        if len(candidates) == 0:
+            # Nothing is healthy - stay where we are
+            return current.address if current is not None else states[0].address
+
+        best = min(candidates, key=UpstreamState.sort_key)
+        if current is None or current not in candidates:
+            return best.address
+
+        # Only switch between equally preferred addresses if the improvement is significant
+        if best.sort_key() < current.sort_key() * (1 - self._config.switch_margin):
+            return best.address
+        return current.address
+
+    def _update_selection(self):
+        selected = self.select()
+        if selected is None or selected == self._selected:
+            return
+
+        previous = self._selected
+        self._selected = selected
+        if previous is None:
+            return
+        self.log.info(self.name + ': Switching destination from ' + previous + ' to ' + selected)
+        self.on_selection_changed.fire(selected)
+
+    def _probe(self, address: str) -> Optional[float]:
+        """
+        Probes a single address
+        :return: Measured RTT in seconds or None if the probe can't measure a RTT
+        :raises OSError: If the address is unreachable
+        """
+        if self._prot == 'udp':
+            return self._probe_udp(address)
+        return self._probe_tcp(address)
+
+    def _probe_tcp(self, address: str) -> float:
+        with socket.socket(self._family, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self._config.timeout)
+            start = perf_counter()
+            sock.connect((address, self._port))
+            return perf_counter() - start
+
+    def _probe_udp(self, address: str) -> Optional[float]:
+        # UDP is connectionless: An ICMP port unreachable shows up as ConnectionRefusedError,
+        # silence is considered healthy but doesn't provide a RTT
+        with socket.socket(self._family, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self._config.timeout)
+            sock.connect((address, self._port))
+            start = perf_counter()
+            sock.send(b'')
+            try:
+                sock.recv(1)
+            except socket.timeout:
+                return None
+            return perf_counter() - start
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.probe_all()
+            self._stop.wait(self._config.interval)
+
+
+class StatusExporter(Loggable):
+    """
+    Writes the status of multiple health checkers into a single json file
+    """
+
+    def __init__(self, path: str):
+        super().__init__('StatusExporter')
+        self._path: str = path
+        self._status: Dict[str, any] = {}
+        self._lock = threading.Lock()
+
+    def add(self, checker: Optional[HealthChecker]):
+        """
+        :param checker: Health checker of a forward, None if the forward has none (mux forwards)
+        """
+        if checker is None:
+            return
+        checker.on_probe += self._probed
+
+    def _probed(self, checker: HealthChecker):
+        with self._lock:
+            self._status[checker.name] = checker.get_status()
+            tmp_path = self._path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as file:
+                    json.dump(self._status, file, indent=2)
+                os.replace(tmp_path, self._path)
+            except OSError as e:
+                self.log.warning('Could not export health status to ' + self._path + ': ' + str(e))
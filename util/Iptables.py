@@ -1,32 +1,104 @@
+import os
 import re
+import shutil
 import subprocess
-from typing import List, Optional
+import threading
+from typing import Dict, List, Optional, Tuple
 
 from util.Loggable import Loggable
 from util.Process import Process
+from util.Trace import Trace
 
 
 class Rule:
-    def __init__(self, num: int, target: str, protocol: str, port: int):
+    def __init__(self, num: int, target: str, protocol: str, port: int, comment: Optional[str] = None,
+                 destination: Optional[str] = None):
         self.num = num
         self.target = target
         self.protocol = protocol
         self.port = port
+        self.comment = comment
+        self.destination = destination
+        """
+        Destination address of the rule, None for all addresses
+        """
 
 
 class Iptables(Loggable):
     """
+    Manages the firewall rules of the tunnels
+    """
 
+    NAT_COMMENT_PREFIX = 'dynnat:'
+    """
+    Prefix of the comment which marks the NAT rules managed by this tool
     """
 
+    NAT_CHAINS = ('PREROUTING', 'OUTPUT', 'POSTROUTING')
+    """
+    Chains of the NAT rules of a DNAT forward
+    """
+
+    TIMEOUT = 10
+    """
+    Maximum execution time of a single iptables call in seconds (e.g. while waiting for the xtables lock)
+    """
+
+    __instances: Dict[int, Optional['Iptables']] = {}
+    """
+    Shared instance per stack, None if the rules of the stack can't be managed
+    """
+    __lock = threading.Lock()
+
     def __init__(self, stack: int):
         super().__init__('Iptables')
         self._stack = stack
 
-    def get_entry(self, prot: str, port: int) -> Optional[Rule]:
+    @staticmethod
+    def get(stack: int) -> Optional['Iptables']:
+        """
+        Returns the shared instance of the given stack.
+        The capability is probed once per stack, None is returned if the firewall rules can't be managed
+        (not running as root or iptables is not installed).
+        """
+        with Iptables.__lock:
+            if stack not in Iptables.__instances:
+                instance = Iptables(stack)
+                error = instance.probe()
+                if error is not None:
+                    instance.log.warning('Firewall rules for IPv' + str(stack) + ' are not managed: ' + error)
+                    instance = None
+                Iptables.__instances[stack] = instance
+            return Iptables.__instances[stack]
+
+    def probe(self) -> Optional[str]:
+        """
+        Checks if the rules can be managed.
+        iptables is executed once to list the nat table, which fails if the table or its kernel module is missing.
+        :return: None if they can, otherwise the reason why not
+        """
+        if os.geteuid() != 0:
+            return 'not running as root'
+        for bin_name in (self._bin_name(), self._bin_name() + '-restore'):
+            if shutil.which(bin_name) is None:
+                return bin_name + ' not found'
+        try:
+            self._execute(['-t', 'nat', '-S'])
+        except (subprocess.SubprocessError, OSError):
+            return 'the nat table is not available'
+        return None
+
+    def get_entry(self, prot: str, port: int, destination: Optional[str] = None) -> Optional[Rule]:
         args = ['-L', 'INPUT', '-n', '--line-number']
         out = self._execute(args)
         rules = self._parse_table(out)
+        return self._find_rule(rules, prot, port, destination)
+
+    @staticmethod
+    def _find_rule(rules: List[Rule], prot: str, port: int, destination: Optional[str] = None) -> Optional[Rule]:
+        """
+        Returns the first accept rule of the given port and destination address (None for all addresses)
+        """
         for rule in rules:
             if rule.target != 'ACCEPT':
                 continue
@@ -34,26 +106,36 @@ class Iptables(Loggable):
                 continue
             if rule.protocol != 'all' and rule.protocol != prot:
                 continue
+            if rule.destination != destination:
+                continue
 
             return rule
         return None
 
-    def add_entry(self, prot: str, port: int):
+    @staticmethod
+    def _accept_command(prot: str, port: int, destination: Optional[str]) -> List[str]:
+        command = ['-A', 'INPUT', '-p', prot]
+        if destination is not None:
+            # Only the address the listener is bound to
+            command += ['-d', destination]
+        return command + ['--dport', str(port), '-j', 'ACCEPT']
+
+    def add_entry(self, prot: str, port: int, destination: Optional[str] = None):
         try:
-            rule = self.get_entry(prot, port)
+            rule = self.get_entry(prot, port, destination)
             if rule is not None:
                 # Matching rule found -> Do nothing
                 return
 
-            args = ['-A', 'INPUT', '-p', prot, '--dport', str(port), '-j', 'ACCEPT']
+            args = self._accept_command(prot, port, destination)
 
             self._execute(args)
         except subprocess.SubprocessError:
             self.log.warning('Could not add iptables rule for ' + prot + ':' + str(port))
 
-    def remove_entry(self, prot: str, port: int):
+    def remove_entry(self, prot: str, port: int, destination: Optional[str] = None):
         try:
-            rule = self.get_entry(prot, port)
+            rule = self.get_entry(prot, port, destination)
             if rule is None:
                 # No matching rule found -> Do nothing
                 return
@@ -62,31 +144,199 @@ class Iptables(Loggable):
         except subprocess.SubprocessError:
             self.log.warning('Could not remove iptables rule for ' + prot + ':' + str(port))
 
+    def add_entries(self, entries: List[Tuple[str, int, Optional[str]]]):
+        """
+        Adds the accept rules of multiple ports with a single listing
+        and a single iptables-restore transaction
+        :param entries: List of (protocol, port, destination address or None for all addresses)
+        """
+        try:
+            rules = self._parse_table(self._execute(['-L', 'INPUT', '-n', '--line-number']))
+            commands = []
+            for prot, port, destination in entries:
+                if self._find_rule(rules, prot, port, destination) is not None:
+                    # Matching rule found -> Do nothing
+                    continue
+                command = self._accept_command(prot, port, destination)
+                if command not in commands:
+                    commands.append(command)
+
+            if len(commands) == 0:
+                return
+            self._restore('filter', commands)
+        except subprocess.SubprocessError:
+            self.log.warning('Could not add iptables rules for ' + str(len(entries)) + ' ports')
+
+    def remove_entries(self, entries: List[Tuple[str, int, Optional[str]]]):
+        """
+        Removes the accept rules of multiple ports with a single listing
+        and a single iptables-restore transaction
+        :param entries: List of (protocol, port, destination address or None for all addresses)
+        """
+        try:
+            rules = self._parse_table(self._execute(['-L', 'INPUT', '-n', '--line-number']))
+            to_remove = []
+            for prot, port, destination in entries:
+                rule = self._find_rule(rules, prot, port, destination)
+                if rule is not None and rule not in to_remove:
+                    to_remove.append(rule)
+
+            if len(to_remove) == 0:
+                return
+            self._restore('filter', self._delete_commands('INPUT', to_remove))
+        except subprocess.SubprocessError:
+            self.log.warning('Could not remove iptables rules for ' + str(len(entries)) + ' ports')
+
+    def set_dnat(self, prot: str, port: int, dest_ip: str, dest_port: int):
+        """
+        Installs (or atomically rewrites) the DNAT/MASQUERADE rules
+        which forward the given port to the destination in the kernel.
+        Only connections to local addresses are redirected (PREROUTING for remote clients,
+        OUTPUT for local ones), traffic which is routed through this host is not touched.
+        :param prot: Protocol (tcp or udp)
+        :param port: Local port
+        :param dest_ip: Destination ip
+        :param dest_port: Destination port
+        """
+        comment = self._nat_comment(prot, port)
+        rules = {chain: self._get_nat_rules(chain, comment) for chain in Iptables.NAT_CHAINS}
+
+        if self._stack == 6:
+            to_dest = '[' + dest_ip + ']:' + str(dest_port)
+        else:
+            to_dest = dest_ip + ':' + str(dest_port)
+        dnat_spec = ['-p', prot, '--dport', str(port), '-m', 'addrtype', '--dst-type', 'LOCAL',
+                     '-m', 'comment', '--comment', comment, '-j', 'DNAT', '--to-destination', to_dest]
+        # Only masquerade the connections which have been redirected, not all traffic to the destination
+        masq_spec = ['-p', prot, '-d', dest_ip, '--dport', str(dest_port), '-m', 'conntrack', '--ctstate', 'DNAT',
+                     '-m', 'comment', '--comment', comment, '-j', 'MASQUERADE']
+        specs = {'PREROUTING': dnat_spec, 'OUTPUT': dnat_spec, 'POSTROUTING': masq_spec}
+
+        commands = []
+        if all(len(rules[chain]) == 1 for chain in Iptables.NAT_CHAINS):
+            # Existing rules -> Replace all of them in one transaction
+            for chain in Iptables.NAT_CHAINS:
+                commands.append(['-R', chain, str(rules[chain][0].num)] + specs[chain])
+        else:
+            # Missing or inconsistent rules -> Start from scratch
+            for chain in Iptables.NAT_CHAINS:
+                commands += self._delete_commands(chain, rules[chain])
+            for chain in Iptables.NAT_CHAINS:
+                commands.append(['-A', chain] + specs[chain])
+
+        self._restore('nat', commands)
+
+    def remove_dnat(self, prot: str, port: int):
+        """
+        Removes the DNAT/MASQUERADE rules of the given port
+        """
+        try:
+            comment = self._nat_comment(prot, port)
+            commands = []
+            for chain in Iptables.NAT_CHAINS:
+                commands += self._delete_commands(chain, self._get_nat_rules(chain, comment))
+            if len(commands) == 0:
+                return
+            self._restore('nat', commands)
+        except subprocess.SubprocessError:
+            self.log.warning('Could not remove NAT rules for ' + prot + ':' + str(port))
+
+    def forwarding_enabled(self) -> bool:
+        """
+        Checks if the kernel forwards packets for this stack
+        """
+        if self._stack == 6:
+            path = '/proc/sys/net/ipv6/conf/all/forwarding'
+        else:
+            path = '/proc/sys/net/ipv4/ip_forward'
+        try:
+            with open(path) as file:
+                return file.read().strip() == '1'
+        except OSError:
+            return False
+
+    def _get_nat_rules(self, chain: str, comment: str) -> List[Rule]:
+        out = self._execute(['-t', 'nat', '-L', chain, '-n', '--line-number'])
+        return [rule for rule in self._parse_table(out) if rule.comment == comment]
+
+    @staticmethod
+    def _delete_commands(chain: str, rules: List[Rule]) -> List[List[str]]:
+        # Delete from the bottom so the rule numbers stay valid
+        nums = sorted([rule.num for rule in rules], reverse=True)
+        return [['-D', chain, str(num)] for num in nums]
+
+    @staticmethod
+    def _nat_comment(prot: str, port: int) -> str:
+        return Iptables.NAT_COMMENT_PREFIX + prot + ':' + str(port)
+
+    @Trace.traced('iptables')
+    def _restore(self, table: str, commands: List[List[str]]):
+        """
+        Applies all commands in a single iptables-restore transaction
+        """
+        bin_name = self._bin_name() + '-restore'
+        lines = ['*' + table]
+        lines += [' '.join(command) for command in commands]
+        lines.append('COMMIT')
+
+        proc = Process([bin_name, '--noflush'])
+        proc.set_timeout(Iptables.TIMEOUT)
+        proc.collect_output()
+        proc.hide_output()
+        proc.stdin('\n'.join(lines) + '\n')
+        proc.run()
+
+    @Trace.traced('iptables')
     def _execute(self, args: List[str]) -> List[str]:
-        bin_name = 'ip6tables' if self._stack == 6 else 'iptables'
-        args.insert(0, bin_name)
+        args.insert(0, self._bin_name())
 
         proc = Process(args)
+        proc.set_timeout(Iptables.TIMEOUT)
         proc.collect_output()
         proc.hide_output()
         proc.run()
         return proc.get_out_lines()
 
+    def _bin_name(self) -> str:
+        return 'ip6tables' if self._stack == 6 else 'iptables'
+
+    @staticmethod
+    def _parse_destination(columns: List[str]) -> Optional[str]:
+        """
+        Returns the destination address of a listed rule, None if it matches all addresses
+        """
+        # The opt column is empty in the listing of ip6tables
+        index = 4 if columns[3] in ('--', '-f', '!f') else 3
+        if len(columns) <= index + 1:
+            return None
+        destination = columns[index + 1]
+        if destination in ('0.0.0.0/0', '::/0'):
+            return None
+        if destination.endswith('/32') or destination.endswith('/128'):
+            destination = destination[:destination.rindex('/')]
+        return destination
+
     def _parse_table(self, lines: List[str]) -> List[Rule]:
         rules = []
         for line in lines:
-            columns = re.split(" +", line)
+            comment = None
+            match = re.search(r'/\* (.*?) \*/', line)
+            if match is not None:
+                comment = match.group(1)
+                line = line[:match.start()] + line[match.end():]
+
+            columns = re.split(" +", line.strip())
             num = columns[0]
             if not num.isdigit():
                 continue
             num = int(num)
             target = columns[1]
             prot = columns[2]
-            last_col = columns[-1]
-            if 'dpt' not in last_col:
+            port_cols = [col for col in columns[3:] if 'dpt' in col]
+            if len(port_cols) == 0:
                 continue
 
-            parts = last_col.split(':', 2)
+            parts = port_cols[0].split(':', 2)
             port = int(parts[1])
-            rules.append(Rule(num, target, prot, port))
+            rules.append(Rule(num, target, prot, port, comment, self._parse_destination(columns)))
         return rules
@@ -0,0 +1,159 @@
+import struct
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from config.Config import RouteConfig
+from util.Loggable import Loggable
+
+
+class HostPeek:
+    """
+    Extracts the requested host name from the first bytes of a connection
+    (server name indication of a TLS ClientHello or the Host header of a HTTP request) without consuming them
+    """
+
+    HTTP_METHODS = (b'GET ', b'POST ', b'PUT ', b'HEAD ', b'DELETE ', b'OPTIONS ', b'PATCH ', b'CONNECT ',
+                    b'TRACE ')
+
+    MAX_HEADER_SIZE = 16384
+    """
+    Maximum number of bytes which are inspected
+    """
+
+    @staticmethod
+    def parse(data: bytes) -> Tuple[bool, Optional[str]]:
+        """
+        :param data: Bytes the client has sent so far
+        :return: (complete, host name). complete is False if more data is required to decide,
+        the host name is None if the data doesn't contain one
+        """
+        if len(data) == 0:
+            return False, None
+        if data[0] == 0x16:
+            return HostPeek._parse_tls(data)
+        if len(data) < 8 and any(method.startswith(data) for method in HostPeek.HTTP_METHODS):
+            return False, None
+        if data.startswith(HostPeek.HTTP_METHODS):
+            return HostPeek._parse_http(data)
+        return True, None
+
+    @staticmethod
+    def _parse_tls(data: bytes) -> Tuple[bool, Optional[str]]:
+        # Record header: type, version, length
+        if len(data) < 5:
+            return False, None
+        length = struct.unpack('!H', data[3:5])[0]
+        if len(data) < 5 + length and len(data) < HostPeek.MAX_HEADER_SIZE:
+            return False, None
+        try:
+            return True, HostPeek._parse_client_hello(data[5:5 + length])
+        except (IndexError, struct.error, UnicodeDecodeError):
+            return True, None
+
+    @staticmethod
+    def _parse_client_hello(data: bytes) -> Optional[str]:
+        if data[0] != 0x01:
+            # Not a ClientHello
+            return None
+        # Handshake header (4), client version (2), random (32)
+        offset = 4 + 2 + 32
+        offset += 1 + data[offset]
+        offset += 2 + struct.unpack('!H', data[offset:offset + 2])[0]
+        offset += 1 + data[offset]
+        end = offset + 2 + struct.unpack('!H', data[offset:offset + 2])[0]
+        offset += 2
+        while offset + 4 <= end:
+            ext_type, ext_length = struct.unpack('!HH', data[offset:offset + 4])
+            offset += 4
+            if ext_type == 0:
+                # server_name extension: list length, name type, name length, name
+                name_type = data[offset + 2]
+                name_length = struct.unpack('!H', data[offset + 3:offset + 5])[0]
+                if name_type != 0:
+                    return None
+                return data[offset + 5:offset + 5 + name_length].decode('ascii').lower()
+            offset += ext_length
+        return None
+
+    @staticmethod
+    def _parse_http(data: bytes) -> Tuple[bool, Optional[str]]:
+        end = data.find(b'\r\n\r\n')
+        if end < 0:
+            if len(data) < HostPeek.MAX_HEADER_SIZE:
+                return False, None
+            end = len(data)
+        for line in data[:end].split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() != b'host':
+                continue
+            host = value.strip().decode('ascii', 'replace').lower()
+            if host.startswith('['):
+                # IPv6 literal with optional port
+                return True, host[1:host.find(']')] if ']' in host else None
+            return True, host.split(':', 1)[0]
+        return True, None
+
+
+class MuxRouter(Loggable):
+    """
+    Maps the host names requested by the clients to the destinations of the routes of a multiplexed forward
+    """
+
+    def __init__(self, routes: List[RouteConfig], default_port: int):
+        """
+        :param routes: Routes of the forward
+        :param default_port: Destination port of routes which don't define their own
+        """
+        super().__init__('MuxRouter')
+        self._ports: Dict[str, int] = {}
+        for route in routes:
+            self._ports[route.match.lower()] = route.port if route.port is not None else default_port
+        self._addresses: Dict[str, str] = {}
+        """
+        Current destination ip per route (match pattern)
+        """
+        self._lock = threading.Lock()
+
+    def set_address(self, match: str, ip_addr: Optional[str]):
+        """
+        Sets the destination ip of a route, None if it is currently unknown
+        """
+        with self._lock:
+            # Copy on write, the relay thread reads without locking
+            addresses = dict(self._addresses)
+            if ip_addr is None:
+                addresses.pop(match.lower(), None)
+            else:
+                addresses[match.lower()] = ip_addr
+            self._addresses = addresses
+
+    def match(self, host: Optional[str]) -> Optional[str]:
+        """
+        Returns the pattern of the route which matches the host name:
+        Exact name, then the longest matching "*.domain" pattern, then "*"
+        """
+        if host is not None:
+            host = host.rstrip('.')
+            if host in self._ports:
+                return host
+            labels = host.split('.')
+            for i in range(1, len(labels)):
+                pattern = '*.' + '.'.join(labels[i:])
+                if pattern in self._ports:
+                    return pattern
+        if '*' in self._ports:
+            return '*'
+        return None
+
+    def select(self, host: Optional[str]) -> Optional[Tuple[str, int]]:
+        """
+        Returns the destination (ip, port) for the requested host name, None if no route matches
+        or the destination hasn't been resolved
+        """
+        pattern = self.match(host)
+        if pattern is None:
+            return None
+        ip_addr = self._addresses.get(pattern)
+        if ip_addr is None:
+            return None
+        return ip_addr, self._ports[pattern]
@@ -1,10 +1,12 @@
 import os
+import signal
 import subprocess
 import threading
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Union
 
 from util.Events import EventHook
 from util.Loggable import Loggable
+from util.Trace import Trace
 
 
 class AsyncStreamReader(Loggable):
@@ -56,14 +58,18 @@ class AsyncStreamReader(Loggable):
 
             self.log.debug('Read thread stopped')
 
-        self.__thread = threading.Thread(target=read_stream, name='stream-thread')
+        # A daemon, a grandchild which keeps the stream open must not block the exit
+        self.__thread = threading.Thread(target=read_stream, name='stream-thread', daemon=True)
         self.__thread.start()
 
-    def join(self):
+    def join(self, timeout: Optional[float] = None) -> bool:
         """
         Joins the read thread
+        :param timeout: Maximum time to wait in seconds, None to wait until the stream is closed
+        :return: True if the stream has been read completely
         """
-        self.__thread.join()
+        self.__thread.join(timeout)
+        return not self.__thread.is_alive()
 
     @staticmethod
     def decode_message(message: bytes) -> str:
@@ -108,12 +114,17 @@ class Process(Loggable):
         Process name and arguments for executing
         """
 
-        self.__timeout: int = 0
+        self.__timeout: float = 0
         """
         Timeout for the process to complete its execution in seconds.
         If the value is "0" the timeout will be disabled
         """
 
+        self.__kill_after: float = 5
+        """
+        Time in seconds a process gets to terminate after SIGTERM before it gets killed
+        """
+
         self.__process: Optional[subprocess.Popen] = None
         """
         The process object
@@ -125,8 +136,8 @@ class Process(Loggable):
         self.__collect_output: bool = False
         """ When True, the output will be redirected to a local variable"""
 
-        self.__env: Dict[str, str] = os.environ.copy()
-        """ Environment variables for the process"""
+        self.__env: Optional[Dict[str, str]] = None
+        """ Environment variables for the process, None to inherit the current environment"""
 
         self.__stdin: Optional[str] = None
         """ Commands that should be send to the stdin of the process after it was started"""
@@ -215,6 +226,61 @@ class Process(Loggable):
 
         self.__process.terminate()
 
+    def kill(self):
+        """
+        Kills the process without giving it the chance to clean up (or to forward the signal)
+        """
+        if self.__process is None:
+            return
+
+        self.__process.send_signal(signal.SIGKILL)
+
+    def get_pid(self) -> Optional[int]:
+        """
+        Returns the pid of the running process or None if it isn't running
+        """
+        process = self.__process
+        if process is None:
+            return None
+        return process.pid
+
+    @staticmethod
+    def get_child_pids(pid: int) -> List[int]:
+        """
+        Returns the pids of all direct children of the given process
+        """
+        children = []
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            stat = Process._read_stat(int(entry))
+            if stat is not None and int(stat[1]) == pid:
+                children.append(int(entry))
+        return children
+
+    @staticmethod
+    def is_alive(pid: int) -> bool:
+        """
+        Checks if the process with the given pid is still running (and not a zombie)
+        """
+        stat = Process._read_stat(pid)
+        return stat is not None and stat[0] != 'Z'
+
+    @staticmethod
+    def _read_stat(pid: int) -> Optional[List[str]]:
+        """
+        Reads /proc/<pid>/stat
+        :return: The fields after the process name (state, ppid, ...) or None if the process doesn't exist
+        """
+        try:
+            with open('/proc/' + str(pid) + '/stat') as file:
+                stat = file.read()
+        except OSError:
+            return None
+        # The process name can contain spaces and brackets
+        return stat[stat.rfind(')') + 2:].split(' ')
+
+    @Trace.traced('process')
     def run(self) -> int:
         """
         Executes the process in the current thread.
@@ -244,7 +310,18 @@ class Process(Loggable):
             self.__start_stdio_threads()
 
         # Wait for the process to complete
-        self.__process.wait()
+        timed_out = False
+        try:
+            self.__process.wait(timeout=self.__timeout if self.__timeout > 0 else None)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            self.log.warning(self.__process_args[0] + ' did not complete within ' + str(self.__timeout) + 's')
+            self.__process.terminate()
+            try:
+                self.__process.wait(timeout=self.__kill_after)
+            except subprocess.TimeoutExpired:
+                self.__process.kill()
+                self.__process.wait()
         result = self.__process.poll()
         self.log.debug('Process completed with code ' + str(result))
 
@@ -252,10 +329,104 @@ class Process(Loggable):
         self.__process = None
 
         if pipe_stdio:
-            # Only join stdio threads if they were started in the first place
-            self.__stderr_reader.join()
-            self.__stdout_reader.join()
+            # Only join stdio threads if they were started in the first place.
+            # After a timeout a grandchild might still hold the pipes open -> Don't wait for it forever
+            join_timeout = self.__kill_after if timed_out else None
+            closed = [reader.join(join_timeout) for reader in (self.__stderr_reader, self.__stdout_reader)]
+            if not all(closed):
+                self.log.warning('Output of ' + self.__process_args[0] + ' is still open, not waiting for it')
+
+        if timed_out:
+            raise subprocess.TimeoutExpired(self.__process_args, self.__timeout, self.out, self.err)
+        return self.__check_result(result)
+
+    async def run_async(self) -> int:
+        """
+        Executes the process using an asyncio subprocess.
+        The output is collected/printed once the process completed.
+        :return int process result
+        :raises subprocess.TimeoutExpired: If the timeout is exceeded. The process is terminated,
+        and killed if it doesn't terminate within the kill grace time.
+        :raises subprocess.SubprocessError: Gets raised when the result of the process was not 0
+        and "ignore_errors" was not called
+        """
+        # Only loaded if used, asyncio is slow to import
+        import asyncio
+
+        self.log.info('Starting ' + self.__process_args[0])
+        pipe_stdio = self.__collect_output or self._print_output
+        stdio = subprocess.PIPE if pipe_stdio else subprocess.DEVNULL
+        stdin = subprocess.PIPE if self.__stdin is not None else subprocess.DEVNULL
+        kwargs = {'stdout': stdio, 'stderr': stdio, 'stdin': stdin,
+                  'env': self.__env, 'cwd': self.__working_directory}
+        if self.__use_shell:
+            process = await asyncio.create_subprocess_shell(' '.join(self.__process_args), **kwargs)
+        else:
+            process = await asyncio.create_subprocess_exec(*self.__process_args, **kwargs)
+
+        stdin_data = None
+        if self.__stdin is not None:
+            stdin_data = AsyncStreamReader.encode_message(self.__stdin)
+
+        try:
+            out, err = await asyncio.wait_for(process.communicate(stdin_data),
+                                              self.__timeout if self.__timeout > 0 else None)
+        except asyncio.TimeoutError:
+            self.log.warning(self.__process_args[0] + ' did not complete within ' + str(self.__timeout) + 's')
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), self.__kill_after)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+            raise subprocess.TimeoutExpired(self.__process_args, self.__timeout)
+
+        for data, is_err in ((out, False), (err, True)):
+            if data is None:
+                continue
+            text = AsyncStreamReader.decode_message(data)
+            if self._print_output:
+                for line in text.splitlines():
+                    if is_err:
+                        self.log.error(line.strip())
+                    else:
+                        self.log.info(line.strip())
+            if self.__collect_output:
+                if is_err:
+                    self.err += text
+                else:
+                    self.out += text
+
+        self.log.debug('Process completed with code ' + str(process.returncode))
+        return self.__check_result(process.returncode)
+
+    @staticmethod
+    def run_all(processes: List['Process'], limit: int = 8) -> List[Union[int, Exception]]:
+        """
+        Runs the processes concurrently, with at most "limit" processes at the same time.
+        Must not be called from a running event loop.
+        :param processes: Processes which should be executed
+        :param limit: Maximum number of concurrently running processes
+        :return: Result code or raised exception of each process, in the order of the given processes
+        """
+        import asyncio
+
+        async def run_limited(semaphore: asyncio.Semaphore, process: Process) -> int:
+            async with semaphore:
+                return await process.run_async()
+
+        async def run():
+            semaphore = asyncio.Semaphore(limit)
+            return await asyncio.gather(*[run_limited(semaphore, process) for process in processes],
+                                        return_exceptions=True)
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(run())
+        finally:
+            loop.close()
 
+    def __check_result(self, result: int) -> int:
         if not self.__ignore_errors and result != 0:
             if self.__collect_output:
                 raise subprocess.SubprocessError(
@@ -264,14 +435,16 @@ class Process(Loggable):
             raise subprocess.SubprocessError('Process returned ' + str(result))
         return result
 
-    def set_timeout(self, timeout: int):
+    def set_timeout(self, timeout: float, kill_after: float = 5):
         """
         Sets the maximum execution time the process can run before being
         gracefully stopped
 
         :param timeout: timeout in seconds
+        :param kill_after: time in seconds the process gets to terminate before it is killed
         """
         self.__timeout = timeout
+        self.__kill_after = kill_after
 
     def set_environment(self, param: Dict[str, str]):
         """
@@ -281,6 +454,9 @@ class Process(Loggable):
 
         :param param: dict with environment variables
         """
+        if self.__env is None:
+            # Only copy the environment if it is actually modified
+            self.__env = os.environ.copy()
         self.__env.update(param)
 
     def set_working_directory(self, path: str):
@@ -295,7 +471,7 @@ class Process(Loggable):
         Prints the arguments of the process and the current environment variables
         """
         self.log.debug(str(self.__process_args))
-        self.log.debug(self.__env)
+        self.log.debug(self.__env if self.__env is not None else os.environ)
 
     def print_args(self):
         """
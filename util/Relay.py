@@ -0,0 +1,689 @@
+import errno
+import heapq
+import itertools
+import math
+import os
+import select
+import socket
+import threading
+from time import time, perf_counter, monotonic
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from config.Config import PortConfig
+from util.ConnectionLog import ConnectionLog, ConnectionRecord
+from util.Loggable import Loggable
+from util.Mux import HostPeek, MuxRouter
+from util.Shaper import Shaper
+from util.Trace import Trace
+
+
+class BufferPool:
+    """
+    Preallocated relay buffers which are handed out as memoryview slices
+    of a few large bytearrays. This avoids allocating a new bytes object for every recv.
+    """
+
+    def __init__(self, buffer_size: int, grow_count: int = 32):
+        """
+        :param buffer_size: Size of a single buffer in bytes
+        :param grow_count: Number of buffers which are allocated at once if the pool is exhausted
+        """
+        self.buffer_size: int = buffer_size
+        self._grow_count: int = grow_count
+        self._chunks: List[bytearray] = []
+        self._free: List[memoryview] = []
+        self._lock = threading.Lock()
+        self._grow()
+
+    def acquire(self) -> memoryview:
+        with self._lock:
+            if len(self._free) == 0:
+                self._grow()
+            return self._free.pop()
+
+    def release(self, buffer: memoryview):
+        with self._lock:
+            self._free.append(buffer)
+
+    def get_allocated(self) -> int:
+        """
+        Returns the total number of allocated buffers
+        """
+        return len(self._chunks) * self._grow_count
+
+    def _grow(self):
+        chunk = bytearray(self.buffer_size * self._grow_count)
+        self._chunks.append(chunk)
+        view = memoryview(chunk)
+        for i in range(self._grow_count):
+            self._free.append(view[i * self.buffer_size:(i + 1) * self.buffer_size])
+
+
+class TimerHeap:
+    """
+    Binary heap of deadlines.
+    Entries are never moved or removed when a deadline changes, the owner checks popped entries
+    and pushes them again if they are not due anymore (lazy invalidation).
+    This keeps I/O free of timer operations and every item has at most one entry.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, Any]] = []
+        self._counter = itertools.count()
+        """
+        Tie breaker for equal deadlines, the items don't have to be comparable
+        """
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, due: float, item: Any):
+        heapq.heappush(self._heap, (due, next(self._counter), item))
+
+    def next_due(self) -> Optional[float]:
+        """
+        Returns the earliest deadline, None if the heap is empty
+        """
+        return self._heap[0][0] if len(self._heap) > 0 else None
+
+    def pop_due(self, now: float) -> Optional[Any]:
+        """
+        Removes and returns an item whose deadline has passed, None if there is none
+        """
+        if len(self._heap) == 0 or self._heap[0][0] > now:
+            return None
+        return heapq.heappop(self._heap)[2]
+
+    def retain(self, keep: Set[Any]):
+        """
+        Drops the entries of all items which are not in the given set
+        """
+        self._heap = [entry for entry in self._heap if entry[2] in keep]
+        heapq.heapify(self._heap)
+
+
+class Pipe:
+    """
+    One direction of a relayed connection
+    """
+
+    def __init__(self, src: Optional[socket.socket], dst: Optional[socket.socket], buffer: memoryview):
+        self.src: Optional[socket.socket] = src
+        self.dst: Optional[socket.socket] = dst
+        self.buffer: memoryview = buffer
+        self.start: int = 0
+        """
+        Offset of the first byte in the buffer which has not been sent yet
+        """
+        self.end: int = 0
+        """
+        Offset after the last received byte in the buffer
+        """
+        self.eof: bool = False
+        """
+        True once the source has closed its side
+        """
+        self.shut: bool = False
+        """
+        True once the end of the stream has been passed on to the destination
+        """
+        self.bytes: int = 0
+        """
+        Number of transferred bytes
+        """
+        self.throttled: bool = False
+        """
+        True while reading is paused by the bandwidth limit
+        """
+
+    def pending(self) -> bool:
+        return self.end > self.start
+
+
+class Connection:
+    """
+    A relayed connection between a client and the upstream
+    """
+
+    def __init__(self, client: socket.socket, client_addr: Tuple, pool: BufferPool, now: float):
+        self.client: socket.socket = client
+        self.client_addr: Tuple = client_addr
+        self.upstream: Optional[socket.socket] = None
+        """
+        Upstream socket, None until the destination has been chosen
+        """
+        self.upstream_addr: str = ''
+        self.upstream_port: int = 0
+        self.start: float = time()
+        """
+        Unix timestamp of the accept
+        """
+        self.opened: float = now
+        """
+        Monotonic time of the accept
+        """
+        self.active: float = now
+        """
+        Monotonic time of the last event
+        """
+        self.connected: bool = False
+        """
+        True once the upstream connection has been established
+        """
+        self.outbound = Pipe(client, None, pool.acquire())
+        self.inbound = Pipe(None, client, pool.acquire())
+        self.events = {client: 0}
+        """
+        Currently registered selector events per socket
+        """
+
+    def set_upstream(self, upstream: socket.socket, address: str, port: int):
+        self.upstream = upstream
+        self.upstream_addr = address
+        self.upstream_port = port
+        self.outbound.dst = upstream
+        self.inbound.src = upstream
+        self.events[upstream] = 0
+
+    def finished(self) -> bool:
+        """
+        Returns True once both sides have closed and all data has been passed on
+        """
+        return self.outbound.shut and self.inbound.shut
+
+
+class Relay(Loggable):
+    """
+    Native TCP relay which forwards connections from a local port to the destination.
+    All connections of the relay are served by a single selector thread.
+    With a router, the destination of each connection is chosen by the host name the client requests.
+    """
+
+    DEFAULT_BUFFER_SIZE = 16384
+
+    READS_PER_EVENT = 16
+    """
+    Maximum number of reads from one socket per selector event
+    """
+
+    def __init__(self, src_stack: int, src_port: int, dst_stack: int, dst_port: int,
+                 buffer_size: int = DEFAULT_BUFFER_SIZE, shaper: Optional[Shaper] = None,
+                 connection_log: Optional[ConnectionLog] = None, bind_address: Optional[str] = None,
+                 router: Optional[MuxRouter] = None, idle_timeout: float = 0, max_lifetime: float = 0):
+        """
+        :param src_stack: IP stack of the listening socket (4, 6 or dual)
+        :param src_port: Listening port
+        :param dst_stack: IP stack of the destination (4 or 6)
+        :param dst_port: Destination port
+        :param buffer_size: Size of the per connection and direction buffer in bytes
+        :param shaper: Optional bandwidth limit
+        :param connection_log: Optional export of the closed connections
+        :param bind_address: Local address to listen on, None for the wildcard address
+        :param router: Chooses the destination by the requested host name (TLS SNI / HTTP Host),
+        the destination address is not used if set
+        :param idle_timeout: Seconds without any event after which a connection is closed, 0 to disable
+        :param max_lifetime: Seconds after which a connection is closed in any case, 0 to disable
+        """
+        super().__init__('Relay')
+        self._src_stack: int = src_stack
+        self._src_port: int = src_port
+        self._bind_address: str = bind_address or ''
+        self._dst_family: int = socket.AF_INET6 if dst_stack == 6 else socket.AF_INET
+        self._dst_port: int = dst_port
+        self._dst_address: Optional[str] = None
+        self._router: Optional[MuxRouter] = router
+
+        self._pool = BufferPool(buffer_size)
+        self._poller = select.epoll()
+        self._sockets: Dict[int, Tuple[Optional[Connection], socket.socket]] = {}
+        """
+        Registered sockets and their connection (None for the listener and the wakeup socket) by file descriptor
+        """
+        self._listener: Optional[socket.socket] = None
+        self._connections: Set[Connection] = set()
+        self._shaper: Optional[Shaper] = shaper
+        self._throttled: Set[Connection] = set()
+        """
+        Connections with at least one direction paused by the bandwidth limit
+        """
+        self._connection_log: Optional[ConnectionLog] = connection_log
+        self._idle_timeout: float = idle_timeout
+        self._max_lifetime: float = max_lifetime
+        self._timers = TimerHeap()
+        """
+        Next deadline (idle or lifetime) of every connection if a timeout is configured
+        """
+        self._now: float = monotonic()
+        """
+        Time of the current selector round
+        """
+        self._name: str = ''
+        """
+        Name of the forward in the connection records
+        """
+        self._thread: Optional[threading.Thread] = None
+
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._commands: List[str] = []
+        """
+        Commands for the relay thread (stop_accepting, stop)
+        """
+
+    def set_destination(self, ip_addr: str):
+        """
+        Sets the destination address for new connections.
+        Open connections are not affected.
+        """
+        self._dst_address = ip_addr
+
+    def get_family(self) -> int:
+        return socket.AF_INET if self._src_stack == 4 else socket.AF_INET6
+
+    def start(self, listener: Optional[socket.socket] = None):
+        """
+        Starts the relay
+        :param listener: Already bound listening socket (socket activation / handover),
+        a new one is created if not set
+        """
+        if listener is None:
+            listener = socket.socket(self.get_family(), socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self._src_stack == PortConfig.STACK_DUAL:
+                # IPv4 clients are accepted as IPv4 mapped addresses
+                listener.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            listener.bind((self._bind_address, self._src_port))
+            listener.listen(socket.SOMAXCONN)
+        self._listener = listener
+        self._listener.setblocking(False)
+        self._name = 'tcp:' + PortConfig.get_stack_name(self._src_stack) + ':' + str(self.get_port())
+
+        self._register(self._listener, select.EPOLLIN, None)
+        self._wakeup_recv.setblocking(False)
+        self._register(self._wakeup_recv, select.EPOLLIN, None)
+
+        self._thread = threading.Thread(target=self._run, name='relay-' + str(self._src_port), daemon=True)
+        self._thread.start()
+
+    def stop_accepting(self):
+        """
+        Closes the listening socket, open connections are kept
+        """
+        self._send_command('stop_accepting')
+
+    def stop(self):
+        """
+        Closes the listening socket and all connections
+        """
+        self._send_command('stop')
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def active_connections(self) -> int:
+        return len(self._connections)
+
+    def kill_connections(self) -> int:
+        """
+        Closes all open connections
+        :return: Number of closed connections
+        """
+        count = len(self._connections)
+        self.stop()
+        return count
+
+    def get_listener(self) -> Optional[socket.socket]:
+        """
+        Returns the listening socket, None if it has been closed
+        """
+        if self._listener is None or self._listener.fileno() < 0:
+            return None
+        return self._listener
+
+    def get_port(self) -> int:
+        """
+        Returns the port the relay is listening on
+        """
+        return self._listener.getsockname()[1]
+
+    def _send_command(self, command: str):
+        self._commands.append(command)
+        try:
+            self._wakeup_send.send(b'\0')
+        except OSError:
+            pass
+
+    def _run(self):
+        while True:
+            timeout = None
+            if len(self._throttled) > 0:
+                timeout = max(0.001, self._shaper.delay())
+            next_due = self._timers.next_due()
+            if next_due is not None:
+                due_in = max(0.0, next_due - monotonic())
+                timeout = due_in if timeout is None else min(timeout, due_in)
+            # The sockets are looked up before handling any event, a handler may close a socket
+            # and a new one may get the same file descriptor in the same round
+            sockets = self._sockets
+            events = [(sockets.get(fd), event) for fd, event in self._poller.poll(-1 if timeout is None else timeout)]
+            self._now = monotonic()
+            start = perf_counter() if Trace.enabled else 0
+            for registered, event in events:
+                if registered is None:
+                    continue
+                conn, sock = registered
+                if conn is not None:
+                    if event & ~(select.EPOLLIN | select.EPOLLOUT):
+                        # Errors and hang ups are handled by the registered read / write handlers
+                        event = conn.events.get(sock, 0)
+                    self._handle(conn, sock, event)
+                elif sock is self._listener:
+                    self._accept()
+                elif not self._handle_commands():
+                    self._close_all()
+                    return
+            if len(self._throttled) > 0:
+                self._resume_throttled()
+            if next_due is not None:
+                self._close_expired()
+            if start > 0:
+                Trace.add('Relay.events', 'relay', start, perf_counter() - start, {'events': len(events)})
+
+    def _resume_throttled(self):
+        if self._shaper.allowance() < self._shaper.min_chunk:
+            return
+        throttled = self._throttled
+        self._throttled = set()
+        for conn in throttled:
+            if conn not in self._connections:
+                continue
+            conn.outbound.throttled = False
+            conn.inbound.throttled = False
+            self._update(conn)
+
+    def _get_deadline(self, conn: Connection) -> float:
+        deadline = math.inf
+        if self._idle_timeout > 0:
+            deadline = conn.active + self._idle_timeout
+        if self._max_lifetime > 0:
+            deadline = min(deadline, conn.opened + self._max_lifetime)
+        return deadline
+
+    def _close_expired(self):
+        while True:
+            conn = self._timers.pop_due(self._now)
+            if conn is None:
+                return
+            if conn not in self._connections:
+                continue
+            deadline = self._get_deadline(conn)
+            if deadline > self._now:
+                # There has been activity since the entry was added
+                self._timers.push(deadline, conn)
+                continue
+            expired = 0 < self._max_lifetime <= self._now - conn.opened
+            self.log.debug('Closing ' + ('expired' if expired else 'idle') + ' connection from ' + str(conn.client_addr))
+            self._close(conn)
+
+    def _handle_commands(self) -> bool:
+        """
+        :return: False if the relay should stop
+        """
+        try:
+            self._wakeup_recv.recv(1024)
+        except BlockingIOError:
+            pass
+        while len(self._commands) > 0:
+            command = self._commands.pop(0)
+            self._close_listener()
+            if command == 'stop':
+                return False
+        return True
+
+    def _close_listener(self):
+        if self._listener is None or self._listener.fileno() < 0:
+            return
+        self._unregister(self._listener)
+        self._listener.close()
+
+    def _close_all(self):
+        for conn in list(self._connections):
+            self._close(conn)
+        self._unregister(self._wakeup_recv)
+        self._poller.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+
+    def _accept(self):
+        while self._listener.fileno() >= 0:
+            try:
+                client, client_addr = self._listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.log.warning('Could not accept connection: ' + str(e))
+                return
+
+            if self._dst_address is None and self._router is None:
+                client.close()
+                continue
+
+            client.setblocking(False)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(client, client_addr, self._pool, self._now)
+            self._connections.add(conn)
+            if self._idle_timeout > 0 or self._max_lifetime > 0:
+                self._timers.push(self._get_deadline(conn), conn)
+            if self._router is None and not self._connect(conn, self._dst_address, self._dst_port):
+                continue
+            # Routed connections wait for the requested host name first
+            self._update(conn)
+
+    def _connect(self, conn: Connection, address: str, port: int) -> bool:
+        """
+        Starts connecting to the upstream
+        :return: False if the connection failed and has been closed
+        """
+        upstream = socket.socket(self._dst_family, socket.SOCK_STREAM)
+        upstream.setblocking(False)
+        upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.set_upstream(upstream, address, port)
+        err = upstream.connect_ex((address, port))
+        if err != 0 and err != errno.EINPROGRESS:
+            self.log.warning('Could not connect to ' + address + ': ' + os.strerror(err))
+            self._close(conn)
+            return False
+        return True
+
+    def _route(self, conn: Connection) -> bool:
+        """
+        Reads the first bytes of the client until the requested host name is known,
+        then connects to the destination of the matching route.
+        The bytes are kept in the outbound buffer and sent once the upstream is connected.
+        :return: False if the connection has been closed
+        """
+        pipe = conn.outbound
+        try:
+            received = pipe.src.recv_into(pipe.buffer[pipe.end:])
+        except (BlockingIOError, InterruptedError):
+            return True
+        if received == 0:
+            self._close(conn)
+            return False
+        if self._shaper is not None:
+            self._shaper.consume(received)
+        pipe.end += received
+        pipe.bytes += received
+
+        complete, host = HostPeek.parse(bytes(pipe.buffer[:pipe.end]))
+        if not complete and pipe.end < len(pipe.buffer):
+            return True
+
+        destination = self._router.select(host)
+        if destination is None:
+            self.log.debug('No route for host ' + str(host) + ' requested by ' + str(conn.client_addr))
+            self._close(conn)
+            return False
+        return self._connect(conn, destination[0], destination[1])
+
+    def _handle(self, conn: Connection, sock: socket.socket, mask: int):
+        if conn not in self._connections:
+            # Closed by an earlier event of the same select call
+            return
+        conn.active = self._now
+        try:
+            if conn.upstream is None:
+                if not self._route(conn):
+                    return
+            elif sock is conn.upstream and not conn.connected:
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err != 0:
+                    raise OSError(err, os.strerror(err))
+                conn.connected = True
+            else:
+                if sock is conn.client:
+                    src, dst = conn.outbound, conn.inbound
+                else:
+                    src, dst = conn.inbound, conn.outbound
+                if mask & select.EPOLLIN:
+                    self._read(conn, src)
+                    if mask == select.EPOLLIN and src.end == 0 and not src.eof and not src.throttled:
+                        # Everything has been forwarded right away (the common case of small messages)
+                        # -> The registered events are still the same
+                        return
+                if mask & select.EPOLLOUT:
+                    self._flush(dst)
+                self._shutdown_if_done(conn.outbound)
+                self._shutdown_if_done(conn.inbound)
+        except OSError as e:
+            self.log.debug('Connection from ' + str(conn.client_addr) + ' failed: ' + str(e))
+            self._close(conn)
+            return
+
+        if conn.finished():
+            self._close(conn)
+        else:
+            self._update(conn)
+
+    def _read(self, conn: Connection, pipe: Pipe):
+        # Keep reading while the data can be forwarded right away to save selector round trips
+        for _ in range(Relay.READS_PER_EVENT):
+            size = len(pipe.buffer)
+            if self._shaper is not None:
+                size = min(size, self._shaper.allowance())
+                if size < self._shaper.min_chunk:
+                    # Bandwidth limit reached -> Pause reading until enough tokens are available
+                    pipe.throttled = True
+                    self._throttled.add(conn)
+                    return
+
+            try:
+                received = pipe.src.recv_into(pipe.buffer, size)
+            except (BlockingIOError, InterruptedError):
+                return
+            if received == 0:
+                pipe.eof = True
+                return
+            if self._shaper is not None:
+                self._shaper.consume(received)
+            pipe.start = 0
+            pipe.end = received
+            pipe.bytes += received
+            self._flush(pipe)
+            if pipe.end > 0 or received < size:
+                return
+
+    @staticmethod
+    def _shutdown_if_done(pipe: Pipe):
+        """
+        Passes the end of the stream on once the source has closed and everything has been sent,
+        the other direction keeps working (half-close)
+        """
+        if pipe.eof and not pipe.shut and not pipe.pending():
+            pipe.dst.shutdown(socket.SHUT_WR)
+            pipe.shut = True
+
+    @staticmethod
+    def _flush(pipe: Pipe):
+        start = pipe.start
+        end = pipe.end
+        while start < end:
+            try:
+                # Slicing a memoryview doesn't copy the data
+                start += pipe.dst.send(pipe.buffer[start:end])
+            except (BlockingIOError, InterruptedError):
+                pipe.start = start
+                return
+        pipe.start = 0
+        pipe.end = 0
+
+    def _update(self, conn: Connection):
+        """
+        Registers the selector events the connection is currently interested in
+        """
+        outbound = conn.outbound
+        inbound = conn.inbound
+        if conn.upstream is None:
+            # Waiting for the requested host name
+            self._set_events(conn, conn.client, select.EPOLLIN)
+            return
+        if conn.connected:
+            client_events = 0
+            if not outbound.eof and not outbound.pending() and not outbound.throttled:
+                client_events |= select.EPOLLIN
+            if inbound.pending():
+                client_events |= select.EPOLLOUT
+
+            upstream_events = 0
+            if not inbound.eof and not inbound.pending() and not inbound.throttled:
+                upstream_events |= select.EPOLLIN
+            if outbound.pending():
+                upstream_events |= select.EPOLLOUT
+        else:
+            client_events = 0
+            upstream_events = select.EPOLLOUT
+
+        self._set_events(conn, conn.client, client_events)
+        self._set_events(conn, conn.upstream, upstream_events)
+
+    def _set_events(self, conn: Connection, sock: socket.socket, events: int):
+        current = conn.events[sock]
+        if current == events:
+            return
+        if current == 0:
+            self._register(sock, events, conn)
+        elif events == 0:
+            self._unregister(sock)
+        else:
+            self._poller.modify(sock.fileno(), events)
+        conn.events[sock] = events
+
+    def _register(self, sock: socket.socket, events: int, conn: Optional[Connection]):
+        self._poller.register(sock.fileno(), events)
+        self._sockets[sock.fileno()] = (conn, sock)
+
+    def _unregister(self, sock: socket.socket):
+        self._poller.unregister(sock.fileno())
+        del self._sockets[sock.fileno()]
+
+    def _close(self, conn: Connection):
+        if conn not in self._connections:
+            return
+        self._connections.remove(conn)
+        self._throttled.discard(conn)
+        if len(self._timers) > 2 * len(self._connections) + 1024:
+            # Entries of closed connections are only dropped once they are due, don't let them pile up
+            self._timers.retain(self._connections)
+        for sock in conn.events:
+            if conn.events[sock] != 0:
+                self._unregister(sock)
+                conn.events[sock] = 0
+            sock.close()
+        self._pool.release(conn.outbound.buffer)
+        self._pool.release(conn.inbound.buffer)
+        if self._connection_log is not None:
+            client_ip = conn.client_addr[0]
+            if client_ip.startswith('::ffff:') and '.' in client_ip:
+                # IPv4 client of a dual stack listener
+                client_ip = client_ip[7:]
+            self._connection_log.add(ConnectionRecord(self._name, client_ip, conn.client_addr[1],
+                                                      conn.upstream_addr, conn.upstream_port, conn.start, time(),
+                                                      conn.outbound.bytes, conn.inbound.bytes))
@@ -0,0 +1,120 @@
+import threading
+from time import monotonic
+from typing import Optional
+
+from config.Config import LimitConfig
+
+
+class TokenBucket:
+    """
+    Token bucket with one token per byte
+    """
+
+    def __init__(self, rate: float, burst: float, reserve: float = 0):
+        """
+        :param rate: Tokens (bytes) per second
+        :param burst: Maximum number of tokens
+        :param reserve: Fraction of the burst which is reserved for interactive consumers
+        """
+        self.rate: float = rate
+        self.burst: float = burst
+        self.reserved: float = burst * reserve
+        """
+        Number of tokens only interactive consumers may use
+        """
+        self._tokens: float = burst
+        self._last: float = monotonic()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(config: Optional[LimitConfig]) -> Optional['TokenBucket']:
+        if config is None:
+            return None
+        return TokenBucket(config.rate, config.burst, config.reserve)
+
+    def available(self, interactive: bool = True) -> int:
+        """
+        Returns the number of tokens which can be consumed right now.
+        Bulk consumers can't use the reserved tokens.
+        """
+        with self._lock:
+            self._refill()
+            tokens = self._tokens if interactive else self._tokens - self.reserved
+            return max(0, int(tokens))
+
+    def consume(self, count: int):
+        with self._lock:
+            self._refill()
+            self._tokens -= count
+
+    def delay(self, count: int, interactive: bool = True) -> float:
+        """
+        Returns the time in seconds until the given number of tokens is available
+        """
+        with self._lock:
+            self._refill()
+            missing = count - self._tokens
+            if not interactive:
+                missing += self.reserved
+            return max(0.0, missing / self.rate)
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+
+class Shaper:
+    """
+    Bandwidth limit of a single forward, optionally sharing a global limit with other forwards
+    """
+
+    PRIORITY_INTERACTIVE = 'interactive'
+    PRIORITY_BULK = 'bulk'
+
+    MIN_CHUNK = 4096
+    """
+    Reads are postponed until at least this many bytes may be read, which avoids tiny reads
+    """
+
+    def __init__(self, bucket: Optional[TokenBucket], global_bucket: Optional[TokenBucket], priority: str):
+        """
+        :param bucket: Limit of the forward
+        :param global_bucket: Limit shared by all forwards
+        :param priority: Priority class of the forward (interactive or bulk)
+        """
+        self._buckets = [b for b in (bucket, global_bucket) if b is not None]
+        self._global_bucket: Optional[TokenBucket] = global_bucket
+        self._interactive: bool = priority == Shaper.PRIORITY_INTERACTIVE
+        self.min_chunk: int = int(min([Shaper.MIN_CHUNK] + [b.burst for b in self._buckets]))
+        if global_bucket is not None and not self._interactive:
+            # Bulk traffic never gets the reserved part of the global bucket
+            self.min_chunk = int(min(self.min_chunk, global_bucket.burst - global_bucket.reserved))
+        # A read of 0 bytes would look like the end of the stream
+        self.min_chunk = max(1, self.min_chunk)
+
+    def allowance(self) -> int:
+        """
+        Returns the number of bytes which may be read right now
+        """
+        return min(self._available(bucket) for bucket in self._buckets)
+
+    def consume(self, count: int):
+        for bucket in self._buckets:
+            bucket.consume(count)
+
+    def delay(self) -> float:
+        """
+        Returns the time in seconds until the next read of at least min_chunk bytes is allowed
+        """
+        return max(self._delay(bucket) for bucket in self._buckets)
+
+    def _available(self, bucket: TokenBucket) -> int:
+        if bucket is self._global_bucket:
+            return bucket.available(self._interactive)
+        return bucket.available()
+
+    def _delay(self, bucket: TokenBucket) -> float:
+        if bucket is self._global_bucket:
+            return bucket.delay(self.min_chunk, self._interactive)
+        return bucket.delay(self.min_chunk)
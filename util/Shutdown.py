@@ -0,0 +1,75 @@
+import threading
+from time import perf_counter
+from typing import List
+
+from util.Iptables import Iptables
+from util.Loggable import Loggable
+from util.Tunnel import Tunnel
+
+
+class GracefulShutdown(Loggable):
+    """
+    Stops all tunnels while giving open connections time to finish
+    """
+
+    POLL_INTERVAL = 0.2
+    """
+    Interval in seconds in which the open connections are counted while draining
+    """
+
+    def __init__(self, tunnels: List[Tunnel], deadline: float):
+        """
+        :param tunnels: Tunnels which should be stopped
+        :param deadline: Maximum time in seconds open connections are waited for
+        """
+        super().__init__('Shutdown')
+        self._tunnels: List[Tunnel] = tunnels
+        self._deadline: float = deadline
+        self._forced = threading.Event()
+
+    def force(self):
+        """
+        Skips the remaining drain time, open connections are terminated immediately
+        """
+        self.log.warning('Forcing shutdown')
+        self._forced.set()
+
+    def run(self, remove_firewall: bool = True):
+        """
+        Runs the shutdown sequence. Blocks until all connections are closed,
+        the deadline is reached or "force" is called.
+        :param remove_firewall: False if the firewall rules should be kept
+        """
+        start = perf_counter()
+        for tunnel in self._tunnels:
+            tunnel.stop_accepting(remove_firewall)
+
+        if remove_firewall:
+            self._remove_firewall_rules()
+
+        active = self._active_connections()
+        if active > 0:
+            self.log.info('Waiting up to ' + str(self._deadline) + 's for ' + str(active) + ' connections')
+        end = start + self._deadline
+        while active > 0 and perf_counter() < end:
+            if self._forced.wait(GracefulShutdown.POLL_INTERVAL):
+                break
+            active = self._active_connections()
+
+        killed = 0
+        for tunnel in self._tunnels:
+            killed += tunnel.kill_connections()
+            tunnel.stop(remove_firewall=False)
+
+        self.log.info('Shutdown completed in ' + str(round(perf_counter() - start, 3)) + 's, ' +
+                      str(killed) + ' connections killed')
+
+    def _active_connections(self) -> int:
+        return sum(tunnel.active_connections() for tunnel in self._tunnels)
+
+    def _remove_firewall_rules(self):
+        # One batch per stack instead of one listing per tunnel
+        for stack, entries in Tunnel.get_firewall_entries(self._tunnels).items():
+            firewall = Iptables.get(stack)
+            if firewall is not None:
+                firewall.remove_entries(entries)
@@ -1,12 +1,17 @@
 from __future__ import annotations
 
+import os
+import signal
+import subprocess
 import threading
-from typing import Optional
+from typing import Optional, List
 
+from config.Config import PortConfig
+from util.Loggable import Loggable
 from util.Process import Process
 
 
-class Socat:
+class Socat(Loggable):
     """
     Wrapper for the socat binary
     """
@@ -17,18 +22,49 @@ class Socat:
     STACK_IPV_4 = 4
     STACK_IPV_6 = 6
 
-    def __init__(self, prot: int, src_stack: int, src_port: int, dst_stack: int, dst_port: int, dst_address: str):
+    RESTART_DELAY = 1
+    """
+    Seconds until socat is restarted after it terminated unexpectedly (e.g. the port is still in use
+    by the instance we are replacing), doubled for every failed attempt
+    """
+
+    MAX_RESTART_DELAY = 30
+
+    def __init__(self, prot: int, src_stack: int, src_port: int, dst_stack: int, dst_port: int, dst_address: str,
+                 src_bind: Optional[str] = None, idle_timeout: float = 0):
+        super().__init__('Socat')
         self._prot: int = prot
         self._src_stack: int = src_stack
         self._src_port: int = src_port
+        self._src_bind: Optional[str] = src_bind
         self._dst_stack: int = dst_stack
         self._dst_port: int = dst_port
         self._dst_address: str = dst_address
+        self._idle_timeout: float = idle_timeout
+        """
+        Seconds without any transferred data after which a forked connection process exits, 0 to disable
+        """
 
         self._proc: Optional[Process] = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+        self._connection_pids: List[int] = []
+        """
+        Forked socat processes which serve the connections accepted before stop_accepting was called
+        """
 
     def start(self):
+        with self._lock:
+            self._stopped.clear()
+            self._proc = self._create_process()
+            self._proc.print_args()
+            threading.Thread(target=self._start_socat, args=(self._proc,)).start()
+
+    def _create_process(self) -> Process:
         args = ['socat']
+        if self._idle_timeout > 0:
+            args += ['-T', str(self._idle_timeout)]
 
         if self._prot == Socat.PROT_TCP:
             prot_str = 'TCP'
@@ -36,8 +72,19 @@ class Socat:
             prot_str = 'UDP'
 
         src = prot_str
-        src += str(self._src_stack) + '-LISTEN'
+        if self._src_stack == PortConfig.STACK_DUAL:
+            src += '6-LISTEN'
+        else:
+            src += str(self._src_stack) + '-LISTEN'
         src += ':' + str(self._src_port) + ',fork,su=nobody'
+        if self._src_stack == PortConfig.STACK_DUAL:
+            # Accept IPv4 clients as IPv4 mapped addresses on the same socket
+            src += ',ipv6only=0'
+        if self._src_bind is not None:
+            if ':' in self._src_bind:
+                src += ',bind=[' + self._src_bind + ']'
+            else:
+                src += ',bind=' + self._src_bind
         args.append(src)
 
         dst = prot_str
@@ -51,19 +98,80 @@ class Socat:
         dst += ':' + str(self._dst_port)
         args.append(dst)
 
-        self._proc = Process(args)
-        self._proc.print_args()
-        threading.Thread(target=self._start_socat).start()
+        return Process(args)
 
     def stop(self):
-        if self._proc is None:
+        with self._lock:
+            self._stopped.set()
+            proc = self._proc
+            self._proc = None
+        if proc is None:
+            return
+        proc.stop()
+
+    def stop_accepting(self):
+        """
+        Stops the listening socat process but keeps the forked connection processes running.
+        """
+        with self._lock:
+            self._stopped.set()
+            proc = self._proc
+            self._proc = None
+        if proc is None:
+            return
+        pid = proc.get_pid()
+        if pid is None:
             return
 
-        self._proc.stop()
-        self._proc = None
-
-    def _start_socat(self):
-        self._proc.run()
+        self._connection_pids = Process.get_child_pids(pid)
+        # SIGTERM would be forwarded to the children by socat, SIGKILL is not
+        proc.kill()
+
+    def active_connections(self) -> int:
+        """
+        Returns the number of connections which are still open after stop_accepting was called
+        """
+        self._connection_pids = [pid for pid in self._connection_pids if Process.is_alive(pid)]
+        return len(self._connection_pids)
+
+    def kill_connections(self) -> int:
+        """
+        Terminates all connections which are still open
+        :return: Number of terminated connections
+        """
+        killed = 0
+        for pid in self._connection_pids:
+            if not Process.is_alive(pid):
+                continue
+            try:
+                os.kill(pid, signal.SIGTERM)
+                killed += 1
+            except OSError:
+                pass
+        self._connection_pids = []
+        return killed
+
+    def _start_socat(self, proc: Process):
+        delay = Socat.RESTART_DELAY
+        while not self._stopped.is_set():
+            try:
+                proc.run()
+                error = 'exit code 0'
+            except subprocess.SubprocessError as e:
+                error = str(e)
+            if self._proc is not proc:
+                # Stopped by us
+                return
+
+            self.log.error('socat terminated unexpectedly, restarting in ' + str(delay) + 's: ' + error)
+            if self._stopped.wait(delay):
+                return
+            delay = min(delay * 2, Socat.MAX_RESTART_DELAY)
+            with self._lock:
+                if self._stopped.is_set():
+                    return
+                proc = self._create_process()
+                self._proc = proc
 
 
 class SocatBuilder:
@@ -72,9 +180,11 @@ class SocatBuilder:
 
         self._src_stack = Socat.STACK_IPV_4
         self._src_port = None
+        self._src_bind = None
         self._dst_stack = Socat.STACK_IPV_6
         self._dst_port = None
         self._dst_address = None
+        self._idle_timeout = 0
 
     def protocol(self, protocol: str) -> SocatBuilder:
         protocol = protocol.lower()
@@ -84,11 +194,18 @@ class SocatBuilder:
         self._prot = Socat.PROT_TCP if protocol == 'tcp' else Socat.PROT_UDP
         return self
 
-    def from_address(self, port: int, stack: int = Socat.STACK_IPV_4) -> SocatBuilder:
+    def from_address(self, port: int, stack: int = Socat.STACK_IPV_4, bind: Optional[str] = None) -> SocatBuilder:
+        """
+        :param port: Listening port
+        :param stack: IP stack (4, 6 or dual)
+        :param bind: Local address to listen on, None for the wildcard address
+        """
         self._validate_port('src', port)
         self._src_port = port
-        self._validate_stack('src', stack)
+        if stack != PortConfig.STACK_DUAL:
+            self._validate_stack('src', stack)
         self._src_stack = stack
+        self._src_bind = bind
         return self
 
     def to_address(self, ip_addr: str, port: int, stack: int = Socat.STACK_IPV_4) -> SocatBuilder:
@@ -99,9 +216,16 @@ class SocatBuilder:
         self._dst_address = ip_addr
         return self
 
+    def timeout(self, idle_timeout: float) -> SocatBuilder:
+        """
+        :param idle_timeout: Seconds without any transferred data after which a connection is closed, 0 to disable
+        """
+        self._idle_timeout = idle_timeout
+        return self
+
     def build(self) -> Socat:
         return Socat(self._prot, self._src_stack, self._src_port,
-                     self._dst_stack, self._dst_port, self._dst_address)
+                     self._dst_stack, self._dst_port, self._dst_address, self._src_bind, self._idle_timeout)
 
     @staticmethod
     def _validate_stack(tag: str, stack: int):
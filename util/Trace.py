@@ -0,0 +1,297 @@
+import functools
+import itertools
+import json
+import os
+import sys
+import threading
+from collections import Counter
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from util.Loggable import Loggable
+
+
+class _NullSpan:
+    """
+    Span which is returned while tracing is disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class Span:
+    """
+    Records the time between enter and exit
+    """
+
+    def __init__(self, name: str, category: str, args: Optional[Dict[str, any]]):
+        self._name: str = name
+        self._category: str = category
+        self._args: Optional[Dict[str, any]] = args
+        self._start: float = 0
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        Trace.add(self._name, self._category, self._start, perf_counter() - self._start, self._args)
+        return False
+
+
+class Trace:
+    """
+    Opt-in recording of timing spans into an in-memory ring buffer which can be dumped in the Chrome trace format
+    (chrome://tracing, Perfetto). While tracing is disabled, instrumented code only checks "enabled".
+    """
+
+    enabled: bool = False
+    """
+    True while spans are recorded
+    """
+
+    _NULL_SPAN = _NullSpan()
+    _events: List[Optional[Tuple]] = []
+    _counter = itertools.count()
+    _origin: float = perf_counter()
+
+    @staticmethod
+    def start(capacity: int = 65536):
+        """
+        Enables tracing, previously recorded spans are discarded
+        :param capacity: Maximum number of kept spans, the oldest ones are overwritten
+        """
+        Trace._events = [None] * capacity
+        Trace._counter = itertools.count()
+        Trace.enabled = True
+
+    @staticmethod
+    def stop():
+        Trace.enabled = False
+
+    @staticmethod
+    def span(name: str, category: str, args: Optional[Dict[str, any]] = None):
+        """
+        Returns a context manager which records the time spent in its block
+        """
+        if not Trace.enabled:
+            return Trace._NULL_SPAN
+        return Span(name, category, args)
+
+    @staticmethod
+    def traced(category: str) -> Callable:
+        """
+        Decorator which records a span for every call of the decorated function
+        """
+
+        def decorator(func: Callable) -> Callable:
+            name = func.__qualname__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not Trace.enabled:
+                    return func(*args, **kwargs)
+                start = perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    Trace.add(name, category, start, perf_counter() - start)
+
+            return wrapper
+
+        return decorator
+
+    @staticmethod
+    def add(name: str, category: str, start: float, duration: float, args: Optional[Dict[str, any]] = None):
+        """
+        Records a span, never blocks. Spans of all threads share the buffer.
+        """
+        events = Trace._events
+        if len(events) == 0:
+            return
+        # next() on itertools.count is atomic, no lock required
+        index = next(Trace._counter)
+        events[index % len(events)] = (index, name, category, start, duration, threading.get_ident(), args)
+
+    @staticmethod
+    def get_events() -> List[Tuple]:
+        """
+        Returns the recorded spans, oldest first
+        """
+        events = [event for event in Trace._events if event is not None]
+        events.sort(key=lambda event: event[0])
+        return events
+
+    @staticmethod
+    def to_chrome_trace() -> Dict[str, any]:
+        pid = os.getpid()
+        trace_events = []
+        for thread in threading.enumerate():
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread.ident,
+                                 'args': {'name': thread.name}})
+        for _, name, category, start, duration, tid, args in Trace.get_events():
+            event = {'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': round((start - Trace._origin) * 1e6, 1), 'dur': round(duration * 1e6, 1)}
+            if args is not None:
+                event['args'] = args
+            trace_events.append(event)
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    @staticmethod
+    def dump(path: str):
+        """
+        Writes the recorded spans in the Chrome trace format
+        """
+        with open(path, 'w') as file:
+            json.dump(Trace.to_chrome_trace(), file)
+
+
+class StackSampler(Loggable):
+    """
+    Periodically samples the stacks of all threads to find CPU hotspots.
+    Threads which are waiting (select, locks, sleeping) are not counted.
+    The result is written in the collapsed stack format used by flamegraph.pl and speedscope.
+    """
+
+    IDLE_FUNCTIONS = {'select', 'poll', 'wait', 'sleep', 'accept', 'recv', 'recvfrom', 'readline',
+                      '_wait_for_tstate_lock'}
+    """
+    Top most functions of threads which are blocked
+    """
+
+    MAX_DEPTH = 64
+
+    def __init__(self, interval: float = 0.01):
+        """
+        :param interval: Time between two samples in seconds
+        """
+        super().__init__('StackSampler')
+        self._interval: float = interval
+        self._stacks: Counter = Counter()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.samples: int = 0
+        """
+        Number of taken samples
+        """
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get_stacks(self) -> Counter:
+        """
+        Returns the number of samples per collapsed stack (root first, separated by ";")
+        """
+        return Counter(self._stacks)
+
+    def dump(self, path: str):
+        with open(path, 'w') as file:
+            for stack, count in self._stacks.most_common():
+                file.write(stack + ' ' + str(count) + '\n')
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self._interval):
+            self.sample(own_id)
+
+    def sample(self, own_id: Optional[int] = None):
+        self.samples += 1
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id or frame.f_code.co_name in StackSampler.IDLE_FUNCTIONS:
+                continue
+            stack = []
+            while frame is not None and len(stack) < StackSampler.MAX_DEPTH:
+                code = frame.f_code
+                stack.append(os.path.basename(code.co_filename) + ':' + code.co_name)
+                frame = frame.f_back
+            stack.reverse()
+            self._stacks[';'.join(stack)] += 1
+
+
+class TraceSession(Loggable):
+    """
+    Records spans and stack samples until it is stopped, then writes both to files
+    """
+
+    def __init__(self, path: str, sample_interval: float = 0.01):
+        """
+        :param path: Path of the Chrome trace file, the collapsed stacks are written to <path>.stacks
+        :param sample_interval: Time between two stack samples in seconds
+        """
+        super().__init__('Trace')
+        self._path: str = path
+        self._sample_interval: float = sample_interval
+        self._sampler: Optional[StackSampler] = None
+        self._lock = threading.Lock()
+        self._toggle_requested = threading.Event()
+        self._toggle_thread: Optional[threading.Thread] = None
+
+    def is_running(self) -> bool:
+        return self._sampler is not None
+
+    def start(self):
+        with self._lock:
+            if self._sampler is not None:
+                return
+            Trace.start()
+            self._sampler = StackSampler(self._sample_interval)
+            self._sampler.start()
+            self.log.info('Tracing started')
+
+    def stop(self):
+        """
+        Stops recording and writes the trace
+        """
+        with self._lock:
+            if self._sampler is None:
+                return
+            Trace.stop()
+            self._sampler.stop()
+            try:
+                Trace.dump(self._path)
+                self._sampler.dump(self._path + '.stacks')
+                self.log.info('Trace written to ' + self._path + ' (' + str(len(Trace.get_events())) +
+                              ' spans, ' + str(self._sampler.samples) + ' stack samples)')
+            except OSError as e:
+                self.log.error('Could not write trace ' + self._path + ': ' + str(e))
+            self._sampler = None
+
+    def toggle(self):
+        if self.is_running():
+            self.stop()
+        else:
+            self.start()
+
+    def handle_toggle_requests(self):
+        """
+        Starts the thread which toggles the recording after request_toggle()
+        """
+        if self._toggle_thread is not None:
+            return
+        self._toggle_thread = threading.Thread(target=self._toggle_loop, name='trace-toggle', daemon=True)
+        self._toggle_thread.start()
+
+    def request_toggle(self):
+        """
+        Toggles the recording on the thread of handle_toggle_requests().
+        Safe to call from a signal handler, which must not wait for the lock or write the files itself.
+        """
+        self._toggle_requested.set()
+
+    def _toggle_loop(self):
+        while True:
+            self._toggle_requested.wait()
+            self._toggle_requested.clear()
+            self.toggle()
@@ -1,53 +1,363 @@
-from typing import Optional
+from __future__ import annotations
 
-from config.Config import ForwardConfig
+import socket
+import subprocess
+import threading
+from typing import Optional, List, Tuple, Union, Dict, TYPE_CHECKING
+
+from config.Config import ForwardConfig, Config, PortConfig
 from util.DnsWatcher import DnsWatcher, EntryWatch
 from util.Iptables import Iptables
+from util.Loggable import Loggable
 from util.Socat import SocatBuilder, Socat
+from util.Trace import Trace
+
+if TYPE_CHECKING:
+    # Optional subsystems, only imported if they are used
+    from util.ConnectionLog import ConnectionLog
+    from util.Handover import ListenerRegistry
+    from util.HealthCheck import HealthChecker
+    from util.Mux import MuxRouter
+    from util.Relay import Relay
+    from util.Shaper import Shaper, TokenBucket
 
 
-class Tunnel:
+class Tunnel(Loggable):
     """
     Represents a single tunnel
     """
 
-    def __init__(self, config: ForwardConfig, dest_addr: str, dns_watcher: DnsWatcher):
+    def __init__(self, config: ForwardConfig, global_config: Config, dns_watcher: DnsWatcher,
+                 listeners: Optional[ListenerRegistry] = None, global_bucket: Optional[TokenBucket] = None,
+                 connection_log: Optional[ConnectionLog] = None):
+        """
+        :param config: Forward configuration
+        :param global_config: Global configuration
+        :param dns_watcher: Watcher the destination host is registered at
+        :param listeners: Inherited listening sockets which should be used instead of binding new ones
+        :param global_bucket: Bandwidth limit shared by all tunnels
+        :param connection_log: Export of the connection records (native relay only)
+        """
+        super().__init__('Tunnel')
         self._config = config
-        self._dest_addr: str = dest_addr
-        self._socat: Optional[Socat] = None
+        self._listeners: Optional[ListenerRegistry] = listeners
+        self._connection_log: Optional[ConnectionLog] = connection_log
+        self._dest_addr: Optional[str] = global_config.get_dest_addr(config)
+        self._forwarder: Optional[Union[Socat, Relay]] = None
+        self._dest_ip: Optional[str] = None
+        self._lock = threading.Lock()
+
+        self._router: Optional[MuxRouter] = None
+        """
+        Destinations by requested host name (mux mode only)
+        """
+        self._route_entries: List[Tuple[str, EntryWatch]] = []
+        """
+        Watched destination host per route pattern
+        """
+        self._dns_entry: Optional[EntryWatch] = None
+        self._fallback_entry: Optional[EntryWatch] = None
+        self._health: Optional[HealthChecker] = None
+        if config.mode == ForwardConfig.MODE_MUX:
+            from util.Mux import MuxRouter
+            self._router = MuxRouter(config.routes, config.dest.port)
+            for route in config.routes:
+                self._route_entries.append((route.match, dns_watcher.add(route.host, config.dest.stack,
+                                                                         self._route_changed)))
+            if global_config.health_check is not None:
+                self.log.warning(self.get_name() + ': Health checks are not supported by mux forwards')
+        else:
+            self._dns_entry = dns_watcher.add(self._dest_addr, config.dest.stack, self._dns_changed)
+        if self._dns_entry is not None and global_config.health_check is not None:
+            from util.HealthCheck import HealthChecker
+            if global_config.fallback_addr is not None:
+                self._fallback_entry = dns_watcher.add(global_config.fallback_addr, config.dest.stack,
+                                                       self._dns_changed)
+            self._health = HealthChecker(self.get_name(), config.prot, config.dest.port, config.dest.stack,
+                                         global_config.health_check)
+            self._health.on_selection_changed += self._selection_changed
+
+        self._firewalls: Dict[int, Iptables] = {}
+        """
+        Accept rules per stack, a dual stack listener needs rules for IPv4 and IPv6.
+        Empty if the firewall rules can't be managed.
+        """
+        for stack in config.src.get_stacks():
+            firewall = Iptables.get(stack)
+            if firewall is not None:
+                self._firewalls[stack] = firewall
+        self._iptables: Optional[Iptables] = next(iter(self._firewalls.values()), None)
+        """
+        Used for the DNAT rules, which require the same single stack on both sides
+        """
+
+        self._dnat: bool = False
+        """
+        True if the traffic is forwarded by the kernel instead of socat
+        """
+        if config.mode == ForwardConfig.MODE_DNAT:
+            if config.src.stack != config.dest.stack:
+                self.log.warning(self.get_name() + ': DNAT requires the same stack on both sides, using socat')
+            elif self._iptables is None:
+                self.log.warning(self.get_name() + ': DNAT requires iptables, using socat')
+            else:
+                self._dnat = True
+            if self._dnat and config.src.bind is not None:
+                self.log.warning(self.get_name() + ': The bind address is ignored by DNAT forwards')
 
-        self._dns_entry: EntryWatch = dns_watcher.add(dest_addr, config.dest.stack, self._dns_changed)
-        self._iptables = Iptables(config.src.stack)
+        self._relay: bool = False
+        """
+        True if the traffic is relayed natively instead of using socat
+        """
+        if config.mode == ForwardConfig.MODE_MUX:
+            self._relay = True
+        elif config.mode == ForwardConfig.MODE_RELAY:
+            if config.prot.lower() == 'tcp':
+                self._relay = True
+            else:
+                self.log.warning(self.get_name() + ': The native relay only supports tcp, using socat')
+
+        self._shaper: Optional[Shaper] = None
+        if self._relay and (config.limit is not None or global_bucket is not None):
+            from util.Shaper import Shaper, TokenBucket
+            self._shaper = Shaper(TokenBucket.from_config(config.limit), global_bucket, config.priority)
+        elif config.limit is not None:
+            self.log.warning(self.get_name() + ': Bandwidth limits are only supported by the native relay')
+
+        if self._dnat and (config.idle_timeout > 0 or config.max_lifetime > 0):
+            self.log.warning(self.get_name() + ': Timeouts are ignored by DNAT forwards, conntrack decides')
+        elif not self._relay and config.max_lifetime > 0:
+            self.log.warning(self.get_name() + ': max_lifetime is only supported by the native relay')
+
+    def get_name(self) -> str:
+        return self._config.prot + ':' + PortConfig.get_stack_name(self._config.src.stack) + ':' + \
+            str(self._config.src.port)
 
-    def start(self):
+    def get_health_checker(self) -> Optional[HealthChecker]:
+        return self._health
+
+    @Trace.traced('tunnel')
+    def start(self, add_firewall: bool = True):
         """
         Starts the tunnel
+        :param add_firewall: False if the accept rules have already been added
         """
-        self._iptables.add_entry(self._config.prot, self._config.src.port)
+        if self._dnat:
+            if not self._iptables.forwarding_enabled():
+                self.log.warning(self.get_name() + ': IP forwarding is disabled in the kernel')
+        elif add_firewall:
+            for stack, firewall in self._firewalls.items():
+                firewall.add_entry(*self.get_firewall_entry(stack))
+
+        if self._router is not None:
+            for match, entry in self._route_entries:
+                try:
+                    entry.resolve()
+                except socket.gaierror:
+                    # Connections for this route are closed until the host can be resolved
+                    self.log.warning(self.get_name() + ': Could not resolve the destination of route ' + match)
+            self._update_routes()
+            with self._lock:
+                self._start_tunnel(None)
+            return
 
         ip_addr = self._dns_entry.resolve()
-        self._start_tunnel(ip_addr)
+        if self._health is not None:
+            self._health.set_addresses(self._dns_entry.get_ips(), self._resolve_fallback())
+            ip_addr = self._health.get_selected()
+            self._health.start()
+
+        with self._lock:
+            self._start_tunnel(ip_addr)
+
+    @Trace.traced('tunnel')
+    def stop(self, remove_firewall: bool = True):
+        """
+        Stops the tunnel and terminates all open connections
+        :param remove_firewall: False if the firewall rules have already been removed
+        """
+        if self._health is not None:
+            self._health.stop()
+        with self._lock:
+            self._stop_tunnel()
+        if remove_firewall and not self._dnat:
+            for stack, firewall in self._firewalls.items():
+                firewall.remove_entry(*self.get_firewall_entry(stack))
+
+    def stop_accepting(self, remove_firewall: bool = True):
+        """
+        Stops accepting new connections, open connections are kept alive
+        :param remove_firewall: False if the NAT rules should be kept (handover to a new instance)
+        """
+        if self._health is not None:
+            self._health.stop()
+        with self._lock:
+            if self._dnat:
+                if remove_firewall:
+                    # Established flows are kept by conntrack
+                    self._stop_tunnel()
+                else:
+                    self._dest_ip = None
+            elif self._forwarder is not None:
+                self._forwarder.stop_accepting()
+
+    def active_connections(self) -> int:
+        if self._forwarder is None:
+            return 0
+        return self._forwarder.active_connections()
+
+    def kill_connections(self) -> int:
+        """
+        Terminates all connections which are still open
+        :return: Number of terminated connections
+        """
+        if self._forwarder is None:
+            return 0
+        return self._forwarder.kill_connections()
+
+    def get_listener(self) -> Optional[socket.socket]:
+        """
+        Returns the listening socket if the tunnel owns one (native relay)
+        """
+        if not self._relay or self._forwarder is None:
+            return None
+        return self._forwarder.get_listener()
+
+    def get_stacks(self) -> List[int]:
+        """
+        Returns the IP stacks (4 and/or 6) the firewall rules of the tunnel are installed for
+        """
+        return self._config.src.get_stacks()
+
+    def get_firewall_entry(self, stack: int) -> Optional[Tuple[str, int, Optional[str]]]:
+        """
+        Returns the (protocol, port, local address) of the accept rule of this tunnel for the given stack
+        or None if it doesn't use one. The local address is None if the listener is bound to all addresses.
+        """
+        if self._dnat:
+            return None
+        return self._config.prot, self._config.src.port, self._config.src.get_local_address(stack)
+
+    @staticmethod
+    def get_firewall_entries(tunnels: List[Tunnel]) -> Dict[int, List[Tuple[str, int, Optional[str]]]]:
+        """
+        Returns the accept rules of all given tunnels grouped by stack, so they can be changed in one batch per stack
+        """
+        entries: Dict[int, List[Tuple[str, int, Optional[str]]]] = {}
+        for tunnel in tunnels:
+            for stack in tunnel.get_stacks():
+                entry = tunnel.get_firewall_entry(stack)
+                if entry is not None:
+                    entries.setdefault(stack, []).append(entry)
+        return entries
+
+    def _resolve_fallback(self) -> List[str]:
+        if self._fallback_entry is None:
+            return []
+        try:
+            self._fallback_entry.resolve()
+        except socket.gaierror:
+            return []
+        return self._fallback_entry.get_ips()
+
+    def _start_tunnel(self, dest_ip: Optional[str]):
+        if self._dnat:
+            self._set_dnat(dest_ip)
+            return
 
-    def stop(self):
-        self._stop_tunnel()
-        self._iptables.remove_entry(self._config.prot, self._config.src.port)
+        self._dest_ip = dest_ip
 
-    def _start_tunnel(self, dest_ip: str):
-        self._socat = SocatBuilder().protocol(self._config.prot) \
-            .from_address(self._config.src.port, self._config.src.stack) \
+        if self._relay:
+            from util.Relay import Relay
+            self._forwarder = Relay(self._config.src.stack, self._config.src.port,
+                                    self._config.dest.stack, self._config.dest.port, self._config.buffer_size,
+                                    self._shaper, self._connection_log, self._config.src.bind, self._router,
+                                    self._config.idle_timeout, self._config.max_lifetime)
+            if dest_ip is not None:
+                self._forwarder.set_destination(dest_ip)
+            listener = None
+            if self._listeners is not None:
+                listener = self._listeners.take(self._forwarder.get_family(), self._config.src.port,
+                                                self._config.src.bind or '',
+                                                self._config.src.stack == PortConfig.STACK_DUAL)
+            self._forwarder.start(listener)
+            return
+
+        self._forwarder = SocatBuilder().protocol(self._config.prot) \
+            .from_address(self._config.src.port, self._config.src.stack, self._config.src.bind) \
             .to_address(dest_ip, self._config.dest.port, self._config.dest.stack) \
+            .timeout(self._config.idle_timeout) \
             .build()
 
-        self._socat.start()
+        self._forwarder.start()
+
+    def _set_dnat(self, dest_ip: str):
+        try:
+            self._iptables.set_dnat(self._config.prot, self._config.src.port, dest_ip, self._config.dest.port)
+        except subprocess.SubprocessError:
+            # The destination is kept unchanged, so the next change tries again
+            self.log.error(self.get_name() + ': Could not install NAT rules for ' + dest_ip)
+            return
+        self._dest_ip = dest_ip
 
     def _stop_tunnel(self):
-        if self._socat is None:
+        if self._dnat:
+            if self._dest_ip is not None:
+                self._iptables.remove_dnat(self._config.prot, self._config.src.port)
+                self._dest_ip = None
             return
 
-        self._socat.stop()
-        self._socat = None
+        if self._forwarder is None:
+            return
+
+        self._forwarder.stop()
+        self._forwarder = None
+
+    def _restart_tunnel(self, dest_ip: str):
+        with self._lock:
+            if self._dnat:
+                # The rules are rewritten in place, established connections are kept by conntrack
+                if dest_ip != self._dest_ip:
+                    self._set_dnat(dest_ip)
+                return
+
+            if self._forwarder is not None and dest_ip == self._dest_ip:
+                return
+
+            if self._relay and self._forwarder is not None:
+                # Only new connections use the new destination, open ones are kept
+                self._dest_ip = dest_ip
+                self._forwarder.set_destination(dest_ip)
+                return
 
+            self._stop_tunnel()
+            self._start_tunnel(dest_ip)
+
+    @Trace.traced('dns')
     def _dns_changed(self, new_addr: str):
+        if self._health is not None:
+            # Let the health checker decide which of the new addresses should be used
+            fallback = self._fallback_entry.get_ips() if self._fallback_entry is not None else []
+            self._health.set_addresses(self._dns_entry.get_ips(), fallback)
+            return
+
+        if self._dest_ip in self._dns_entry.get_ips():
+            # The address in use is still valid
+            return
+
         # DNS of destination has been changed -> Restart tunnel
-        self._stop_tunnel()
-        self._start_tunnel(new_addr)
+        self._restart_tunnel(new_addr)
+
+    def _update_routes(self):
+        for match, entry in self._route_entries:
+            ips = entry.get_ips()
+            self._router.set_address(match, ips[0] if len(ips) > 0 else None)
+
+    @Trace.traced('dns')
+    def _route_changed(self, new_addr: str):
+        # Open connections are kept, only new ones use the new addresses
+        self._update_routes()
+
+    def _selection_changed(self, new_addr: str):
+        # A different upstream address is healthier / faster -> Restart tunnel
+        self._restart_tunnel(new_addr)